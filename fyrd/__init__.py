@@ -139,8 +139,10 @@ Full help is available at::
     github.com/MikeDacre/fyrd
 """
 import os as _os
+import sys as _sys
 import signal as _signal
 import atexit as _atexit
+from importlib import import_module as _import_module
 
 # Version Number
 __version__ = '0.6.1-beta.6'
@@ -172,7 +174,6 @@ from . import queue
 from . import job
 from . import conf
 from . import options
-from . import helpers
 from .run import check_pid as _check_pid
 
 from .queue import Queue
@@ -181,6 +182,7 @@ from .queue import check_queue
 from .queue import get_cluster_environment
 
 from .job import Job
+from .job import JobTemplate
 from .basic import submit
 from .basic import submit_file
 from .basic import make_job_file
@@ -192,16 +194,48 @@ from .conf import get_profile
 
 from .options import option_help
 
-__all__ = ['Job', 'Queue', 'wait', 'submit', 'submit_file', 'make_job_file',
+__all__ = ['Job', 'JobTemplate', 'Workflow', 'WorkerPool', 'Queue', 'wait',
+           'submit', 'submit_packed', 'submit_file', 'make_job_file',
            'clean', 'clean_dir', 'check_queue', 'option_help', 'set_profile',
            'get_profile', 'helpers']
 
+# Rarely used modules are only imported on first use, see __getattr__
+# {name: (module, attribute or None for the module itself)}
+_LAZY = {
+    'helpers':       ('helpers', None),
+    'workflow':      ('workflow', None),
+    'pack':          ('pack', None),
+    'workers':       ('workers', None),
+    'daemon':        ('daemon', None),
+    'Workflow':      ('workflow', 'Workflow'),
+    'WorkerPool':    ('workers', 'WorkerPool'),
+    'submit_packed': ('pack', 'submit_packed'),
+}
+
+
+def __getattr__(name):
+    """Import the module holding name the first time it is used."""
+    if name not in _LAZY:
+        raise AttributeError("module '{}' has no attribute '{}'"
+                             .format(__name__, name))
+    module, attr = _LAZY[name]
+    obj = _import_module('.' + module, __name__)
+    if attr:
+        obj = getattr(obj, attr)
+    globals()[name] = obj
+    return obj
+
+# Module __getattr__ needs python 3.7
+if _sys.version_info < (3, 7):
+    for _name in _LAZY:
+        __getattr__(_name)
+
 ##########################
 #  Set the cluster type  #
 ##########################
 
-queue.MODE = get_cluster_environment()
-check_queue()
+# queue.MODE is detected on first use by queue.check_queue(), so importing
+# fyrd does not search the PATH or read the config
 
 
 ###############################
@@ -94,11 +94,20 @@ WAIT_HELP = """\
 Wait on a list of jobs, block until they complete.
 """
 
+DAEMON_HELP = """\
+Start or stop the local job daemon, which runs the local jobs of all python
+processes of this user with one set of cores and one memory budget.
+
+While it is running, qtype='local' jobs are sent to it, unless the jobqueue
+daemon config option is False.
+"""
+
 DEFAULT_CONF_SECTIONS = set(fyrd.conf.DEFAULTS.keys())
 DEFAULT_CONF_OPTS = set(
     chain(*[list(i.keys()) for i in fyrd.conf.DEFAULTS.values()])
 )
 
+fyrd.conf.load_config()  # Creates the file if needed
 with open(fyrd.conf.CONFIG_FILE) as fin:
     CURRENT_CONF = fin.read()
 
@@ -154,6 +163,7 @@ Caution:
         .<suffix> for local mode
         _func.<suffix>.py
         _func.<suffix>.py.pickle.in
+        _func.<suffix>.py.pickle.in.buf
         _func.<suffix>.py.pickle.out
 
 """
@@ -380,6 +390,28 @@ def wait(args):
     q.wait(args.jobs)
 
 
+def daemon(args):
+    """Start, stop, or show the local daemon."""
+    if args.action == 'start':
+        if fyrd.daemon.start(cores=args.cores, mem=args.mem):
+            print('Local daemon started')
+        else:
+            print('Local daemon is already running')
+    elif args.action == 'stop':
+        if fyrd.daemon.stop():
+            print('Local daemon stopped')
+        else:
+            print('Local daemon is not running')
+    else:
+        if fyrd.daemon.running():
+            print('Local daemon is running on {}'.format(
+                fyrd.daemon.socket_path()))
+        else:
+            print('Local daemon is not running')
+            return 1
+    return 0
+
+
 def clean_dir(args):
     """Clean up a job directory."""
     if args.dir:
@@ -539,7 +571,8 @@ def command_line_parser():
 
     # Subcommands
     modes = parser.add_subparsers(
-        dest='modes', metavar='{conf,prof,keywords,queue,wait,clean}')
+        dest='modes',
+        metavar='{conf,prof,keywords,queue,wait,daemon,clean}')
 
     #########################
     #  Config Manipulation  #
@@ -726,6 +759,27 @@ def command_line_parser():
     # Set function
     wait_sub.set_defaults(func=wait)
 
+    ##################
+    #  Local Daemon  #
+    ##################
+
+    daemon_sub = modes.add_parser(
+        'daemon', description=DAEMON_HELP, help="Manage the local daemon",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+
+    daemon_sub.add_argument('action', choices=('start', 'stop', 'status'),
+                            nargs='?', default='status',
+                            help="What to do, default status")
+    daemon_sub.add_argument('-c', '--cores', type=int,
+                            help="Cores jobs may use, default all")
+    daemon_sub.add_argument('-m', '--mem', type=int,
+                            help="MB of memory jobs may reserve, default "
+                            "from the config")
+
+    # Set function
+    daemon_sub.set_defaults(func=daemon)
+
     ########################
     #  Directory Cleaning  #
     ########################
@@ -4,6 +4,7 @@ Functions to allow simple job and file submission without the Job class.
 """
 import os  as _os
 import sys as _sys
+import shutil as _shutil
 from time import sleep as _sleep
 from subprocess import CalledProcessError as _CalledProcessError
 
@@ -17,6 +18,7 @@ from . import conf  as _conf
 from . import queue as _queue
 from . import local as _local
 from . import logme as _logme
+from . import serialize as _serialize
 from . import ClusterError as _ClusterError
 from .job import Job
 
@@ -58,7 +60,6 @@ def submit(command, args=None, kwargs=None, name=None, qtype=None,
     job = Job(command=command, args=args, kwargs=kwargs, name=name,
               qtype=qtype, profile=profile, **kwds)
 
-    job.write()
     job.submit()
     job.update()
 
@@ -264,9 +265,8 @@ def submit_file(script_file, dependencies=None, threads=None, qtype=None):
                     depends.append(int(depend))
         command = 'bash {}'.format(script_file)
         # Make sure the global job pool exists
-        if not _local.JQUEUE or not _local.JQUEUE.runner.is_alive():
-            _local.JQUEUE = _local.JobQueue(cores=threads)
-        return _local.JQUEUE.add(_run.cmd, (command,), dependencies=depends)
+        return _local.get_queue(threads).add(_run.cmd, (command,),
+                                             dependencies=depends)
 
 
 def clean_work_dirs(outputs=False, confirm=False):
@@ -298,12 +298,16 @@ def clean_dir(directory=None, suffix=None, qtype=None, confirm=False,
                  .<suffix>.err
                  .<suffix>.out
                  .<suffix>.out.func.pickle
+                 .<suffix>.out.func.pickle.buf
                  .<suffix>.sbatch & .<suffix>.script for slurm mode
                  .<suffix>.qsub for torque mode
                  .<suffix> for local mode
                  _func.<suffix>.py
                  _func.<suffix>.py.pickle.in
+                 _func.<suffix>.py.pickle.in.buf
                  _func.<suffix>.py.pickle.out
+                 fyrd_blobs/ (the blob store shared by function jobs), unless
+                 qtype is set
 
     Args:
         directory (str):       The directory to run in, defaults to the current
@@ -330,7 +334,9 @@ def clean_dir(directory=None, suffix=None, qtype=None, confirm=False,
     if delete_outputs:
         extensions += ['.' + suffix + '.err', '.' + suffix + '.out',
                        '_func.' + suffix + '.py.pickle.out',
-                       '.' + suffix + '.out.func.pickle']
+                       '.' + suffix + '.out.func.pickle',
+                       '.' + suffix + '.out.tasks',
+                       '.' + suffix + '.out.func.pickle.buf']
 
     if qtype:
         if qtype == 'local':
@@ -342,13 +348,21 @@ def clean_dir(directory=None, suffix=None, qtype=None, confirm=False,
     else:
         extensions.append('.' + suffix)
         extensions.append('_func.' + suffix + '.py.pickle.in')
+        extensions.append('_func.' + suffix + '.py.pickle.in.buf')
         extensions += ['.' + suffix + '.sbatch', '.' + suffix + '.script']
         extensions.append('.' + suffix + '.qsub')
 
     files = [_os.path.join(directory, i) for i in _os.listdir(directory)]
     files = [i for i in files if _os.path.isfile(i)]
 
-    if not files:
+    # The blob store is shared by jobs of all queue types
+    blob_dir = _os.path.join(directory, _serialize.BLOB_DIR)
+    blobs    = []
+    if not qtype and _os.path.isdir(blob_dir):
+        for root, _, names in _os.walk(blob_dir):
+            blobs += [_os.path.join(root, i) for i in names]
+
+    if not files and not blobs:
         _logme.log('No files found.', 'debug')
         return []
 
@@ -358,7 +372,7 @@ def clean_dir(directory=None, suffix=None, qtype=None, confirm=False,
             if f.endswith(extension):
                 deleted.append(f)
 
-    deleted = sorted(deleted)
+    deleted = sorted(deleted) + sorted(blobs)
     delete  = False
 
     if confirm:
@@ -384,6 +398,8 @@ def clean_dir(directory=None, suffix=None, qtype=None, confirm=False,
     if delete and deleted:
         for f in deleted:
             _os.remove(f)
+        if blobs:
+            _shutil.rmtree(blob_dir, ignore_errors=True)
         if confirm:
             _sys.stdout.write('Done\n')
 
@@ -17,7 +17,6 @@ Options will also be pre-sanitized before being added to profile. e.g. 'mem':
 """
 from __future__ import print_function
 import os       as _os
-import readline as _rl
 from textwrap import dedent as _dnt
 try:
     import configparser as _configparser
@@ -29,6 +28,17 @@ from . import logme   as _logme
 from . import options as _opt
 
 
+class _LazyReadline(object):
+
+    """Import readline on first use, it is only needed by the wizards."""
+
+    def __getattr__(self, attr):
+        import readline
+        return getattr(readline, attr)
+
+_rl = _LazyReadline()
+
+
 ###############################################################################
 #                            Configurable Defaults                            #
 ###############################################################################
@@ -65,10 +75,21 @@ DEFAULTS = {
         'generic_python':  False,
         'profile_file':    _os.path.join(
             CONFIG_PATH, 'profiles.txt'
-        )
+        ),
+        'memo_path':       None,
+        'memo_size':       2048,
+        'blob_size':       10240,
+        'blob_age':        30,
     },
     'jobqueue': {
-        'jobno': 1
+        'jobno':       1,
+        'jobno_block': 100,
+        'max_tasks':   0,
+        'mem':         0,
+        'mem_sample':  0,
+        'affinity':    True,
+        'journal':     True,
+        'daemon':      True,
     },
 }
 
@@ -141,6 +162,17 @@ CONF_HELP = {
                                    current executable, not advised, but
                                    sometimes necessary.
             profile_file (str):    the config file where profiles are defined.
+            memo_path (str):       Where to store the results of function jobs
+                                   submitted with memo=True, default is memo
+                                   in the config directory.
+            memo_size (int):       Maximum size of memo_path in MB, the least
+                                   recently used results are deleted first.
+            blob_size (int):       Maximum size in MB of the fyrd_blobs store
+                                   of functions and large arguments in each
+                                   script path, the least recently used are
+                                   deleted first.
+            blob_age (int):        Days after which unused blobs are deleted,
+                                   must be longer than jobs wait to run.
         """
     ),
     'jobqueue': _dnt(
@@ -148,6 +180,27 @@ CONF_HELP = {
         [jobqueue]
         Sets options for the local queue system, will be removed in the future
         in favor of database.
+
+            jobno (int):     The local job number to start from if there is
+                             no jobqueue_state file in the config folder,
+                             which now holds the current number.
+            jobno_block (int): Local job numbers to claim from the state
+                             file at once, it is only written once per block.
+            max_tasks (int): Replace each local worker process after it has
+                             run this many jobs, 0 to keep them forever.
+            mem (int):       Memory in MB that local jobs may reserve with
+                             the mem option, 0 to use MemAvailable from
+                             /proc/meminfo.
+            mem_sample (int): Check the memory use (RSS) of running local
+                             jobs every this many seconds, and reserve it if
+                             more than they asked for, 0 to never check.
+            affinity (bool): Pin each local job to its own CPUs, one per
+                             core it asked for, on one NUMA node if possible.
+            journal (bool):  Record local jobs in a journal in a private
+                             folder in the temp folder, so a restarted local
+                             queue resumes them.
+            daemon (bool):   Send local jobs to the local daemon of this
+                             user if it is running (see fyrd.daemon).
         """
     ),
 }
@@ -200,8 +253,13 @@ profiles = _configparser.ConfigParser(defaults=DEFAULT_PROFILES['DEFAULT'],
                                       allow_no_value=True)
 """
 This is the globally accessible ConfigParser object for handling profiles.
+
+Both are loaded on first use, and only read again if the file changes.
 """
 
+# (mtime, size) of the config and profile files when last read or written
+_READ = {}
+
 __all__ = ['set_option', 'get_option', 'delete', 'create_config',
            'create_config_interactive', 'set_profile',
            'get_profile', 'del_profile', 'create_profiles']
@@ -212,6 +270,24 @@ __all__ = ['set_option', 'get_option', 'delete', 'create_config',
 ###############################################################################
 
 
+class ConfigDefault(object):
+
+    """A class attribute that reads its value from the config when used.
+
+    Instances can still override it by setting the attribute, this just
+    avoids reading the config when the class is defined (i.e. on import).
+    """
+
+    def __init__(self, section, key):
+        """Store the section and key to use."""
+        self.section = section
+        self.key     = key
+
+    def __get__(self, instance, owner):
+        """Return the current config value."""
+        return get_option(self.section, self.key)
+
+
 def get_option(section=None, key=None, default=None):
     """Get a single key or section.
 
@@ -335,9 +411,13 @@ def load_config():
     Returns:
         ConfigParser: Config options.
     """
+    if _sections(config) and not _changed(CONFIG_FILE):
+        return config
     if _os.path.isfile(CONFIG_FILE):
         config.read(CONFIG_FILE)
+        _mark_read(CONFIG_FILE)
     else:
+        _make_config_path()
         create_config()
 
     for section in DEFAULTS:
@@ -360,6 +440,7 @@ def write_config():
     """Write the current config to CONFIG_FILE."""
     with open(CONFIG_FILE, 'w') as fout:
         config.write(fout)
+    _mark_read(CONFIG_FILE)
 
 
 ###############################################################################
@@ -513,6 +594,7 @@ def create_config(cnf=None, def_queue=None):
 
     with open(CONFIG_FILE, 'w') as fout:
         config.write(fout)
+    _mark_read(CONFIG_FILE)
 
     if def_queue:
         def_prof = get_profile('DEFAULT')
@@ -712,6 +794,7 @@ def create_profiles(profs=None):
 
     with open(config.get('jobs', 'profile_file'), 'w') as fout:
         profiles.write(fout)
+    _mark_read(config.get('jobs', 'profile_file'))
 
 
 def load_profiles():
@@ -720,9 +803,13 @@ def load_profiles():
     Returns:
         ConfigParser: profiles
     """
-    if not _os.path.isfile(config.get('jobs', 'profile_file')):
+    profile_file = load_config().get('jobs', 'profile_file')
+    if not _os.path.isfile(profile_file):
         create_profiles()
-    profiles.read(config.get('jobs', 'profile_file'))
+    if not _changed(profile_file):
+        return profiles
+    profiles.read(profile_file)
+    _mark_read(profile_file)
 
     # Recreate DEFAULT if necessary.
     def_prof = _config_to_dict(profiles)['DEFAULT']
@@ -753,6 +840,29 @@ def write_profiles():
 ###############################################################################
 
 
+def _changed(file_name):
+    """Return True if file_name changed since it was last read or written."""
+    try:
+        stat = _os.stat(file_name)
+    except OSError:
+        return True
+    return _READ.get(file_name) != (stat.st_mtime, stat.st_size)
+
+
+def _mark_read(file_name):
+    """Record the state of file_name after reading or writing it."""
+    stat = _os.stat(file_name)
+    _READ[file_name] = (stat.st_mtime, stat.st_size)
+
+
+def _make_config_path():
+    """Create the config directory if it doesn't exist."""
+    if not _os.path.isdir(CONFIG_PATH):
+        if _os.path.exists(CONFIG_PATH):
+            _os.remove(CONFIG_PATH)
+        _os.makedirs(CONFIG_PATH)
+
+
 def _sections(cnf, inc_anyway=False):
     """Include default in sections if it has items.
 
@@ -964,22 +1074,3 @@ def _get_set_path(message):
                 else:
                     continue
     return file_path
-
-
-###############################################################################
-#           Set Constants from config, initialize config on import            #
-###############################################################################
-
-# Create directory if it doesn't exist
-if not _os.path.isdir(CONFIG_PATH):
-    if _os.path.exists(CONFIG_PATH):
-        _os.remove(CONFIG_PATH)
-    _os.makedirs(CONFIG_PATH)
-if not _os.path.isfile(CONFIG_FILE):
-    create_config()
-
-# Load config
-config = load_config()
-
-# Load profiles
-profiles = load_profiles()
@@ -0,0 +1,550 @@
+# -*- coding: utf-8 -*-
+"""
+A local job daemon shared by all Python processes of one user.
+
+Every JobQueue has its own job_runner, so two scripts that each use the local
+queue both use every core, and neither knows about the memory the other has
+reserved. `serve()` instead runs a single job_runner behind a Unix domain
+socket (`socket_path()`, in a directory only the user can open), which owns
+the cores and the memory budget of the machine, and any Python process can
+send jobs to it.
+
+When the daemon is running, `local.get_queue()` (and so every ``qtype='local'``
+job) connects to it with a `DaemonQueue` instead of starting its own runner,
+unless the jobqueue `daemon` config option is False. A DaemonQueue works just
+like a JobQueue: job numbers come from the shared state file, so they are
+unique across processes and jobs may depend on the jobs of other processes,
+and the daemon only forwards each process the changes to its own jobs. Thread
+jobs still run in the process that added them.
+
+Start and stop the daemon with::
+
+    fyrd daemon start --cores 16
+    fyrd daemon stop
+
+or with `start()` and `stop()`. It runs with the python path of the process
+that started it, functions defined in a script's ``__main__`` are sent by
+value.
+
+Jobs keep running if the process that added them exits, but their outputs
+are dropped, except thread jobs, which fail.
+"""
+import os as _os
+import sys as _sys
+import atexit as _atexit
+import pickle as _pickle
+import signal as _signal
+import argparse as _argparse
+import threading as _threading
+import subprocess as _sub
+import multiprocessing as _mp
+from copy import copy as _copy
+from itertools import count as _count
+from time import sleep as _sleep
+from time import time as _time
+try:
+    from queue import Empty as _Empty
+except ImportError:  # python2
+    from Queue import Empty as _Empty
+try:
+    from multiprocessing.connection import wait as _mp_wait
+    from multiprocessing.connection import Client as _Client
+    from multiprocessing.connection import Listener as _Listener
+except ImportError:  # python2
+    _mp_wait = None
+
+from . import run as _run
+from . import conf as _conf
+from . import local as _local
+from . import logme as _logme
+from . import serialize as _serialize
+from . import ClusterError as _ClusterError
+
+__all__ = ['DaemonQueue', 'serve', 'start', 'stop', 'running', 'connect',
+           'socket_path']
+
+# Seconds to wait for the daemon to start, stop, or answer
+TIMEOUT = 10
+
+
+###############################################################################
+#                               Socket Location                               #
+###############################################################################
+
+
+def socket_path(create=False):
+    """Return the path to the daemon socket of this user.
+
+    Args:
+        create (bool): Create the directory of the socket, see
+                       `local.user_dir()`.
+
+    Raises:
+        ClusterError: If the directory is accessible to other users.
+    """
+    # Jobs are pickled over the socket, so nobody else may connect
+    return _os.path.join(_local.user_dir(create), 'jobqueue.sock')
+
+
+###############################################################################
+#                                 The Daemon                                  #
+###############################################################################
+
+
+class _ClientState(object):
+
+    """What the daemon knows about one connected process."""
+
+    def __init__(self):
+        """Number changes from 1, like a job_runner."""
+        self.seq     = _count(1)
+        self.threads = set()  # Thread jobs that have not ended
+
+
+def serve(cores=None, mem=None, path=None):
+    """Run the daemon in this process until it is stopped.
+
+    The other jobqueue options (max_tasks, mem_sample, affinity, journal) are
+    taken from the config. If the runner dies it is restarted, and resumes
+    from the journal.
+
+    Args:
+        cores (int): Number of cores to use, defaults to all.
+        mem (int):   MB of memory jobs may reserve, 0 to use MemAvailable,
+                     default from the jobqueue config.
+        path (str):  The socket, default `socket_path()`.
+    """
+    if _mp_wait is None:
+        raise _ClusterError('The local daemon requires python 3')
+    path = path if path else socket_path(create=True)
+    if running(path):
+        raise _ClusterError('A daemon is already running on {}'.format(path))
+    if _os.path.exists(path):
+        _os.remove(path)  # Left by a daemon that was killed
+    _local.reset_affinity()
+    cores      = int(cores) if cores else _local.THREADS
+    mem        = int(mem) if mem is not None else \
+        int(_conf.get_option('jobqueue', 'mem', '0'))
+    max_tasks  = int(_conf.get_option('jobqueue', 'max_tasks', '0'))
+    mem_sample = float(_conf.get_option('jobqueue', 'mem_sample', '0'))
+    affinity   = _conf.get_option('jobqueue', 'affinity', True)
+    journal    = None
+    if _conf.get_option('jobqueue', 'journal', True):
+        # The processes that owned the jobs of a killed daemon are gone
+        journal = path + '.journal'
+        if _os.path.isfile(journal):
+            _os.remove(journal)
+
+    jobqueue = _mp.Queue()
+    outputs  = _mp.Queue()
+
+    def start_runner():
+        """Start a job_runner, it resumes from the journal if there is one."""
+        runner = _mp.Process(target=_local.job_runner,
+                             args=(jobqueue, outputs, cores, 1, max_tasks,
+                                   mem, mem_sample, affinity, journal),
+                             name='Runner')
+        runner.start()
+        return runner
+
+    runner   = start_runner()
+    listener = _Listener(path, 'AF_UNIX')
+    clients  = {}  # {Connection: _ClientState}
+    owners   = {}  # {job_no: Connection} for jobs that have not ended
+    exits    = {}  # {job_no: exitcode} of thread jobs not done yet
+    accepted = []  # New connections
+    lock     = _threading.Lock()
+    wake_r, wake_w = _os.pipe()
+
+    def accept():
+        """Greet new connections and wake the main loop for them."""
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, EOFError):
+                return  # The listener was closed
+            try:
+                conn.send(('hello', cores, _os.getpid()))
+            except (OSError, EOFError):
+                conn.close()
+                continue
+            with lock:
+                accepted.append(conn)
+            _os.write(wake_w, b'.')
+
+    def send(conn, changes):
+        """Send changes to one client, drop it if it is gone."""
+        state = clients[conn]
+        try:
+            conn.send([(next(state.seq), jobno, field, value)
+                       for _, jobno, field, value in changes])
+        except (OSError, EOFError):
+            drop(conn)
+
+    def drop(conn):
+        """Forget a client, failing its thread jobs."""
+        state = clients.pop(conn)
+        conn.close()
+        for jobno in state.threads:
+            if jobno not in exits:
+                exits[jobno] = 1
+                jobqueue.put((jobno, 1))
+        for jobno in [i for i, j in owners.items() if j is conn]:
+            del owners[jobno]
+        _logme.log('Client disconnected, {} clients'.format(len(clients)),
+                   'debug')
+
+    def receive(conn):
+        """Handle one message from a client, return False to stop."""
+        try:
+            msg = conn.recv()
+        except (OSError, EOFError):
+            drop(conn)
+            return True
+        if msg == 'stop':
+            return False
+        if msg[0] == 'exit':
+            _, jobno, code = msg
+            exits[jobno] = code
+            jobqueue.put((jobno, code))
+            return True
+        _, jobno, depends, payload = msg
+        try:
+            job = _pickle.loads(payload)
+        except Exception as err:
+            # Fail the job in the runner, so its dependents are cancelled
+            _logme.log('Could not load local job {}: {}'.format(jobno, err),
+                       'error')
+            job    = _local.Job(_unloadable, ('{}: {}'.format(
+                type(err).__name__, err),), depends=depends)
+            job.id = jobno
+        owners[jobno] = conn
+        if job.executor == 'thread':
+            clients[conn].threads.add(jobno)
+        jobqueue.put(job)
+        return True
+
+    def forward(changes):
+        """Send each client the changes to its own jobs."""
+        out = {}
+        for change in changes:
+            _, jobno, field, value = change
+            conn = owners.get(jobno)
+            if field == 'state' and value in _local.END_STATES:
+                owners.pop(jobno, None)
+                exits.pop(jobno, None)
+                if conn is not None:
+                    clients[conn].threads.discard(jobno)
+            if conn is None:
+                if isinstance(value, _local.Result):
+                    value.load()  # Free its shared memory
+                continue
+            out.setdefault(conn, []).append(change)
+        for conn, conn_changes in out.items():
+            if conn in clients:
+                send(conn, conn_changes)
+
+    def failed_all():
+        """Without a journal, every job of a dead runner failed."""
+        for jobno in list(owners):
+            forward([(0, jobno, 'exitcode', 1), (0, jobno, 'state', 'done')])
+
+    _signal.signal(_signal.SIGTERM, _local._exit)
+    thread = _threading.Thread(target=accept, name='Accept')
+    thread.daemon = True
+    thread.start()
+    _logme.log('Local daemon on {} with {} cores'.format(path, cores), 'info')
+    try:
+        while True:
+            ready = _mp_wait([wake_r, outputs._reader, runner.sentinel] +
+                             list(clients))
+            if wake_r in ready:
+                _os.read(wake_r, 1024)
+                with lock:
+                    for conn in accepted:
+                        clients[conn] = _ClientState()
+                    accepted[:] = []
+            if runner.sentinel in ready:
+                _logme.log('Runner died, restarting it', 'warn')
+                runner.join()
+                if not journal:
+                    failed_all()
+                runner = start_runner()
+                for item in exits.items():
+                    jobqueue.put(item)
+            while True:
+                try:
+                    forward(outputs.get_nowait())
+                except _Empty:
+                    break
+            if not all(receive(i) for i in ready if i in clients):
+                break
+    finally:
+        _logme.log('Stopping the local daemon', 'info')
+        for conn in list(clients):
+            conn.close()
+        listener.close()
+        runner.terminate()
+        runner.join(1)
+        if _run.check_pid(runner.pid):
+            _os.kill(runner.pid, _signal.SIGKILL)
+        _os.close(wake_r)
+        _os.close(wake_w)
+        if _os.path.exists(path):
+            _os.remove(path)
+        if journal and _os.path.isfile(journal):
+            _os.remove(journal)
+
+
+def _unloadable(message):
+    """Stands in for a job the daemon could not load."""
+    raise _ClusterError('The local daemon could not load this job, its '
+                        'function must be importable: {}'.format(message))
+
+
+###############################################################################
+#                           Controlling the Daemon                            #
+###############################################################################
+
+
+def running(path=None):
+    """Return True if a daemon is listening on path."""
+    if _mp_wait is None:
+        return False
+    path = path if path else socket_path()
+    if not _os.path.exists(path):
+        return False
+    try:
+        _Client(path, 'AF_UNIX').close()
+    except (OSError, EOFError):
+        return False
+    return True
+
+
+def start(cores=None, mem=None, path=None):
+    """Start the daemon in the background, unless it is running.
+
+    It gets the python path of this process, and logs to daemon.log next to
+    the socket.
+
+    Args:
+        cores (int): Number of cores to use, defaults to all.
+        mem (int):   MB of memory jobs may reserve, default from the config.
+        path (str):  The socket, default `socket_path()`.
+
+    Returns:
+        bool: True if the daemon was started.
+    """
+    path = path if path else socket_path(create=True)
+    if running(path):
+        return False
+    args = [_sys.executable, '-m', 'fyrd.daemon', '--socket', path]
+    if cores:
+        args += ['--cores', str(cores)]
+    if mem is not None:
+        args += ['--mem', str(mem)]
+    env = dict(_os.environ)
+    env['PYTHONPATH'] = _os.pathsep.join(
+        [_os.path.abspath(i) if i else _os.getcwd() for i in _sys.path]
+    )
+    logfile = _os.path.join(_os.path.dirname(path), 'daemon.log')
+    with open(logfile, 'a') as log:
+        # In its own session, so it outlives this shell
+        _sub.Popen(args, stdin=_sub.DEVNULL, stdout=log, stderr=_sub.STDOUT,
+                   env=env, start_new_session=True)
+    start_time = _time()
+    while not running(path):
+        if _time() - start_time > TIMEOUT:
+            raise _ClusterError('The local daemon did not start, see {}'
+                                .format(logfile))
+        _sleep(0.05)
+    return True
+
+
+def stop(path=None):
+    """Stop the daemon, jobs it is running are killed.
+
+    Returns:
+        bool: True if a daemon was stopped.
+    """
+    path = path if path else socket_path()
+    if not running(path):
+        return False
+    conn = _Client(path, 'AF_UNIX')
+    # Take the greeting first, the daemon drops clients that hang up on it
+    if conn.poll(TIMEOUT):
+        conn.recv()
+    conn.send('stop')
+    conn.close()
+    start_time = _time()
+    while _os.path.exists(path):
+        if _time() - start_time > TIMEOUT:
+            raise _ClusterError('The local daemon did not stop')
+        _sleep(0.05)
+    return True
+
+
+def connect(path=None):
+    """Return a DaemonQueue if the daemon is running, else None."""
+    path = path if path else socket_path()
+    if not running(path):
+        return None
+    try:
+        return DaemonQueue(path)
+    except (OSError, EOFError, _ClusterError) as err:
+        _logme.log('Could not connect to the local daemon: {}'.format(err),
+                   'warn')
+        return None
+
+
+###############################################################################
+#                         The Queue Used by Processes                         #
+###############################################################################
+
+
+class _Link(object):
+
+    """Stands in for the runner Process of a JobQueue."""
+
+    def __init__(self, conn, pid):
+        """The connection to the daemon, and its PID."""
+        self.conn = conn
+        self.pid  = pid
+
+    def is_alive(self):
+        """True while the connection is open."""
+        return not self.conn.closed
+
+    def terminate(self):
+        """Disconnect, the daemon keeps running."""
+        self.conn.close()
+
+
+class DaemonQueue(_local.JobQueue):
+
+    """A JobQueue whose jobs are run by the local daemon."""
+
+    shared = True
+
+    def __init__(self, path=None):
+        """Connect to the daemon.
+
+        Args:
+            path (str): The socket, default `socket_path()`.
+
+        Raises:
+            ClusterError: If the daemon does not answer.
+        """
+        self._init_jobs(None)
+        self.path    = path if path else socket_path()
+        self.journal = None
+        self._conn   = _Client(self.path, 'AF_UNIX')
+        self._send_lock = _threading.Lock()
+        if not self._conn.poll(TIMEOUT):
+            self._conn.close()
+            raise _ClusterError('The local daemon did not answer')
+        _, self.cores, self.pid = self._conn.recv()
+        self.runner = _Link(self._conn, self.pid)
+        _logme.log('Connected to the local daemon ({} cores)'
+                   .format(self.cores), 'debug')
+
+        def close():
+            """Disconnect and give back unused job numbers."""
+            self._conn.close()
+            self.numbers.close()
+
+        _atexit.register(close)
+
+    def _send(self, item):
+        """Send a Job, or (job_no, exitcode) of a thread job, to the daemon."""
+        if isinstance(item, tuple):
+            msg = ('exit',) + tuple(item)
+        else:
+            msg = ('job', item.id, item.depends, _dumps(item))
+        with self._send_lock:
+            try:
+                self._conn.send(msg)
+            except (OSError, EOFError):
+                self._conn.close()
+                raise _ClusterError('The local daemon has stopped')
+
+    def _receive(self, timeout=None):
+        """Return the next list of changes, raise Empty if there is none."""
+        try:
+            if self._conn.poll(timeout or 0):
+                return self._conn.recv()
+        except (OSError, EOFError):
+            self._conn.close()
+        raise _Empty
+
+    def _handle(self):
+        """Return an object that can be waited on for changes."""
+        return self._conn
+
+    def update(self, timeout=None):
+        """Get fresh job info from the daemon.
+
+        Raises:
+            ClusterError: If the daemon has stopped.
+        """
+        got = super(DaemonQueue, self).update(timeout)
+        if self._conn.closed:
+            self.restart(True)
+        return got
+
+    def restart(self, force=False):
+        """The daemon can't be restarted from here."""
+        raise _ClusterError('The local daemon on {} has stopped'
+                            .format(self.path))
+
+    def __repr__(self):
+        """Class information."""
+        return 'Daemon' + super(DaemonQueue, self).__repr__()
+
+
+def _dumps(job):
+    """Pickle job, with its function by value if it is in __main__.
+
+    The daemon has a different __main__, so the function and arguments of
+    such jobs are pickled on their own and run by _run_pickled().
+    """
+    if getattr(job.function, '__module__', None) != '__main__':
+        try:
+            return _pickle.dumps(job)
+        except _pickle.PicklingError:
+            pass  # e.g. __module__ was changed from __main__ by a Job
+    job = _copy(job)
+    job.args     = (_serialize.dumps_call(job.function, job.args, job.kwargs,
+                                          by_value=True),)
+    job.function = _run_pickled
+    job.kwargs   = {}
+    return _pickle.dumps(job)
+
+
+def _run_pickled(payload):
+    """Run a function call pickled by _dumps()."""
+    function, args, kwargs = _serialize.loads_call(payload)
+    return function(*args, **kwargs)
+
+
+###############################################################################
+#                             Running as a Script                             #
+###############################################################################
+
+
+def main(argv=None):
+    """Run the daemon in the foreground."""
+    parser = _argparse.ArgumentParser(
+        description='Run the fyrd local job daemon in the foreground'
+    )
+    parser.add_argument('--cores', type=int, help='Cores to use, default all')
+    parser.add_argument('--mem', type=int,
+                        help='MB of memory jobs may reserve')
+    parser.add_argument('--socket', help='The socket to listen on')
+    args = parser.parse_args(argv)
+    serve(cores=args.cores, mem=args.mem, path=args.socket)
+    return 0
+
+
+if __name__ == '__main__':
+    _sys.exit(main())
@@ -13,16 +13,6 @@ from . import logme as _logme
 from . import options as _options
 from .job import Job as _Job
 
-###############################################################################
-#                       Try Import Non-Required Modules                       #
-###############################################################################
-
-try:
-    import numpy as _np
-    import pandas as _pd
-except ImportError:
-    _logme.log('Could not import numpy and pandas for helpers', 'debug')
-
 __all__ = ['parapply', 'split_file']
 
 ###############################################################################
@@ -115,6 +105,10 @@ def parapply(jobs, df, func, args=(), profile=None, applymap=False,
     Returns:
         DataFrame: A recombined DataFrame
     """
+    # numpy and pandas are slow to import, so only load them when needed
+    import numpy as _np
+    import pandas as _pd
+
     # Handle arguments
     if not isinstance(jobs, int):
         raise ValueError('Jobs argument must be an integer.')
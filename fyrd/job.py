@@ -9,15 +9,6 @@ from time import sleep as _sleep
 from datetime import datetime as _dt
 from subprocess import CalledProcessError as _CalledProcessError
 
-# Try to use dill, revert to pickle if not found
-try:
-    import dill as _pickle
-except ImportError:
-    try:
-        import cPickle as _pickle # For python2
-    except ImportError:
-        import _pickle
-
 ###############################################################################
 #                                Our functions                                #
 ###############################################################################
@@ -28,12 +19,16 @@ from . import queue   as _queue
 from . import logme   as _logme
 from . import local   as _local
 from . import options as _options
+from . import memo    as _memo
+from . import retry   as _retry
+from . import watcher as _watcher
+from . import serialize as _serialize
 from . import ClusterError as _ClusterError
 from .submission_scripts import Script   as _Script
 from .submission_scripts import Function as _Function
 
 
-__all__ = ['Job']
+__all__ = ['Job', 'JobTemplate']
 
 ###############################################################################
 #                                The Job Class                                #
@@ -62,6 +57,10 @@ class Job(object):
         runtime (timedelta):  A timedelta object containing runtime.
         files (list):         A list of script files associated with this class
         done (bool):          True if the job has completed
+        failures (list):      Why the job failed each time it was resubmitted
+                              by its retry policy, see `fyrd.retry`
+        template (JobTemplate): The resolved options shared with other jobs
+                              made from the same template
 
     Methods:
         submit(): submit the job if it is ready
@@ -94,6 +93,12 @@ class Job(object):
     Finally, if the job command is a function, this object will also contain a
     `.function` attribute, which contains the script to run the function.
 
+    In local mode function jobs are run by a worker of the local queue
+    directly (`in_process` is True), no scripts or pickle files are written
+    and the output is passed back from the worker, see `fyrd.local`. With
+    ``executor='thread'`` they run on a thread in this process instead, so
+    nothing is pickled at all.
+
     """
 
     id            = None
@@ -114,6 +119,22 @@ class Job(object):
     # Pickled output file for functions
     poutfile      = None
 
+    # Local function jobs run straight in a local queue worker
+    in_process    = False
+
+    # Result memoization
+    memo          = False
+    memo_key      = None
+    memoized      = False
+
+    # Resubmission, failures holds the reason for each retry
+    retry         = None
+    failures      = None
+
+    # The JobTemplate the options came from, and its cached header
+    template      = None
+    _header       = None
+
     # Holds queue information in torque and slurm
     queue_info    = None
 
@@ -136,11 +157,11 @@ class Job(object):
     _updating     = False
 
     # Autocleaning
-    clean_files   = _conf.get_option('jobs', 'clean_files')
-    clean_outputs = _conf.get_option('jobs', 'clean_outputs')
+    clean_files   = _conf.ConfigDefault('jobs', 'clean_files')
+    clean_outputs = _conf.ConfigDefault('jobs', 'clean_outputs')
 
     def __init__(self, command, args=None, kwargs=None, name=None, qtype=None,
-                 profile=None, **kwds):
+                 profile=None, template=None, **kwds):
         """Initialization function arguments.
 
         Args:
@@ -157,71 +178,56 @@ class Job(object):
             qtype (str):            Override the default queue type
             profile (str):          The name of a profile saved in the
                                     conf
+            template (JobTemplate): Take all options from this template
+                                    instead, only depends can be added.
 
             *All other keywords are parsed into cluster keywords by the
             options system. For available keywords see `fyrd.option_help()`*
         """
 
-        ########################
-        #  Sanitize arguments  #
-        ########################
-        kwds = _options.check_arguments(kwds)
-
-        # Override autoclean state (set in config file)
-        if 'clean_files' in kwds:
-            self.clean_files = kwds.pop('clean_files')
-        if 'clean_outputs' in kwds:
-            self.clean_outputs = kwds.pop('clean_outputs')
-
-        # Path handling
-        self.runpath = _os.path.abspath(kwds['dir'] if 'dir' in kwds else '.')
-        kwds['dir'] = self.runpath
-
-        # Set the output path
-        cpath = _conf.get_option('jobs', 'outpath')
-        if 'outpath' in kwds:
-            outpath = kwds['outpath']
-        elif cpath:
-            outpath = cpath
+        ##########################
+        #  Resolve the options  #
+        ##########################
+        if template is None:
+            template = JobTemplate(qtype=qtype, profile=profile, **kwds)
+            dependencies = template.dependencies
         else:
-            outpath = self.runpath
-        self.outpath = _os.path.abspath(outpath)
-
-        # Set the script path
-        cpath = _conf.get_option('jobs', 'scriptpath')
-        if 'scriptpath' in kwds:
-            scriptpath = kwds['scriptpath']
-        elif cpath:
-            scriptpath = cpath
-        else:
-            scriptpath = self.outpath
-        self.scriptpath = _os.path.abspath(scriptpath)
+            if qtype or profile or [i for i in kwds if i != 'depends']:
+                raise _options.OptionsError(
+                    'Only depends can be set on a job made from a template, '
+                    'make a new JobTemplate to change other options')
+            dependencies = _parse_dependencies(kwds['depends']) \
+                if kwds.get('depends') is not None else template.dependencies
+        self.template = template
+
+        # Copy the shared settings
+        if template.clean_files is not None:
+            self.clean_files = template.clean_files
+        if template.clean_outputs is not None:
+            self.clean_outputs = template.clean_outputs
+        self.runpath    = template.runpath
+        self.outpath    = template.outpath
+        self.scriptpath = template.scriptpath
+        self.qtype      = template.qtype
+        self.queue      = template.queue
+        self.modules    = template.modules
+        self.nodes      = template.nodes
+        self.cores      = template.cores
+        self.imports    = template.imports
+        self.memo       = template.memo
+        self.retry      = template.retry
+        self.failures   = []
+        self.state      = 'Not_Submitted'
+        self.dependencies = list(dependencies) \
+            if dependencies is not None else None
+        self._header    = template.header
+        self._suffix    = suffix = template.suffix
+        kwds = template.kwds.copy()
 
         # Save command
         self.command = command
         self.args    = args
 
-        # Merge in profile, this includes all args from the DEFAULT profile
-        # as well, ensuring that those are always set at a minumum.
-        profile = profile if profile else 'DEFAULT'
-        prof = _conf.get_profile(profile)
-        if not prof:
-            raise _ClusterError('No profile found for {}'.format(profile))
-        for k,v in prof.args.items():
-            if k not in kwds:
-                kwds[k] = v
-
-        # Use the default profile as a backup if any arguments missing
-        default_args = _conf.DEFAULT_PROFILES['DEFAULT']
-        default_args.update(_conf.get_profile('default').args)
-
-        # Get environment
-        if not _queue.MODE:
-            _queue.MODE = _queue.get_cluster_environment()
-        self.qtype = qtype if qtype else _queue.MODE
-        self.queue = _queue.Queue(user='self', qtype=self.qtype)
-        self.state = 'Not_Submitted'
-
         # Set name
         if not name:
             if callable(command):
@@ -246,11 +252,6 @@ class Job(object):
         name      = '{}.{}.{}'.format(name, namecnt, self.uuid)
         self.name = name
 
-        # Set modules
-        self.modules = kwds.pop('modules') if 'modules' in kwds else None
-        if self.modules:
-            self.modules = _run.opt_split(self.modules, (',', ';'))
-
         # Make sure args are a tuple or dictionary
         if args:
             if isinstance(args, str):
@@ -261,69 +262,20 @@ class Job(object):
                 except TypeError:
                     args = (args,)
 
-        # In case cores are passed as None
-        if 'nodes' not in kwds:
-            kwds['nodes'] = default_args['nodes']
-        if 'cores' not in kwds:
-            kwds['cores'] = default_args['cores']
-        self.nodes = kwds['nodes']
-        self.cores = kwds['cores']
-
         # Set output files
-        suffix = kwds.pop('suffix') if 'suffix' in kwds \
-                 else _conf.get_option('jobs', 'suffix')
-        if 'outfile' in kwds:
-            pth, fle = _os.path.split(kwds['outfile'])
-            if not pth:
-                pth = self.outpath
-            kwds['outfile'] = _os.path.join(pth, fle)
-        else:
+        if 'outfile' not in kwds:
             kwds['outfile'] = _os.path.join(
                 self.outpath, '.'.join([name, suffix, 'out']))
-        if 'errfile' in kwds:
-            pth, fle = _os.path.split(kwds['errfile'])
-            if not pth:
-                pth = self.outpath
-            kwds['errfile'] = _os.path.join(pth, fle)
-        else:
+        if 'errfile' not in kwds:
             kwds['errfile'] = _os.path.join(
                 self.outpath, '.'.join([name, suffix, 'err']))
         self.outfile = kwds['outfile']
         self.errfile = kwds['errfile']
 
-        # Check and set dependencies
-        if 'depends' in kwds:
-            dependencies = kwds.pop('depends')
-            self.dependencies = []
-            if isinstance(dependencies, 'str'):
-                if not dependencies.isdigit():
-                    raise _ClusterError('Dependencies must be number or list')
-                else:
-                    dependencies = [int(dependencies)]
-            elif isinstance(dependencies, (int, Job)):
-                dependencies = [dependencies]
-            else:
-                try:
-                    dependencies = list(dependencies)
-                except TypeError:
-                    raise _ClusterError('Dependencies must be number or list')
-            for dependency in dependencies:
-                if isinstance(dependency, str):
-                    dependency  = int(dependency)
-                if not isinstance(dependency, (int, Job)):
-                    raise _ClusterError('Dependencies must be number or list')
-                self.dependencies.append(dependency)
-
         ######################################
         #  Command and Function Preparation  #
         ######################################
 
-        # Get imports
-        if 'imports' in kwds:
-            self.imports = kwds.pop('imports')
-        else:
-            self.imports = None
-
         # Function specific initialization
         if hasattr(command, '__call__'):
             self.kind = 'function'
@@ -331,90 +283,33 @@ class Job(object):
                 self.scriptpath, '{}_func.{}.py'.format(name, suffix)
                 )
             self.poutfile = self.outfile + '.func.pickle'
-            self.function = _Function(
-                file_name=script_file, function=command, args=args,
-                kwargs=kwargs, outfile=self.poutfile, imports=self.imports
-            )
+            self.function = self._make_function(script_file, command, args,
+                                                kwargs, template.compress)
             # Collapse the command into a python call to the function script
-            executable = '#!/usr/bin/env python{}'.format(
-                _sys.version_info.major) if _conf.get_option(
-                    'jobs', 'generic_python') else _sys.executable
-
-            command = '{} {}'.format(executable, self.function.file_name)
+            command = self.function.command(template.executable)
             args = None
         else:
             self.kind = 'script'
             self.poutfile = None
 
-        # Collapse args into command
-        command = command + ' '.join(args) if args else command
-
-        #####################
-        #  Script Creation  #
-        #####################
-
-        # Build execution wrapper with modules
-        precmd  = ''
-        if self.modules:
-            for module in self.modules:
-                precmd += 'module load {}\n'.format(module)
-
-        # Create queue-dependent scripts
-        sub_script = ''
-        if self.qtype == 'slurm':
-            scrpt = _os.path.join(
-                self.scriptpath, '{}.{}.sbatch'.format(name, suffix)
-            )
-
-            # We use a separate script and a single srun command to avoid
-            # issues with multiple threads running at once
-            exec_script  = _os.path.join(self.scriptpath,
-                                         '{}.{}.script'.format(name, suffix))
-            exe_script   = _run.CMND_RUNNER_TRACK.format(
-                precmd=precmd, usedir=self.runpath, name=name, command=command)
-            # Create the exec_script Script object
-            self.exec_script = _Script(script=exe_script,
-                                       file_name=exec_script)
-
-            # Add all of the keyword arguments at once
-            precmd += _options.options_to_string(kwds, self.qtype)
-
-            ecmnd = 'srun bash {}'.format(exec_script)
-            sub_script = _run.SCRP_RUNNER.format(precmd=precmd,
-                                                 script=exec_script,
-                                                 command=ecmnd)
-
-        elif self.qtype == 'torque':
-            scrpt = _os.path.join(self.scriptpath,
-                                  '{}.cluster.qsub'.format(name))
-
-            # Add all of the keyword arguments at once
-            precmd += _options.options_to_string(kwds, self.qtype)
-
-            sub_script = _run.CMND_RUNNER_TRACK.format(
-                precmd=precmd, usedir=self.runpath, name=name, command=command)
-
-        elif self.qtype == 'local':
-            # Create the pool
-            if not _local.JQUEUE or not _local.JQUEUE.runner.is_alive():
-                threads = kwds['threads'] if 'threads' in kwds \
-                        else _local.THREADS
-                _local.JQUEUE = _local.JobQueue(cores=threads)
-
-            scrpt = _os.path.join(self.scriptpath, '{}.cluster'.format(name))
-            sub_script = _run.CMND_RUNNER_TRACK.format(
-                precmd=precmd, usedir=self.runpath, name=name, command=command)
+        # Local function jobs don't need the script or the output pickle
+        self.in_process = self._runs_in_process()
+        if self.in_process:
+            self.poutfile = None
 
-        else:
-            raise _ClusterError('Invalid queue type')
+        # Collapse args into command
+        self._command = command + ' '.join(args) if args else command
 
-        # Create the submission Script object
-        self.submission = _Script(script=sub_script,
-                                  file_name=scrpt)
+        # Create the pool
+        if self.qtype == 'local':
+            _local.get_queue(kwds['threads'] if 'threads' in kwds
+                             else _local.THREADS)
 
         # Save the keyword arguments for posterity
         self.kwargs = kwds
 
+        self._build_scripts()
+
     ####################
     #  Public Methods  #
     ####################
@@ -425,6 +320,10 @@ class Job(object):
         Args:
             overwrite (bool): Overwrite existing files, defaults to True.
         """
+        if self.in_process:
+            _logme.log('Running in a local worker, nothing to write', 'debug')
+            self.written = True
+            return
         _logme.log('Writing files, overwrite={}'.format(overwrite), 'debug')
         self.submission.write(overwrite)
         if self.exec_script:
@@ -436,6 +335,12 @@ class Job(object):
     def clean(self, delete_outputs=None, get_outputs=True):
         """Delete all scripts created by this module, if they were written.
 
+        The function and large arguments in the shared fyrd_blobs store are
+        kept for other jobs, the store is pruned by the blob_size and blob_age
+        config options when jobs are written. The runner script of a function
+        job is shared too, it is deleted with the last job of this process
+        that uses it, `basic.clean_dir()` deletes any left by other processes.
+
         Args:
             delete_outputs (bool): also delete all output and err files,
                                    but get their contents first.
@@ -458,6 +363,8 @@ class Job(object):
                 if _os.path.isfile(f):
                     _logme.log('Deleteing {}'.format(f), 'debug')
                     _os.remove(f)
+            if self.poutfile:
+                _serialize.remove(self.poutfile, pickle_file=False)
 
     def submit(self, wait_on_max_queue=True):
         """Submit this job.
@@ -477,16 +384,13 @@ class Job(object):
             _logme.log('Not submitting, already submitted.', 'warn')
             return self
 
+        if self.memo and self.kind == 'function' and self._load_memo():
+            return self
+
         if not self.written:
             self.write()
 
-        dependencies = []
-        if self.dependencies:
-            for depend in self.dependencies:
-                if isinstance(depend, Job):
-                    dependencies.append(int(depend.id))
-                else:
-                    dependencies.append(int(depend))
+        dependencies = self._dependency_ids()
 
         self.update()
 
@@ -496,25 +400,20 @@ class Job(object):
         if self.qtype == 'local':
             # Normal mode dependency tracking uses only integer job numbers
             _logme.log('Submitting to local', 'debug')
-            command = 'bash {}'.format(self.submission.file_name)
-            fileargs  = dict(stdout=self.outfile,
-                             stderr=self.errfile)
 
             # Make sure the global job pool exists
-            if not _local.JQUEUE or not _local.JQUEUE.runner.is_alive():
-                _local.JQUEUE = _local.JobQueue(cores=_local.THREADS)
-            self.id = _local.JQUEUE.add(_run.cmd, args=(command,),
-                                        kwargs=fileargs,
-                                        dependencies=dependencies,
-                                        cores=self.cores)
+            _local.get_queue(_local.THREADS)
+            local_job = self.local_job(dependencies)
+            local_job.id = _local.JQUEUE.reserve(1)[0]
+            self.id = _local.JQUEUE.add_many([local_job])[0]
             self.submitted = True
             self.state = 'submitted'
 
         elif self.qtype == 'slurm':
             _logme.log('Submitting to slurm', 'debug')
-            if self.dependencies:
+            if dependencies:
                 depends = '--dependency=afterok:{}'.format(
-                    ':'.join(dependencies))
+                    ':'.join([str(d) for d in dependencies]))
                 args = ['sbatch', depends, self.submission.file_name]
             else:
                 args = ['sbatch', self.submission.file_name]
@@ -524,7 +423,7 @@ class Job(object):
             if code == 0:
                 self.id = int(stdout.split(' ')[-1])
             else:
-                _logme.log('sbatch failed with code {}\n'.format(code),
+                _logme.log('sbatch failed with code {}\n'.format(code) +
                            'stdout: {}\nstderr: {}'.format(stdout, stderr),
                            'critical')
                 raise _CalledProcessError(code, args, stdout, stderr)
@@ -533,9 +432,9 @@ class Job(object):
 
         elif self.qtype == 'torque':
             _logme.log('Submitting to torque', 'debug')
-            if self.dependencies:
+            if dependencies:
                 depends = '-W depend={}'.format(
-                    ','.join(['afterok:' + d for d in dependencies]))
+                    ','.join(['afterok:' + str(d) for d in dependencies]))
                 args = ['qsub', depends, self.submission.file_name]
             else:
                 args = ['qsub', self.submission.file_name]
@@ -565,10 +464,52 @@ class Job(object):
 
         return self
 
+    def local_job(self, dependencies=None):
+        """Return a local.Job object that will run this job locally.
+
+        Args:
+            dependencies (list): Local job numbers to depend on.
+        """
+        if self.memo and self.kind == 'function' and not self.memo_key:
+            self._set_memo_key()
+        sched = dict(cores=self.cores,
+                     priority=self.kwargs.get('priority', 0),
+                     time=self.kwargs.get('time'),
+                     mem=self.kwargs.get('mem'),
+                     executor=self.kwargs.get('executor', 'process'))
+        if self.in_process and sched['executor'] == 'thread':
+            fileargs = dict(outfile=self.outfile, errfile=self.errfile,
+                            name=self.name)
+            return _local.Job(_local.run_thread,
+                              args=(self.function.function,
+                                    self.function.args, self.function.kwargs),
+                              kwargs=fileargs, depends=dependencies, **sched)
+        if self.in_process:
+            # A local daemon can't load functions from our __main__
+            shared = getattr(_local.JQUEUE, 'shared', False)
+            payload = _serialize.dumps_call(
+                self.function.function, self.function.args,
+                self.function.kwargs, by_value=shared
+            )
+            fileargs = dict(outfile=self.outfile, errfile=self.errfile,
+                            runpath=self.runpath, name=self.name)
+            return _local.Job(_local.run_function, args=(payload,),
+                              kwargs=fileargs, depends=dependencies, **sched)
+        command  = 'bash {}'.format(self.submission.file_name)
+        fileargs = dict(stdout=self.outfile, stderr=self.errfile)
+        return _local.Job(_run.cmd, args=(command,), kwargs=fileargs,
+                          depends=dependencies, **sched)
+
     def resubmit(self):
-        """Attempt to auto resubmit, deletes prior files."""
-        self.clean(delete_outputs=True)
-        self.state = 'Not_Submitted'
+        """Attempt to auto resubmit, deletes prior files and outputs."""
+        self.clean(delete_outputs=True, get_outputs=False)
+        self.id         = None
+        self.queue_info = None
+        self.state      = 'Not_Submitted'
+        self.submitted  = False
+        self.start = self.end = None
+        self._got_out = self._got_stdout = self._got_stderr = False
+        self._got_exitcode = self._got_times = False
         self.write()
         return self.submit()
 
@@ -583,35 +524,30 @@ class Job(object):
                 _logme.log('Cannot wait for result as job has not been ' +
                            'submitted', 'warn')
                 return False
-        _sleep(0.1)
+        if self.qtype != 'local':
+            _sleep(0.1)
         self.update()
         if self.done:
             return True
         _logme.log('Waiting for self {}'.format(self.name), 'debug')
-        if self.queue.wait(self) is not True:
+        while True:
+            success = self.queue.wait(self) is True
+            # Jobs can leave the queue as completed even if they ran out of
+            # resources, so check with the retry policy either way
+            if not self._retry():
+                break
+        if not success:
             return False
         # Block for up to file_block_time for output files to be copied back
         btme = _conf.get_option('jobs', 'file_block_time')
-        #  btme = 2
         start = _dt.now()
-        lgd = False
-        while True:
-            if not lgd:
-                _logme.log('Checking for output files', 'debug')
-                lgd = True
-            count = 0
-            for i in self.outfiles:
-                if _os.path.isfile(i):
-                    count += 1
-            if count == len(self.outfiles):
-                _logme.log('All output files found in {} seconds'
-                           .format(count), 'debug')
-                break
-            _sleep(0.1)
-            if (_dt.now() - start).seconds > btme:
-                _logme.log('Job completed but files have not appeared for ' +
-                           '>{} seconds'.format(btme))
-                return False
+        _logme.log('Checking for output files', 'debug')
+        if not _watcher.wait_for_files(self.outfiles, timeout=btme):
+            _logme.log('Job completed but files have not appeared for ' +
+                       '>{} seconds'.format(btme))
+            return False
+        _logme.log('All output files found in {} seconds'
+                   .format((_dt.now() - start).total_seconds()), 'debug')
         self.update()
         return True
 
@@ -662,7 +598,8 @@ class Job(object):
             raise out
         return out
 
-    def get_output(self, save=True, delete_file=None, update=True):
+    def get_output(self, save=True, delete_file=None, update=True,
+                   mmap=False):
         """Get output of function or script.
 
         This is the same as stdout for a script, or the function output for
@@ -671,12 +608,20 @@ class Job(object):
         By default, output file is kept unless delete_file is True or
         self.auto_delete is True.
 
+        Large buffers in function outputs (e.g. numpy arrays or the blocks of a
+        DataFrame) are written to a sidecar file by the runner, if mmap is True
+        that file is memory mapped read-only and the arrays in the output are
+        backed by it with zero copies, which allows slicing huge results
+        without reading them into memory.
+
         Args:
             save (bool):        Save the output to self.out, default True.
                                 Would be a good idea to set to False if the
                                 output is huge.
             delete_file (bool): Delete the output file when getting
             update (bool):      Update job info from queue first.
+            mmap (bool):        Memory map large buffers read-only instead of
+                                reading them, only used for functions.
 
         Returns:
             The output of the script or function. Always a string if script.
@@ -699,14 +644,18 @@ class Job(object):
             _logme.log('Cannot get pickled output before job completes',
                        'warn')
             return None
+        if self.in_process:
+            return self._get_local_output(save)
         _logme.log('Getting output from {}'.format(self.poutfile), 'debug')
         if _os.path.isfile(self.poutfile):
-            with open(self.poutfile, 'rb') as fin:
-                out = _pickle.load(fin)
+            out = _serialize.load(self.poutfile, mmap=mmap)
+            if self.memo_key and not isinstance(out, Exception):
+                _memo.get_store().store(self.memo_key, self.poutfile)
             if delete_file is True or self.auto_delete is True:
+                # Mapped buffers remain valid after the file is unlinked
                 _logme.log('Deleting {}'.format(self.poutfile),
                            'debug')
-                _os.remove(self.poutfile)
+                _serialize.remove(self.poutfile)
             if save:
                 self._out = out
                 self._got_out = True
@@ -895,13 +844,40 @@ class Job(object):
         self._got_exitcode = True
         return code
 
-    def update(self):
-        """Update status from the queue."""
+    def update(self, max_age=None):
+        """Update status from the queue.
+
+        The state comes from a queue snapshot shared by all jobs, the server is
+        only queried if the snapshot is older than max_age seconds.
+
+        Args:
+            max_age (float): Defaults to the queue_update config option.
+        """
         if not self._updating:
-            self._update()
+            self._update(max_age)
         else:
             _logme.log('Already updating, aborting.', 'debug')
 
+    def poll(self):
+        """Return True if the job is complete, never blocks for long.
+
+        Uses the shared queue snapshot, which is refreshed at most once every
+        queue_update seconds for all jobs together, so this is cheap to call
+        in a loop.
+        """
+        if self.state != 'completed' and self.submitted:
+            self.update()
+        return self.state == 'completed'
+
+    def refresh(self):
+        """Force an update of the job state from the server.
+
+        Returns:
+            Job: self
+        """
+        self.update(max_age=0)
+        return self
+
     def update_queue_info(self):
         """Set queue_info from the queue even if done."""
         _logme.log('Updating queue_info', 'debug')
@@ -956,32 +932,195 @@ class Job(object):
     def done(self):
         """Check if completed or not.
 
-        Updates the Job and Queue.
+        Updates the Job from the shared queue snapshot, see `poll()`.
 
         Returns:
             Bool: True if complete, False otherwise.
         """
-        # We have the same statement twice to try and avoid updating.
-        if self.state == 'completed':
-            return True
-        if not self._updating:
-            self.update()
-            if self.state == 'completed':
-                return True
-        return False
+        return self.poll()
 
     ###############
     #  Internals  #
     ###############
 
-    def _update(self):
+    def _make_function(self, script_file, function, args, kwargs,
+                       compress):
+        """Return the Function script that runs function."""
+        return _Function(
+            file_name=script_file, function=function, args=args,
+            kwargs=kwargs, outfile=self.poutfile, imports=self.imports,
+            compress=compress, suffix=self._suffix,
+            blob_dir=_os.path.join(self.scriptpath, _serialize.BLOB_DIR)
+        )
+
+    def _runs_in_process(self):
+        """Return True if the job can run directly in a local queue worker.
+
+        Module loading needs the job script, so those jobs still use it.
+        """
+        return self.kind == 'function' and self.qtype == 'local' \
+            and not self.modules
+
+    def _get_local_output(self, save=True):
+        """Get the output of an in_process job from the local queue."""
+        _logme.log('Getting output from the local queue', 'debug')
+        local_job = _local.JQUEUE[self.id] if _local.JQUEUE else None
+        if local_job is None:
+            raise _ClusterError('Job {} ({}) is no longer in the local queue'
+                                .format(self.name, self.id))
+        out = local_job.out
+        if local_job.exitcode and not isinstance(out, Exception):
+            _logme.log('Job {} ({}) exited with code {}'.format(
+                self.name, self.id, local_job.exitcode), 'error')
+        if self.memo_key and local_job.exitcode == 0 \
+                and not isinstance(out, Exception):
+            _memo.get_store().store_result(self.memo_key, out)
+        if save:
+            self._out = out
+            self._got_out = True
+        return out
+
+    def _options_string(self):
+        """Return the scheduler options for the header of the script."""
+        if self._header is None:
+            return _options.options_to_string(self.kwargs, self.qtype)
+        return self.template.options_string(self.kwargs)
+
+    def _build_scripts(self):
+        """Create the submission scripts from the command and self.kwargs."""
+        name    = self.name
+        suffix  = self._suffix
+        command = self._command
+
+        # Build execution wrapper with modules
+        precmd  = ''
+        if self.modules:
+            for module in self.modules:
+                precmd += 'module load {}\n'.format(module)
+
+        # Create queue-dependent scripts
+        sub_script = ''
+        if self.qtype == 'slurm':
+            scrpt = _os.path.join(
+                self.scriptpath, '{}.{}.sbatch'.format(name, suffix)
+            )
+
+            # We use a separate script and a single srun command to avoid
+            # issues with multiple threads running at once
+            exec_script  = _os.path.join(self.scriptpath,
+                                         '{}.{}.script'.format(name, suffix))
+            exe_script   = _run.CMND_RUNNER_TRACK.format(
+                precmd=precmd, usedir=self.runpath, name=name, command=command)
+            # Create the exec_script Script object
+            self.exec_script = _Script(script=exe_script,
+                                       file_name=exec_script)
+
+            # Add all of the keyword arguments at once
+            precmd += self._options_string()
+
+            ecmnd = 'srun bash {}'.format(exec_script)
+            sub_script = _run.SCRP_RUNNER.format(precmd=precmd,
+                                                 script=exec_script,
+                                                 command=ecmnd)
+
+        elif self.qtype == 'torque':
+            scrpt = _os.path.join(self.scriptpath,
+                                  '{}.cluster.qsub'.format(name))
+
+            # Add all of the keyword arguments at once
+            precmd += self._options_string()
+
+            sub_script = _run.CMND_RUNNER_TRACK.format(
+                precmd=precmd, usedir=self.runpath, name=name, command=command)
+
+        elif self.qtype == 'local':
+            scrpt = _os.path.join(self.scriptpath, '{}.cluster'.format(name))
+            sub_script = _run.CMND_RUNNER_TRACK.format(
+                precmd=precmd, usedir=self.runpath, name=name, command=command)
+
+        else:
+            raise _ClusterError('Invalid queue type')
+
+        # Create the submission Script object
+        self.submission = _Script(script=sub_script,
+                                  file_name=scrpt)
+
+    def _retry(self):
+        """Resubmit the job if it failed in a way the retry policy covers.
+
+        Returns:
+            bool: True if the job was resubmitted.
+        """
+        if not self.retry.retries:
+            return False
+        self.update_queue_info()
+        reason = _retry.failure_reason(self)
+        if not self.retry.can_retry(reason, len(self.failures)):
+            return False
+        self.failures.append(reason)
+        delay = self.retry.delay(len(self.failures))
+        _logme.log('Job {} ({}) failed with {}, resubmitting in {} seconds '
+                   '(retry {}/{})'.format(self.name, self.id, reason, delay,
+                                          len(self.failures),
+                                          self.retry.retries), 'warn')
+        self.kwargs  = self.retry.escalate(self.kwargs, reason)
+        self._header = None
+        self._build_scripts()
+        _sleep(delay)
+        self.resubmit()
+        return True
+
+    def _dependency_ids(self):
+        """Return the job IDs of the dependencies that have not completed.
+
+        Dependencies that completed, e.g. from the result store, have nothing
+        to wait for and may not even have an ID.
+        """
+        dependencies = []
+        for depend in self.dependencies or []:
+            if isinstance(depend, Job):
+                if depend.memoized or depend.state == 'completed':
+                    continue
+                dependencies.append(int(depend.id))
+            else:
+                dependencies.append(int(depend))
+        return dependencies
+
+    def _set_memo_key(self):
+        """Set memo_key from the function and its arguments."""
+        self.memo_key = _memo.job_key(self.function.function,
+                                      self.function.args,
+                                      self.function.kwargs)
+
+    def _load_memo(self):
+        """Complete the job from the result store if possible.
+
+        Returns:
+            bool: True if a stored result was found.
+        """
+        self._set_memo_key()
+        found, out = _memo.get_store().lookup(self.memo_key)
+        if not found:
+            return False
+        _logme.log('Using stored result for {}'.format(self.name), 'info')
+        self.memoized  = True
+        self.submitted = True
+        self.state     = 'completed'
+        self.start     = self.end = _dt.now()
+        self._out,    self._got_out      = out, True
+        self._stdout, self._got_stdout   = '', True
+        self._stderr, self._got_stderr   = '', True
+        self._exitcode, self._got_exitcode = 0, True
+        self._got_times = True
+        return True
+
+    def _update(self, max_age=None):
         """Update status from the queue."""
+        if self.state == 'completed' or not self.submitted:
+            return
         _logme.log('Updating job.', 'debug')
         self._updating = True
-        if self.done or not self.submitted:
-            self._updating = False
-            return
-        self.queue.update()
+        self.queue.update(max_age)
         if self.id:
             queue_info = self.queue[self.id]
             if queue_info:
@@ -1049,3 +1188,209 @@ class Job(object):
             id1 = 'NA'
         return "Job: {name} ID: {id}, state: {state}".format(
             name=self.name, id=id1, state=state)
+
+
+###############################################################################
+#                              The Job Template                               #
+###############################################################################
+
+
+class JobTemplate(object):
+
+    """Options resolved once and shared by many similar jobs.
+
+    Creating a Job reads the config file several times, merges the profile,
+    checks every option and builds the #SBATCH/#PBS header. A template does
+    all of that once, `make()` then only fills in the command, the name, and
+    the output files of each job::
+
+        template = JobTemplate(profile='small', mem='2GB')
+        jobs = [template.make(analyze, (i,)).submit() for i in range(10000)]
+
+    Attributes:
+        kwds (dict):    The resolved keyword arguments.
+        header (str):   The options part of the submission script header,
+                        without the output files, None in local mode.
+    """
+
+    # Options that differ for every job and are left out of the header
+    PER_JOB = ('outfile', 'errfile')
+
+    def __init__(self, qtype=None, profile=None, **kwds):
+        """Resolve the options.
+
+        Args:
+            qtype (str):   Override the default queue type
+            profile (str): The name of a profile saved in the conf
+
+            *All other keywords are parsed into cluster keywords by the
+            options system. For available keywords see `fyrd.option_help()`*
+        """
+        kwds = _options.check_arguments(kwds)
+
+        # Override autoclean state (set in config file)
+        self.clean_files   = kwds.pop('clean_files', None)
+        self.clean_outputs = kwds.pop('clean_outputs', None)
+
+        # Path handling
+        self.runpath = _os.path.abspath(kwds['dir'] if 'dir' in kwds else '.')
+        kwds['dir'] = self.runpath
+
+        # Set the output path
+        cpath = _conf.get_option('jobs', 'outpath')
+        if 'outpath' in kwds:
+            outpath = kwds['outpath']
+        elif cpath:
+            outpath = cpath
+        else:
+            outpath = self.runpath
+        self.outpath = _os.path.abspath(outpath)
+
+        # Set the script path
+        cpath = _conf.get_option('jobs', 'scriptpath')
+        if 'scriptpath' in kwds:
+            scriptpath = kwds['scriptpath']
+        elif cpath:
+            scriptpath = cpath
+        else:
+            scriptpath = self.outpath
+        self.scriptpath = _os.path.abspath(scriptpath)
+
+        # Merge in profile, this includes all args from the DEFAULT profile
+        # as well, ensuring that those are always set at a minumum.
+        profile = profile if profile else 'DEFAULT'
+        prof = _conf.get_profile(profile)
+        if not prof:
+            raise _ClusterError('No profile found for {}'.format(profile))
+        for k,v in prof.args.items():
+            if k not in kwds:
+                kwds[k] = v
+
+        # Use the default profile as a backup if any arguments missing
+        default_args = _conf.DEFAULT_PROFILES['DEFAULT']
+        default_args.update(_conf.get_profile('default').args)
+
+        # Get environment
+        if not _queue.MODE:
+            _queue.MODE = _queue.get_cluster_environment()
+        self.qtype = qtype if qtype else _queue.MODE
+        self.queue = _queue.get_queue(qtype=self.qtype)
+
+        # Set modules
+        self.modules = kwds.pop('modules') if 'modules' in kwds else None
+        if self.modules:
+            self.modules = _run.opt_split(self.modules, (',', ';'))
+
+        # In case cores are passed as None
+        if 'nodes' not in kwds:
+            kwds['nodes'] = default_args['nodes']
+        if 'cores' not in kwds:
+            kwds['cores'] = default_args['cores']
+        self.nodes = kwds['nodes']
+        self.cores = kwds['cores']
+
+        # Set output files, file names without a path go in outpath
+        self.suffix = kwds.pop('suffix') if 'suffix' in kwds \
+            else _conf.get_option('jobs', 'suffix')
+        for outfile in self.PER_JOB:
+            if outfile in kwds:
+                pth, fle = _os.path.split(kwds[outfile])
+                if not pth:
+                    pth = self.outpath
+                kwds[outfile] = _os.path.join(pth, fle)
+
+        # Check and set dependencies
+        self.dependencies = _parse_dependencies(kwds.pop('depends')) \
+            if 'depends' in kwds else None
+
+        # Get imports
+        self.imports = kwds.pop('imports') if 'imports' in kwds else None
+
+        # Compression of function pickles
+        self.compress = kwds.pop('compress') if 'compress' in kwds else None
+
+        # Reuse stored results of identical function calls
+        self.memo = kwds.pop('memo') if 'memo' in kwds else False
+
+        # Resubmission on resource failures
+        self.retry = _retry.RetryPolicy(
+            retries=kwds.pop('retries', 0),
+            scale=kwds.pop('retry_scale', None),
+            backoff=kwds.pop('retry_backoff', None)
+        )
+
+        # The python used to run function scripts
+        self.executable = '#!/usr/bin/env python{}'.format(
+            _sys.version_info.major) if _conf.get_option(
+                'jobs', 'generic_python') else _sys.executable
+
+        # Build the header once, filepath moves the per-job output files so
+        # it needs the full options_to_string every time
+        if self.qtype in ('slurm', 'torque') and 'filepath' not in kwds:
+            self.header = _options.options_to_string(
+                {k: v for k, v in kwds.items() if k not in self.PER_JOB},
+                self.qtype
+            )
+        else:
+            self.header = None
+
+        self.kwds = kwds
+
+    def make(self, command, args=None, kwargs=None, name=None, depends=None):
+        """Create a Job from this template.
+
+        Args:
+            command (function/str): The command or function to execute.
+            args (tuple/dict):      Optional arguments to add to command.
+            kwargs (dict):          Optional keyword arguments for functions.
+            name (str):             Optional name of the job.
+            depends (list):         Dependencies, replacing any in the
+                                    template.
+
+        Returns:
+            Job: A new, unsubmitted job.
+        """
+        return Job(command, args=args, kwargs=kwargs, name=name,
+                   template=self, depends=depends)
+
+    def options_string(self, kwds):
+        """Return the full header for a job with kwds from this template."""
+        lines = [self.header] if self.header else []
+        for option in self.PER_JOB:
+            if option in kwds:
+                lines.append(_options.option_to_string(option, kwds[option],
+                                                       self.qtype))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        """Queue type and options."""
+        return 'JobTemplate<{}:{}>'.format(self.qtype, self.kwds)
+
+
+###############################################################################
+#                              Helper Functions                               #
+###############################################################################
+
+
+def _parse_dependencies(dependencies):
+    """Return a list of job ids and Jobs from a depends argument."""
+    if isinstance(dependencies, str):
+        if not dependencies.isdigit():
+            raise _ClusterError('Dependencies must be number or list')
+        else:
+            dependencies = [int(dependencies)]
+    elif isinstance(dependencies, (int, Job)):
+        dependencies = [dependencies]
+    else:
+        try:
+            dependencies = list(dependencies)
+        except TypeError:
+            raise _ClusterError('Dependencies must be number or list')
+    parsed = []
+    for dependency in dependencies:
+        if isinstance(dependency, str):
+            dependency  = int(dependency)
+        if not isinstance(dependency, (int, Job)):
+            raise _ClusterError('Dependencies must be number or list')
+        parsed.append(dependency)
+    return parsed
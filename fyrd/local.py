@@ -2,31 +2,105 @@
 """
 Manage job dependency tracking with multiprocessing.
 
-Runs jobs with a multiprocessing.Pool, but manages dependency using an
-additional Process that loops through all submitted jobs and checks
-dependencies before running.
+Runs jobs with multiprocessing, but manages dependency using an additional
+Process that checks dependencies before running each job. That process sleeps
+until a job is submitted or a running job exits, so there is no polling delay.
 
 The JobQueue class works as the queue and functions in a similar, but much more
 basic, way as torque or slurm. It manages jobs by forking an instance of the
-job_runner function and keeping it alive. The multiprocessing.Queue class is
-then used to pass job information contained in the Job class back and forth
-between the JobQueue class running in the main process and the job_runner()
-fork running as a separate thread.
-
-The actual job management is done by job_runner() and uses
-multiprocessing.Process objects and not the Pool object.  This allows for more
-careful management and it also allows exit codes to be captured.
+job_runner function and keeping it alive. Jobs are sent to job_runner() over a
+multiprocessing.Queue, and job_runner() sends back only what changed, as
+(seq, jobno, field, value) tuples, which JobQueue applies to its own Job
+objects. The sequence numbers show if any update was missed.
+
+The actual job management is done by job_runner(), which sends every job to
+one of a pool of persistent worker processes (at most one per core), so a job
+does not pay for a new process. A job that asks for several cores counts as
+that many against the pool. Workers are replaced after `max_tasks` jobs to
+contain leaks, or when a job kills them, and exit codes and return values are
+captured just as for a process per job.
+
+Job numbers are handed out from blocks claimed in a small state file
+(`STATE_FILE`), so the file is only rewritten once per block and on exit, not
+for every job.
+
+Jobs added with ``executor='thread'`` are scheduled by the runner in the same
+way, but when the runner starts one the JobQueue runs it on a thread pool in
+this process, and only reports the exit code back. They start without a
+process switch and share memory with the caller, nothing is pickled, which
+suits jobs that are I/O bound or release the GIL.
+
+The runner appends every job it receives and every change it makes to a
+journal file (see `Journal`) before sending the changes, in a temporary
+directory only the user can open (`user_dir()`). Once the journal has grown
+more than the jobs in it, it is rewritten with only the jobs, and jobs that
+ended lose their function, arguments and output. If the runner dies
+and the JobQueue restarts it, the new runner replays the journal. Jobs that
+finished are not run again, thread jobs that are still running are adopted,
+and the rest are scheduled again. Workers of the old runner that are still
+running a job are killed first, as their results could not be collected.
+
+If a local daemon is running (see `fyrd.daemon`), get_queue() returns a
+DaemonQueue instead, which sends jobs to the daemon's runner, so that all
+Python processes of a user share one set of cores, one memory budget and one
+scheduler.
+
+Each job is pinned to its own set of CPUs, as many as it asked cores for,
+all on one NUMA node where possible (see `CPUAllocator`), so jobs don't
+move between cores and thrash their caches. The CPUs are freed when the job
+ends. Set the jobqueue `affinity` config option to False to let jobs float.
+
+Jobs also reserve the memory given with the `mem` option, and are only started
+while the reservations fit in the jobqueue `mem` config limit, or in
+MemAvailable from /proc/meminfo if that is 0. If `mem_sample` is set, the RSS
+of running jobs is read from /proc every that many seconds, and a job using
+more than it asked for reserves what it actually uses.
+
+Function jobs (`fyrd.Job` with a function in local mode) are run by
+run_function() straight in a worker, from the pickled function and arguments,
+without writing a runner script or pickle files. The output is sent back as a
+`Result`, and any large buffers in it (e.g. numpy arrays) are passed through
+one block of shared memory instead of being pickled through the pipes.
 """
 import os
 import sys
 import atexit
+import pickle
 import signal
 import multiprocessing as mp
 from multiprocessing import cpu_count as _cnt
-from subprocess import check_output, CalledProcessError
-from time import sleep
+import threading
+from copy import copy as _copy
+from contextlib import contextmanager
+from glob import glob as _glob
+from heapq import heappush, heappop, heapify
+from datetime import datetime as _dt
+from itertools import count as _count
+from time import sleep, time
+from tempfile import gettempdir as _tempdir
+try:
+    from queue import Empty
+except ImportError:  # python2
+    from Queue import Empty
+try:
+    from multiprocessing.connection import wait as _mp_wait
+except ImportError:  # python2
+    _mp_wait = None
+try:
+    from multiprocessing import shared_memory as _shared_memory
+except ImportError:  # python < 3.8
+    _shared_memory = None
+try:
+    from concurrent.futures import ThreadPoolExecutor as _ThreadPool
+except ImportError:  # python2
+    _ThreadPool = None
+try:
+    import fcntl as _fcntl
+except ImportError:  # Windows
+    _fcntl = None
 
 from . import run
+from . import serialize
 
 # Get defaults
 from . import conf
@@ -48,14 +122,122 @@ __all__ = ['JobQueue']
 
 THREADS  = _cnt()
 
-# Reset broken multithreading
-# Some of the numpy C libraries can break multithreading, this command
-# fixes the issue.
-try:
-    check_output("taskset -p 0xff %d >/dev/null 2>/dev/null" % os.getpid(),
-                 shell=True)
-except CalledProcessError:
-    pass  # This doesn't work on Macs or Windows
+# Seconds to wait for the runner to acknowledge a submission
+ACK_TIMEOUT = 60
+
+# A job in one of these states will not change again
+END_STATES = ('done', 'cancelled')
+
+# Holds the last local job number handed out, see JobNumbers
+STATE_FILE = os.path.join(conf.CONFIG_PATH, 'jobqueue_state')
+
+# Runner journals in user_dir(), formatted with the process ID and a count,
+# see Journal. Kept on local disk, the process IDs only make sense here.
+JOURNAL_FILE = 'jobqueue.{}.{}.journal'
+_JOURNALS = _count(1)
+
+# Bytes appended to a journal before it is compacted, or more if the last
+# compacted journal was bigger
+JOURNAL_COMPACT = 1024*1024
+
+# Set by reset_affinity(), done before the first JobQueue starts
+_AFFINITY_RESET = False
+
+
+def user_dir(create=True):
+    """Return a directory in the temp folder only this user can access.
+
+    It holds the local runner journals, the daemon socket and the blobs
+    cached by function jobs (see `run.FUNC_RUNNER`), which are pickles of
+    jobs, so it must not be readable or writable by others.
+
+    Args:
+        create (bool): Create the directory if it does not exist.
+
+    Raises:
+        ClusterError: If the directory is accessible to other users.
+    """
+    directory = os.path.join(_tempdir(), 'fyrd-{}'.format(os.getuid()))
+    if create and not os.path.isdir(directory):
+        try:
+            os.mkdir(directory, 0o700)
+        except OSError:
+            pass  # Created at the same time by another process
+    if os.path.isdir(directory) or os.path.islink(directory):
+        stat = os.lstat(directory)
+        if stat.st_uid != os.getuid() or stat.st_mode & 0o077 \
+                or os.path.islink(directory):
+            raise ClusterError('{} must be owned by and only accessible to '
+                               'this user'.format(directory))
+    return directory
+
+
+def reset_affinity():
+    """Reset broken multithreading, once per process.
+
+    Some of the numpy C libraries can break multithreading by pinning the
+    process to one core, this lets the process use every online CPU again.
+    """
+    global _AFFINITY_RESET
+    if _AFFINITY_RESET or not hasattr(os, 'sched_setaffinity'):
+        return  # This doesn't work on Macs, Windows, or python2
+    _AFFINITY_RESET = True
+    try:
+        os.sched_setaffinity(0, _online_cpus())
+    except OSError:
+        pass  # e.g. none of the CPUs are in our cpuset
+
+
+def _online_cpus():
+    """Return the set of online CPUs."""
+    try:
+        with open('/sys/devices/system/cpu/online') as fin:
+            return _parse_cpus(fin.read())
+    except (IOError, OSError, ValueError):
+        return set(range(THREADS))
+
+
+def _parse_cpus(cpulist):
+    """Return the set of CPUs in a Linux CPU list, e.g. '0-3,8-11'."""
+    cpus = set()
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def _set_affinity(cpus):
+    """Pin this process (or thread on Linux) to cpus, if supported."""
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError as err:
+            logme.log('Could not set CPU affinity to {}: {}'
+                      .format(cpus, err), 'warn')
+
+
+def get_queue(cores=None):
+    """Return the local queue of this process, JQUEUE, starting it if needed.
+
+    If a local daemon is running and the jobqueue daemon config option is set,
+    a DaemonQueue connected to it is used, otherwise a JobQueue.
+
+    Args:
+        cores (int): Number of cores for a new JobQueue, defaults to all.
+    """
+    global JQUEUE
+    if JQUEUE is None or not JQUEUE.runner.is_alive():
+        queue = None
+        if conf.get_option('jobqueue', 'daemon', True):
+            from . import daemon
+            queue = daemon.connect()
+        JQUEUE = queue if queue is not None else JobQueue(cores=cores)
+    return JQUEUE
 
 
 ###############################################################################
@@ -67,54 +249,168 @@ class JobQueue(object):
 
     """Monitor and submit multiprocessing.Pool jobs with dependencies."""
 
-    def __init__(self, cores=None):
-        """Spawn a job_runner process to interact with."""
+    # True if the jobs are run by a separate process, see fyrd.daemon
+    shared = False
+
+    def __init__(self, cores=None, max_tasks=None, mem=None,
+                 mem_sample=None, affinity=None, journal=None):
+        """Spawn a job_runner process to interact with.
+
+        Args:
+            cores (int):      Number of cores to use, defaults to all.
+            max_tasks (int):  Replace each worker process after it has run
+                              this many jobs, 0 to never replace them, default
+                              from the jobqueue max_tasks config option.
+            mem (int):        MB of memory jobs may reserve, 0 to use
+                              MemAvailable, default from the jobqueue config.
+            mem_sample (int): Seconds between checks of the memory use of
+                              running jobs, 0 for never, default from the
+                              jobqueue config.
+            affinity (bool):  Pin each job to its own CPUs, default from the
+                              jobqueue config.
+            journal (bool):   Keep a journal so that a restarted runner can
+                              resume, default from the jobqueue config.
+        """
+        reset_affinity()
+        self._init_jobs(cores)
         self._jobqueue = mp.Queue()
         self._outputs  = mp.Queue()
-        self.jobno     = int(conf.get_option('jobqueue', 'jobno', '1'))
-        self.cores     = int(cores) if cores else THREADS
+        self.max_tasks = int(max_tasks) if max_tasks is not None else \
+            int(conf.get_option('jobqueue', 'max_tasks', '0'))
+        self.mem       = int(mem) if mem is not None else \
+            int(conf.get_option('jobqueue', 'mem', '0'))
+        self.mem_sample = float(mem_sample) if mem_sample is not None else \
+            float(conf.get_option('jobqueue', 'mem_sample', '0'))
+        self.affinity  = bool(affinity) if affinity is not None else \
+            conf.get_option('jobqueue', 'affinity', True)
+        if journal is None:
+            journal = conf.get_option('jobqueue', 'journal', True)
+        self.journal   = None
+        if journal:
+            Journal.clean()
+            self.journal = os.path.join(
+                user_dir(), JOURNAL_FILE.format(os.getpid(), next(_JOURNALS))
+            )
+            if os.path.isfile(self.journal):
+                os.remove(self.journal)  # Of a process with the same PID
         self.runner    = mp.Process(target=job_runner,
                                     args=(self._jobqueue,
                                           self._outputs,
                                           self.cores,
-                                          self.jobnumber),
+                                          self.jobno,
+                                          self.max_tasks,
+                                          self.mem,
+                                          self.mem_sample,
+                                          self.affinity,
+                                          self.journal),
                                     name='Runner')
         self.runner.start()
         self.pid = self.runner.pid
         assert self.runner.is_alive()
-        self.jobs = {}
 
         def terminate():
             """Kill the queue runner."""
             try:
                 self.runner.terminate()
+                # Give the runner a moment to stop its workers
+                self.runner.join(1)
                 self._jobqueue.close()
                 self._outputs.close()
             except AttributeError:
                 pass
             if run.check_pid(self.runner.pid):
                 os.kill(self.runner.pid, signal.SIGKILL)
+            self.numbers.close()
+            if self.journal and os.path.isfile(self.journal):
+                os.remove(self.journal)
 
         # Call terminate when we exit
         atexit.register(terminate)
 
-    def update(self):
-        """Get fresh job info from the runner."""
-        sleep(0.5)  # This allows the queue time to flush
+    def _init_jobs(self, cores):
+        """Set up job numbering and tracking."""
+        self._lock     = threading.RLock()
+        self.numbers   = JobNumbers()
+        self.jobno     = self.numbers.last
+        self.cores     = int(cores) if cores else THREADS
+        self.jobs      = {}
+        self._seq      = 0      # The last change applied
+        self._pending  = set()  # Thread jobs that have not ended
+        self._started  = set()  # Thread jobs started here
+        self._exits    = {}     # {job_no: exitcode} of thread jobs not done
+        self._listener = None   # Thread that starts thread jobs
+        self._pool     = None   # Runs thread jobs
+
+    def _send(self, item):
+        """Send a Job, or (job_no, exitcode) of a thread job, to the runner."""
+        self._jobqueue.put(item)
+
+    def _receive(self, timeout=None):
+        """Return the next list of changes, raise Empty if there is none.
+
+        Waits up to timeout seconds for it to arrive.
+        """
+        if timeout:
+            return self._outputs.get(timeout=timeout)
+        return self._outputs.get_nowait()
+
+    def _handle(self):
+        """Return an object that can be waited on for changes."""
+        return self._outputs._reader
+
+    def update(self, timeout=None):
+        """Get fresh job info from the runner.
+
+        Args:
+            timeout (float): Block for up to this many seconds for the first
+                             update, by default only take what has arrived.
+
+        Returns:
+            bool: True if any job info was received.
+        """
         if self.runner.is_alive() is not True:
             self.restart(True)
         if self.runner.is_alive() is not True:
             raise ClusterError('JobRunner has crashed')
-        while not self._outputs.empty():
-            # We loop through the whole queue stack, updating the dictionary
-            # every time so that we get the latest info
-            self.jobs.update(self._outputs.get_nowait())
-        if self.jobs:
-            self.jobno = max(self.jobs.keys())
-            conf.set_option('jobqueue', 'jobno', str(self.jobno))
+        got = False
+        with self._lock:
+            while True:
+                try:
+                    jobs = self._receive(timeout if not got else None)
+                except Empty:
+                    break
+                self._apply(jobs)
+                got = True
+        return got
+
+    def _apply(self, changes):
+        """Apply (seq, jobno, field, value) changes from the runner."""
+        for seq, jobno, field, value in changes:
+            if seq <= self._seq:
+                continue
+            if seq != self._seq + 1:
+                logme.log('Missed {} local queue updates'.format(
+                    seq - self._seq - 1), 'warn')
+            self._seq = seq
+            if field == 'out' and jobno in self.jobs \
+                    and self.jobs[jobno].state == 'done':
+                continue  # Sent again by a restarted runner
+            if isinstance(value, Result):
+                value = value.load()
+            if jobno in self.jobs:
+                setattr(self.jobs[jobno], field, value)
+                if field == 'state' and jobno in self._pending:
+                    if value == 'running':
+                        self._start_thread(self.jobs[jobno])
+                    elif value in END_STATES:
+                        self._pending.discard(jobno)
+                        self._exits.pop(jobno, None)
+            else:
+                logme.log('Update for unknown local job {}'.format(jobno),
+                          'debug')
 
     def add(self, function, args=None, kwargs=None, dependencies=None,
-            cores=1):
+            cores=1, priority=0, time=None, mem=None, executor='process'):
         """Add function to local job queue.
 
         Args:
@@ -124,49 +420,140 @@ class JobQueue(object):
             kwargs:       A dict of keyword arguments to submit to the function.
             dependencies: A list of job IDs that this job will depend on.
             cores:        The number of threads required by this job.
+            priority:     Jobs with a higher priority are started first.
+            time:         Estimated walltime, in seconds or [D-]HH:MM:SS, used
+                          to run small jobs ahead of blocked large ones.
+            mem:          MB of memory to reserve for this job.
+            executor:     'process' to run in a worker process, 'thread' to
+                          run on a thread in this process.
 
         Returns:
             int: A job ID
         """
-        self.update()
-        assert self.runner.is_alive()
-        oldjob = self.jobno
-        cores = int(cores)
-        if cores > self.cores:
-            logme.log('Job core request exceeds resources, limiting to max: ' +
-                      '{}'.format(self.cores), 'warn')
-            cores = self.cores
-        self._jobqueue.put(Job(function, args, kwargs, dependencies,
-                               cores))
-        sleep(0.5)
-        self.update()
-        newjob = self.jobno
-        # Sometimes the queue can freeze for reasons I don't understand, this
-        # is an attempted workaround.
-        if not newjob == oldjob + 1:
-            self.restart(True)
-            self._jobqueue.put(Job(function, args, kwargs, dependencies,
-                                   cores))
+        job = Job(function, args, kwargs, dependencies, cores, priority, time,
+                  mem, executor)
+        job.id = self.reserve(1)[0]
+        return self.add_many([job])[0]
+
+    def reserve(self, count):
+        """Reserve count consecutive job numbers for use with add_many().
+
+        Returns:
+            list: The job numbers.
+        """
+        with self._lock:
+            numbers = self.numbers.allocate(count)
+            self.jobno = numbers[-1]
+        return numbers
+
+    def add_many(self, jobs):
+        """Add many jobs at once, blocking only once for all of them.
+
+        Args:
+            jobs: A list of Job objects with ids from reserve(), dependencies
+                  may point to other jobs in the list.
+
+        Returns:
+            list: The job IDs.
+        """
+        for job in jobs:
+            if not job.id:
+                raise ClusterError('Jobs must have an ID from reserve()')
+            if job.cores > self.cores:
+                logme.log('Job core request exceeds resources, limiting to '
+                          'max: {}'.format(self.cores), 'warn')
+                job.cores = self.cores
+            with self._lock:
+                self.jobs[job.id] = job
+            if job.executor == 'thread':
+                self._add_thread_job(job)
+                continue
+            self._send(job)
+        # The runner acknowledges every job as soon as it has it
+        ids = [job.id for job in jobs]
+        self._wait_for(
+            lambda: all(self.jobs[i].state != 'Not Submitted' for i in ids),
+            ACK_TIMEOUT
+        )
+        return ids
+
+    def _add_thread_job(self, job):
+        """Send a thread job to the runner, keeping the function here."""
+        with self._lock:
+            self._pending.add(job.id)
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen,
+                                                  name='Listener')
+                self._listener.daemon = True
+                self._listener.start()
+        info = _copy(job)
+        info.function = info.args = info.kwargs = None
+        self._send(info)
+
+    def _listen(self):
+        """Apply runner updates while there are thread jobs to start."""
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._listener = None
+                    return
+            _wait([self._handle()], 0.5)
             self.update()
-            newjob = self.jobno
-        if not newjob == oldjob + 1:
-            raise ClusterError('Job numbers are not updating correctly, the '
-                               'local queue has probably crashed. Please '
-                               'report this issue.')
-        return self.jobno
+
+    def _start_thread(self, job):
+        """Run a thread job on the pool."""
+        if job.id in self._started:
+            return  # Adopted by a restarted runner
+        self._started.add(job.id)
+        job.pid = os.getpid()
+        if _ThreadPool is None:
+            thread = threading.Thread(target=self._run_thread, args=(job,))
+            thread.daemon = True
+            thread.start()
+            return
+        if self._pool is None:
+            self._pool = _ThreadPool(max_workers=self.cores)
+        self._pool.submit(self._run_thread, job)
+
+    def _run_thread(self, job):
+        """Run job and tell the runner its exit code."""
+        out = None
+        # Only this thread is pinned to the job's CPUs
+        saved = os.sched_getaffinity(0) if job.cpus else None
+        _set_affinity(job.cpus)
+        try:
+            out  = job.function(*(job.args or ()), **(job.kwargs or {}))
+            code = 0
+        except SystemExit as err:
+            code = err.code if isinstance(err.code, int) else 1
+        except Exception as err:
+            logme.log('Job {} failed with: {}: {}'.format(
+                getattr(job.function, '__name__', job.function),
+                type(err).__name__, err), 'error')
+            out  = err
+            code = 1
+        finally:
+            _set_affinity(saved)
+        job.out = out
+        # Kept to tell a restarted runner, until the job is done
+        self._exits[job.id] = code
+        self._send((job.id, code))
 
     def wait(self, jobs=None):
         """Wait for a list of jobs, all jobs are the default."""
-        self.update()
-        if not isinstance(jobs, (list, tuple)):
+        if jobs is None:
+            self.update()
+            jobs = list(self.jobs)
+        elif not isinstance(jobs, (list, tuple)):
             jobs = [jobs]
-        while jobs:
-            for job in jobs:
-                if job not in self.jobs:
-                    raise ClusterError('Job {} has not been submitted.'.format(job))
-                if self.jobs[job].state == 'done':
-                    jobs.remove(job)
-                sleep(0.5)
+        jobs = list(jobs)
+        self.update()
+        for job in jobs:
+            if job not in self.jobs:
+                raise ClusterError('Job {} has not been submitted.'.format(job))
+        self._wait_for(
+            lambda: all(self.jobs[i].state in END_STATES for i in jobs)
+        )
 
     def get(self, job):
         """Return the output of a single job"""
@@ -176,25 +563,71 @@ class JobQueue(object):
         return self.jobs[job].out
 
     def restart(self, force=False):
-        """Kill the job queue and restart it."""
+        """Kill the job queue and restart it.
+
+        With a journal the new runner resumes the jobs of the old one, jobs
+        it may never have received are sent again.
+        """
         if not force:
             self.update()
-            if len(self.done) != len(self.jobs):
+            if len(self.done) + len(self.cancelled) != len(self.jobs):
                 logme.log('Cannot restart, incomplete jobs', 'error')
                 return
         self.runner.terminate()
+        self.runner.join(1)
+        # Apply what the old runner sent, the new one numbers its changes
+        # from the start
+        with self._lock:
+            while True:
+                try:
+                    self._apply(self._receive())
+                except Empty:
+                    break
+            self._seq = 0
         self.runner  = mp.Process(target=job_runner,
                                   args=(self._jobqueue, self._outputs,
-                                        self.cores, self.jobnumber),
+                                        self.cores, self.jobno,
+                                        self.max_tasks, self.mem,
+                                        self.mem_sample, self.affinity,
+                                        self.journal),
                                   name='Runner')
         self.runner.start()
         self.pid = self.runner.pid
         assert self.runner.is_alive()
+        if not self.journal:
+            return
+        with self._lock:
+            jobs  = [i for i in self.jobs.values()
+                     if i.state == 'Not Submitted']
+            exits = list(self._exits.items())
+        for job in jobs:
+            if job.executor == 'thread':
+                job = _copy(job)
+                job.function = job.args = job.kwargs = None
+            self._send(job)
+        for item in exits:
+            self._send(item)
+
+    def _wait_for(self, condition, timeout=None):
+        """Block on runner updates until condition() is True.
+
+        Raises:
+            ClusterError: If the condition is not met within timeout seconds.
+        """
+        start = time()
+        self.update()
+        while not condition():
+            # Wake up regularly to notice if the runner died
+            self.update(timeout=1)
+            if timeout and time() - start > timeout:
+                raise ClusterError('The local queue did not respond in {} '
+                                   'seconds, it has probably crashed. '
+                                   'Please report this issue.'
+                                   .format(timeout))
 
     def __getattr__(self, attr):
         """Dynamic dictionary filtering."""
-        if attr == 'done' or attr == 'queued' or attr == 'waiting' \
-                or attr == 'running':
+        if attr in ('done', 'cancelled', 'queued', 'waiting', 'running'):
             newdict = {}
             for jobid, job_info in self.jobs.items():
                 if job_info.state == attr:
@@ -239,8 +672,14 @@ class Job(object):
     """An object to pass arguments to the runner."""
 
     def __init__(self, function, args=None, kwargs=None, depends=None,
-                 cores=1):
-        """Parse and save arguments."""
+                 cores=1, priority=0, time=None, mem=None,
+                 executor='process'):
+        """Parse and save arguments.
+
+        time is the estimated walltime in seconds or [D-]HH:MM:SS, it is
+        stored in seconds, None if unknown. mem is in MB. executor is
+        'process' or 'thread'.
+        """
         if args and not isinstance(args, tuple):
             args = (args,)
         if kwargs and not isinstance(kwargs, dict):
@@ -257,10 +696,17 @@ class Job(object):
         self.kwargs   = kwargs
         self.depends  = depends
         self.cores    = int(cores)
+        self.priority = int(priority) if priority else 0
+        self.time     = _seconds(time)
+        self.mem      = int(mem) if mem else 0
+        self.executor = executor if executor else 'process'
+        if self.executor not in ('process', 'thread'):
+            raise ValueError("executor must be 'process' or 'thread'")
 
         # Assigned later
         self.id       = None
         self.pid      = None
+        self.cpus     = None
         self.exitcode = None
         self.out      = None
         self.state    = 'Not Submitted'
@@ -282,43 +728,371 @@ class Job(object):
         return outstr
 
 
+def schedule(ready, running, cores, now=None, mem=None):
+    """Pick the ready jobs to start now, removing them from ready.
+
+    Jobs are started in order from the head of the heap for as long as they
+    fit on the free cores and memory. The first job that does not fit is given
+    a reservation: the time when enough running jobs will have finished to
+    free its cores and memory, estimated from their walltimes. Later jobs are
+    then backfilled only if they will finish before the reservation, or if
+    they use cores and memory that the reserved job will not need, so small
+    jobs keep the cores busy without delaying a large one indefinitely.
+
+    If nothing is running the head job is always started, even if it asks
+    for more memory than there is, as waiting would not free any.
+
+    Args:
+        ready (list):   Heap of (-priority, job_no, Job), modified in place.
+        running (list): (cores, estimated end time or None, MB reserved) for
+                        every running job, None is treated as never ending.
+        cores (int):    Total cores available.
+        now (float):    The current time, defaults to time().
+        mem (int):      Total MB of memory available, None for no limit.
+
+    Returns:
+        list: Jobs to start, in order.
+    """
+    now   = now if now is not None else time()
+    free  = cores - sum(i[0] for i in running)
+    fmem  = mem - sum(i[2] for i in running) if mem is not None \
+        else float('inf')
+    start = []
+    while ready and ready[0][2].cores <= free and \
+            (ready[0][2].mem <= fmem or not (running or start)):
+        job = heappop(ready)[2]
+        free -= job.cores
+        fmem -= job.mem
+        start.append(job)
+    if not ready or free <= 0:
+        return start
+
+    # Reserve cores and memory for the blocked job at the head of the queue
+    head = ready[0][2]
+    ends = sorted(
+        [(end if end is not None else float('inf'), used, umem)
+         for used, end, umem in running] +
+        [(now + job.time if job.time else float('inf'), job.cores, job.mem)
+         for job in start]
+    )
+    shadow = float('inf')
+    extra  = 0  # Cores free at the reservation that the head job won't use
+    emem   = 0  # The same for memory
+    avail  = free
+    amem   = fmem
+    for end, used, umem in ends:
+        avail += used
+        amem  += umem
+        if avail >= head.cores and amem >= head.mem:
+            shadow = end
+            extra  = avail - head.cores
+            emem   = amem - head.mem
+            break
+
+    # Backfill, in priority order, without delaying the reservation
+    backfill = []
+    for item in sorted(ready)[1:]:
+        if free <= 0:
+            break
+        job = item[2]
+        if job.cores > free or job.mem > fmem:
+            continue
+        if job.time and now + job.time <= shadow:
+            pass
+        elif job.cores <= extra and job.mem <= emem:
+            extra -= job.cores
+            emem  -= job.mem
+        else:
+            continue
+        free -= job.cores
+        fmem -= job.mem
+        backfill.append(item)
+    if backfill:
+        ids = set(id(i[2]) for i in backfill)
+        ready[:] = [i for i in ready if id(i[2]) not in ids]
+        heapify(ready)
+    return start + [i[2] for i in backfill]
+
+
+def _seconds(walltime):
+    """Return walltime, in seconds or [D-]HH:MM:SS, in seconds or None."""
+    if not walltime:
+        return None
+    if isinstance(walltime, (int, float)):
+        return walltime
+    days = 0
+    if '-' in walltime:
+        days, walltime = walltime.split('-')
+    secs = 0
+    for i in walltime.split(':'):
+        secs = secs*60 + int(i)
+    return int(days)*86400 + secs
+
+
+def _mem_available():
+    """Return MemAvailable from /proc/meminfo in MB, None if unknown."""
+    try:
+        with open('/proc/meminfo') as fin:
+            for line in fin:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])//1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def _rss(pids):
+    """Return {pid: MB} of the RSS of each process and all of its children.
+
+    Reads /proc, so returns an empty dict on systems without it.
+    """
+    if not os.path.isdir('/proc'):
+        return {}
+    parents = {}
+    usage   = {}
+    for proc in os.listdir('/proc'):
+        if not proc.isdigit():
+            continue
+        try:
+            with open('/proc/{}/status'.format(proc)) as fin:
+                for line in fin:
+                    if line.startswith('PPid:'):
+                        parents[int(proc)] = int(line.split()[1])
+                    elif line.startswith('VmRSS:'):
+                        usage[int(proc)] = int(line.split()[1])
+        except (IOError, OSError, ValueError):
+            # The process exited while we were reading
+            continue
+    children = {}
+    for proc, parent in parents.items():
+        children.setdefault(parent, []).append(proc)
+    result = {}
+    for pid in pids:
+        total = 0
+        stack = [pid]
+        while stack:
+            proc   = stack.pop()
+            total += usage.get(proc, 0)
+            stack += children.get(proc, [])
+        result[pid] = total//1024
+    return result
+
+
+###############################################################################
+#                            Job Number Allocation                            #
+###############################################################################
+
+
+class JobNumbers(object):
+
+    """Allocate local job numbers from blocks claimed in a state file.
+
+    The state file holds the last job number claimed by any process. A block
+    of numbers is claimed by advancing it under a lock, so processes sharing
+    the file never hand out the same number, and the file is written once per
+    block rather than once per job. close() gives back the unused end of the
+    block if no other process has claimed one since.
+    """
+
+    def __init__(self, path=None, block=None):
+        """Set up the allocator, no numbers are claimed until needed.
+
+        Args:
+            path (str):  The state file, default STATE_FILE.
+            block (int): Numbers to claim at once, default from the jobqueue
+                         jobno_block config option.
+        """
+        self.path  = path if path else STATE_FILE
+        self.block = int(block) if block else \
+            int(conf.get_option('jobqueue', 'jobno_block', '100'))
+        self.block = max(1, self.block)
+        self.last  = self._read()  # The last number handed out
+        self.end   = self.last     # The last number of our block
+        self._lock = threading.Lock()
+
+    def allocate(self, count=1):
+        """Return a list of count new consecutive job numbers."""
+        count = int(count)
+        with self._lock:
+            if self.last + count > self.end:
+                size = max(count, self.block)
+                with self._locked():
+                    self.last = self._read()
+                    self.end  = self.last + size
+                    self._write(self.end)
+            start      = self.last + 1
+            self.last += count
+        return list(range(start, self.last + 1))
+
+    def close(self):
+        """Return the unused numbers of the block if no one claimed more."""
+        with self._lock:
+            if self.last == self.end:
+                return
+            with self._locked():
+                if self._read() == self.end:
+                    self._write(self.last)
+            self.end = self.last
+
+    def _read(self):
+        """Return the number in the state file.
+
+        Without a state file, start from the old jobqueue jobno config option.
+        """
+        try:
+            with open(self.path) as fin:
+                return int(fin.read().strip())
+        except (IOError, OSError, ValueError):
+            return int(conf.get_option('jobqueue', 'jobno', '0') or 0)
+
+    def _write(self, number):
+        """Atomically replace the state file with number."""
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w') as fout:
+            fout.write('{}\n'.format(number))
+            fout.flush()
+            os.fsync(fout.fileno())
+        getattr(os, 'replace', os.rename)(tmp, self.path)
+
+    @contextmanager
+    def _locked(self):
+        """Hold an exclusive lock on the state file's lock file."""
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(self.path + '.lock', 'a') as lock:
+            if _fcntl:
+                _fcntl.flock(lock.fileno(), _fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if _fcntl:
+                    _fcntl.flock(lock.fileno(), _fcntl.LOCK_UN)
+
+
+class CPUAllocator(object):
+
+    """Hand out sets of CPUs to jobs, each on one NUMA node if possible.
+
+    A job is given CPUs from the node with the fewest free CPUs that still
+    has enough, to leave whole nodes free for large jobs. If no node has
+    enough, the job is spread over the nodes with the most free CPUs.
+    """
+
+    def __init__(self, nodes=None):
+        """Find the CPUs we may use.
+
+        Args:
+            nodes (dict): {node: set of CPUs}, read from /sys by default.
+        """
+        if nodes is None:
+            nodes = _numa_nodes()
+        self.node = {}  # {cpu: node}
+        for node, node_cpus in nodes.items():
+            for cpu in node_cpus:
+                self.node[cpu] = node
+        self.free = dict((node, set(i)) for node, i in nodes.items())
+
+    def allocate(self, count):
+        """Return a sorted list of count CPUs, None if not enough are free."""
+        count = int(count)
+        if count < 1 or count > sum(len(i) for i in self.free.values()):
+            return None
+        fits = [(len(i), node) for node, i in self.free.items()
+                if len(i) >= count]
+        if fits:
+            use = sorted(self.free[min(fits)[1]])[:count]
+        else:
+            use = []
+            for node in sorted(self.free, key=lambda i: -len(self.free[i])):
+                use += sorted(self.free[node])[:count - len(use)]
+                if len(use) == count:
+                    break
+        for cpu in use:
+            self.free[self.node[cpu]].discard(cpu)
+        return sorted(use)
+
+    def release(self, cpus):
+        """Make cpus free again."""
+        for cpu in cpus:
+            if cpu in self.node:
+                self.free[self.node[cpu]].add(cpu)
+
+
+def _numa_nodes():
+    """Return {node: set of CPUs} for the CPUs this process may use."""
+    allowed = os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') \
+        else set(range(THREADS))
+    nodes = {}
+    for path in _glob('/sys/devices/system/node/node*/cpulist'):
+        try:
+            node = int(os.path.basename(os.path.dirname(path))[4:])
+            with open(path) as fin:
+                node_cpus = _parse_cpus(fin.read()) & allowed
+        except (IOError, OSError, ValueError):
+            continue
+        if node_cpus:
+            nodes[node] = node_cpus
+    # Without NUMA info, or for any CPUs it doesn't cover, use one node
+    missing = set(allowed) - set().union(*nodes.values()) if nodes \
+        else set(allowed)
+    if missing:
+        nodes[-1] = missing
+    return nodes
+
+
 ###############################################################################
 #               The Job Runner that will fork and run all jobs                #
 ###############################################################################
 
 
-def job_runner(jobqueue, outputs, cores=None, jobno=None):
+def job_runner(jobqueue, outputs, cores=None, jobno=None, max_tasks=0,
+               mem=0, mem_sample=0, affinity=False, journal=None):
     """Run jobs with dependency tracking.
 
     Must be run as a separate multiprocessing.Process to function correctly.
 
-    Args:
-        jobqueue: A multiprocessing.Queue object into which Job objects must be
-                  added. The function continually searches this Queue for new
-                  jobs. Note, function must be a function call, it cannot be
-                  anything else.  function is the only required argument, the
-                  rest are optional.  tuples are required.
-        outputs:  A multiprocessing.Queue object that will take outputs. A
-                  dictionary of job objects will be output here with the
-                  format:: {job_no => Job}
-                  **NOTE**: function return must be picklable otherwise this
-                  will raise an exception when it is put into the Queue object.
-        cores:    Number of cores to use in the multiprocessing pool. Defaults
-                  to all.
-        jobno:    What number to start counting jobs from, default 1.
-    """
+    The runner sleeps until a job is submitted or a worker finishes, so jobs
+    start and are reported done without any polling delay.
 
-    def output(out):
-        """Explicitly clear the dictionary before sending the output."""
-        # Don't send output if it is the same as last time.
-        lastout = outputs.get() if not outputs.empty() else ''
-        if out == lastout:
-            return
-        while not outputs.empty():
-            # Clear the output object
-            outputs.get()
-        outputs.put(out)
+    Each waiting job has a count of its dependencies that are not done yet,
+    and each job a list of the jobs that depend on it, so a job is queued
+    exactly when its last dependency completes. If a dependency fails (exits
+    with a code other than 0), the job and everything that depends on it is
+    cancelled instead.
+
+    Ready jobs are started by schedule(), highest priority first, with
+    smaller jobs backfilled around a large job that is waiting for cores.
 
+    Thread jobs are not run here, they are only set to 'running', which tells
+    the JobQueue to start them, and it puts (job_no, exitcode) on jobqueue
+    when they finish.
+
+    Args:
+        jobqueue:  A multiprocessing.Queue object into which Job objects must
+                   be added. The function continually searches this Queue for
+                   new jobs. Note, function must be a function call, it cannot
+                   be anything else.  function is the only required argument,
+                   the rest are optional.  tuples are required.
+        outputs:   A multiprocessing.Queue object that will take outputs. A
+                   list of changes will be output here with the format::
+                   [(seq, job_no, field, value)], seq counts up from 1 with
+                   every change. A job's state is first set to 'submitted' as
+                   soon as it is received, acknowledging it.
+                   **NOTE**: function return must be picklable otherwise the
+                   output of the job will be None.
+        cores:     Number of cores to use in the worker pool. Defaults to all.
+        jobno:     What number to start counting jobs from, default 1.
+        max_tasks: Replace a worker after it has run this many jobs, 0 to keep
+                   workers forever.
+        mem:        MB of memory jobs may reserve, 0 to use MemAvailable.
+        mem_sample: Seconds between reads of the RSS of running jobs, 0 to
+                    never read it.
+        affinity:   Pin every job to its own CPUs, if there are enough free
+                    ones, otherwise it may use any.
+        journal:    A file to record all jobs and changes in, if it exists
+                    the jobs in it are resumed.
+    """
     # Make sure we have Queue objects
     if not isinstance(jobqueue, mp.queues.Queue) \
             or not isinstance(outputs, mp.queues.Queue):
@@ -326,117 +1100,670 @@ def job_runner(jobqueue, outputs, cores=None, jobno=None):
                            'Queue objects')
 
     # Initialize job objects
-    jobno   = int(jobno) if jobno \
-              else int(conf.get_option('jobqueue', 'jobno', str(1)))
-    jobs    = {} # This will hold job numbers
-    started = [] # A list of started jobs to check against
-    cores   = cores if cores else THREADS
-    queue   = [] # This will hold Processes that haven't started yet
-    running = [] # This will hold actively running jobs to manage core count
-    done    = [] # A list of completed jobs to check against
-
-    # Actually loop through the jobs
-    while True:
-        if not jobqueue.empty():
-            oldjob = jobno
-            jobno += 1
-            newjob = jobno
-            # Sometimes the thread stalls if it has been left a while and
-            # ends up reusing the same job number. I don't know why this
-            # happens, however explicitly getting the jobno seems to fix the
-            # issue. Just to be sure I also want to test that the job number is
-            # incremented, but this is a little redundant at this point.
-            assert newjob == oldjob + 1
-            job = jobqueue.get_nowait()
-            if not isinstance(job, Job):
-                logme.log('job information must be a job object, was {}'.format(
-                    type(job)), 'error')
+    jobno    = int(jobno) if jobno \
+               else int(conf.get_option('jobqueue', 'jobno', str(1)))
+    cores    = cores if cores else THREADS
+    ready    = [] # Heap of (-priority, job_no, Job) with all dependencies done
+    waiting  = {} # {job_no: number of dependencies not done yet}
+    children = {} # {job_no: [Jobs that depend on it]}
+    done     = set() # Jobs that completed successfully
+    failed   = set() # Jobs that failed or were cancelled
+    idle     = [] # Workers waiting for a job
+    busy     = [] # Workers running a job
+    threads  = {} # {job_no: (Job, estimated end)} for running thread jobs
+    finished = [] # (job_no, exitcode) of thread jobs
+    cpus     = CPUAllocator() if affinity and hasattr(os, 'sched_setaffinity') \
+               else None
+    changes  = [] # (seq, job_no, field, value) to send
+    received = [] # Jobs to add to the journal
+    seq      = _count(1)
+    journal  = Journal(journal) if journal else None
+    logged   = {} # {job_no: Job} of every job in the journal
+    sampled  = time() # When the RSS of running jobs was last read
+
+    def change(job, field, value):
+        """Set field of job to value and record the change."""
+        if getattr(job, field) != value:
+            setattr(job, field, value)
+            changes.append((next(seq), job.id, field, value))
+
+    def make_ready(job):
+        """Queue job to start as soon as there are cores."""
+        heappush(ready, (-job.priority, job.id, job))
+        change(job, 'state', 'queued')
+
+    def finish(job, exitcode):
+        """Mark job done and queue or cancel the jobs that depend on it."""
+        if job.cpus:
+            cpus.release(job.cpus)
+        change(job, 'exitcode', exitcode)
+        change(job, 'state', 'done')
+        if exitcode != 0:
+            # Nothing that depends on a failed job can run
+            failed.add(job.id)
+            for child in children.pop(job.id, []):
+                cancel(child)
+            return
+        done.add(job.id)
+        for child in children.pop(job.id, []):
+            waiting[child.id] -= 1
+            if not waiting[child.id]:
+                del waiting[child.id]
+                make_ready(child)
+
+    def cancel(job):
+        """Cancel job and everything that depends on it."""
+        stack = [job]
+        while stack:
+            job = stack.pop()
+            waiting.pop(job.id, None)
+            failed.add(job.id)
+            change(job, 'state', 'cancelled')
+            stack += children.pop(job.id, [])
+
+    def submit(job):
+        """Queue job once its dependencies are done."""
+        change(job, 'state', 'submitted')
+
+        # Count the dependencies that are not done yet, the job is started
+        # when the last of them completes
+        depends = set(int(i) for i in job.depends or [])
+        if depends & failed:
+            cancel(job)
+            return
+        depends -= done
+        if not depends:
+            make_ready(job)
+            return
+        waiting[job.id] = len(depends)
+        for depend in depends:
+            children.setdefault(depend, []).append(job)
+        change(job, 'state', 'waiting')
+
+    def resend(job, *fields):
+        """Send fields of job again, the JobQueue may have missed them."""
+        for field in fields:
+            changes.append((next(seq), job.id, field, getattr(job, field)))
+
+    # Resume the jobs of a runner that died
+    known = {}
+    seen  = set() # Every job number received
+    if journal:
+        known = journal.replay()
+        logged.update(known)
+        if known:
+            # Outputs may not have been sent yet, they are kept
+            journal.rewrite(list(known.values()))
+        seen.update(known)
+        for job in sorted(known.values(), key=lambda i: i.id):
+            jobno = max(jobno, job.id)
+            if job.state in END_STATES:
+                if job.state == 'cancelled' or job.exitcode != 0:
+                    failed.add(job.id)
+                else:
+                    done.add(job.id)
+                # In the order they are first sent, the output is ignored
+                # once a job is done
+                if job.executor != 'thread':
+                    resend(job, 'out')
+                resend(job, 'exitcode', 'state')
+        for job in sorted(known.values(), key=lambda i: i.id):
+            if job.state in END_STATES:
+                continue
+            if job.state == 'running' and job.executor == 'thread':
+                # Still running in the JobQueue, it will tell us the exit code
+                threads[job.id] = (job, None)
+                job.cpus = None
+                resend(job, 'state')
                 continue
+            if job.state == 'running' and job.pid and run.check_pid(job.pid):
+                # An orphaned worker, its result can't reach us
+                logme.log('Killing orphaned worker {} of job {}'
+                          .format(job.pid, job.id), 'warn')
+                try:
+                    os.kill(job.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            job.pid = job.cpus = None
+            job.state = 'Not Submitted'
+            submit(job)
+
+    # Make terminate() run the cleanup below, so no workers are left behind
+    signal.signal(signal.SIGTERM, _exit)
+
+    try:
+        resume = bool(known)
+        while True:
+            # Sleep until a job arrives, a worker returns, or a worker dies,
+            # or it is time to check the memory use of running jobs
+            if resume:
+                resume = False
+            else:
+                _wait(sum([i.handles for i in busy], [jobqueue._reader]),
+                      mem_sample if mem_sample and busy else None)
+            if mem_sample and busy and time() - sampled >= mem_sample:
+                sampled = time()
+                rss = _rss([i.process.pid for i in busy])
+                for worker in busy:
+                    worker.rss = rss.get(worker.process.pid, 0)
+
+            # Take every new job, so bulk submissions don't wait a tick each
+            while True:
+                try:
+                    job = jobqueue.get_nowait()
+                except Empty:
+                    break
+                except Exception as err:
+                    # e.g. the function is not importable in this process
+                    logme.log('Could not read job: {}'.format(err), 'error')
+                    continue
+                if isinstance(job, tuple):
+                    finished.append(job)
+                    continue
+                if not isinstance(job, Job):
+                    logme.log('job information must be a job object, was {}'
+                              .format(type(job)), 'error')
+                    continue
+
+                # Jobs added with add_many() already have a number
+                if job.id:
+                    if job.id in seen:
+                        continue  # Sent again after a restart
+                    jobno = max(jobno, job.id)
+                else:
+                    jobno += 1
+                    job.id = jobno
+                seen.add(job.id)
+                if journal:
+                    received.append(job)
+                    logged[job.id] = job
+                submit(job)
+
+            # Collect finished jobs, replacing workers that died or are spent
+            for worker in list(busy):
+                job    = worker.job
+                result = worker.collect()
+                if not result:
+                    continue
+                busy.remove(worker)
+                if worker.process.is_alive() and \
+                        not (max_tasks and worker.count >= max_tasks):
+                    idle.append(worker)
+                else:
+                    worker.stop()
+                change(job, 'out', result[1])
+                finish(job, result[0])
+            for job_no, exitcode in finished:
+                if job_no in threads:
+                    finish(threads.pop(job_no)[0], exitcode)
+            finished = []
+
+            # Start as many ready jobs as fit on the free cores and memory,
+            # jobs count what they asked for, or what they use if more
+            running = [(i.job.cores, i.end, max(i.job.mem, i.rss))
+                       for i in busy] + \
+                      [(job.cores, end, job.mem)
+                       for job, end in threads.values()]
+            if mem:
+                limit = mem
+            else:
+                limit = _mem_available()
+                if limit is not None:
+                    # MemAvailable already excludes what jobs are using
+                    limit += sum(i.rss for i in busy)
+            for job in schedule(ready, running, cores, mem=limit):
+                if cpus:
+                    change(job, 'cpus', cpus.allocate(job.cores))
+                if job.executor == 'thread':
+                    threads[job.id] = (
+                        job, time() + job.time if job.time else None
+                    )
+                    change(job, 'state', 'running')
+                    continue
+                worker = idle.pop() if idle else _Worker()
+                worker.run(job)
+                change(job, 'pid', worker.process.pid)
+                change(job, 'state', 'running')
+                busy.append(worker)
+
+            # Send only what changed, once it is in the journal
+            if journal and (received or changes):
+                journal.append(received + changes)
+                received = []
+            if changes:
+                outputs.put(changes)
+                changes = []
+            if journal and journal.full():
+                journal.compact(logged)
+    finally:
+        for worker in idle + busy:
+            worker.process.terminate()
+
+
+class Journal(object):
 
-            # The arguments look good, so lets add this to the stack.
-            job.state   = 'submitted'
-            job.id      = jobno
-            jobs[jobno] = job
+    """An append only record of the jobs and changes of a job_runner.
 
-            # Send the job dictionary
-            output(jobs)
+    Every append() writes one pickled list of Job objects and (seq, job_no,
+    field, value) changes, and flushes it, so it is on disk before the
+    changes are sent. A record cut short by a crash is ignored on reading.
 
-        # If there are jobs, try and run them
-        if jobs:
-            for jobno, job_info in jobs.items():
-                # Skip completed jobs
-                if job_info.state == 'done':
+    The file is only readable by this user, and it is created, never opened
+    if it exists already when created.
+    """
+
+    def __init__(self, path):
+        """Set the file, it is opened on the first append."""
+        self.path  = path
+        self._file = None
+        self._base = 0  # Size of the journal when it was last rewritten
+        self._size = 0  # Bytes appended since
+
+    def append(self, records):
+        """Add a list of Jobs and changes to the end of the journal."""
+        try:
+            data = pickle.dumps(records, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # Keep what we can, e.g. the output of one job is not picklable
+            good = []
+            for record in records:
+                try:
+                    pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+                except Exception as err:
+                    logme.log('Cannot journal {}: {}'.format(record, err),
+                              'warn')
                     continue
+                good.append(record)
+            data = pickle.dumps(good, pickle.HIGHEST_PROTOCOL)
+        if self._file is None:
+            try:
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+            except OSError:
+                fd = _create_private(self.path, os.O_APPEND)
+            self._file = os.fdopen(fd, 'ab')
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
 
-                # Check dependencies
-                ready = True
-                if job_info.depends:
-                    for depend in job_info.depends:
-                        if int(depend) not in done:
-                            ready = False
-                            job_info.state = 'waiting'
-                            output(jobs)
-
-                # Start jobs if dependencies are met and they aren't started.
-                # We use daemon mode so that child jobs are killed on exit.
-                if ready and not jobno in started:
-                    ver = sys.version_info.major
-                    # Python 2 doesn't support daemon, even though the docs
-                    # say that it does.
-                    gen_args = dict(name=str(jobno)) if ver == 2 \
-                        else dict(name=str(jobno), daemon=True)
-                    if job_info.args and job_info.kwargs:
-                        queue.append((mp.Process(target=job_info.function,
-                                                 args=job_info.args,
-                                                 kwargs=job_info.kwargs,
-                                                 **gen_args),
-                                      job_info.cores))
-                    elif job_info.args:
-                        queue.append((mp.Process(target=job_info.function,
-                                                 args=job_info.args,
-                                                 **gen_args),
-                                      job_info.cores))
-                    elif job_info.kwargs:
-                        queue.append((mp.Process(target=job_info.function,
-                                                 kwargs=job_info.kwargs,
-                                                 **gen_args),
-                                      job_info.cores))
-                    else:
-                        queue.append((mp.Process(target=job_info.function,
-                                                 **gen_args),
-                                      job_info.cores))
-                    job_info.state = 'queued'
-                    started.append(jobno)
-                    output(jobs)
-
-        # Actually run jobs
-        if queue:
-            # Get currently used cores, ignore ourself
-            running_cores = 0
-            for i in [i[1] for i in running]:
-                running_cores += i
-            # Look for a job to run
-            for j in queue:
-                if j[1] + running_cores <= cores:
-                    j[0].start()
-                    jobs[int(j[0].name)].state = 'running'
-                    jobs[int(j[0].name)].pid = j[0].pid
-                    running.append(queue.pop(queue.index(j)))
-                    output(jobs)
-                    sleep(0.5)  # Wait for a second to allow job to start
+    def full(self):
+        """True once more was appended than was left by the last rewrite."""
+        return self._size > max(JOURNAL_COMPACT, self._base)
+
+    def compact(self, jobs):
+        """Rewrite the journal with just jobs, as they are now.
+
+        Jobs that ended are replaced in jobs by copies without function,
+        arguments or output, as their changes have been sent.
+
+        Args:
+            jobs (dict): {job_no: Job} of every job in the journal.
+        """
+        for job_no, job in list(jobs.items()):
+            if job.state in END_STATES and \
+                    (job.function or job.args or job.kwargs or job.out):
+                job = _copy(job)
+                job.function = job.args = job.kwargs = job.out = None
+                jobs[job_no] = job
+        logme.log('Compacting the journal of {} jobs'.format(len(jobs)),
+                  'debug')
+        self.rewrite(list(jobs.values()))
+
+    def replay(self):
+        """Return {job_no: Job} with every change in the journal applied."""
+        jobs = {}
+        try:
+            fin = open(self.path, 'rb')
+        except (IOError, OSError):
+            return jobs
+        with fin:
+            while True:
+                try:
+                    records = pickle.load(fin)
+                except EOFError:
+                    break
+                except Exception as err:
+                    logme.log('Ignoring the end of the journal {}: {}'
+                              .format(self.path, err), 'warn')
                     break
+                for record in records:
+                    if isinstance(record, Job):
+                        jobs[record.id] = record
+                    elif record[1] in jobs:
+                        setattr(jobs[record[1]], record[2], record[3])
+        return jobs
+
+    def rewrite(self, jobs):
+        """Atomically replace the journal with just the list of jobs."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        tmp = self.path + '.tmp'
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        with os.fdopen(_create_private(tmp), 'wb') as fout:
+            pickle.dump(jobs, fout, pickle.HIGHEST_PROTOCOL)
+            self._base = fout.tell()
+        getattr(os, 'replace', os.rename)(tmp, self.path)
+        self._size = 0
+
+    @staticmethod
+    def clean():
+        """Delete the journals of processes that are no longer running."""
+        pattern = os.path.join(user_dir(), JOURNAL_FILE.format('*', '*'))
+        for path in _glob(pattern):
+            try:
+                pid = int(os.path.basename(path).split('.')[1])
+            except (IndexError, ValueError):
+                continue
+            if not run.check_pid(pid):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+def _create_private(path, flags=0):
+    """Create path for writing, only readable by this user.
+
+    Returns:
+        int: The file descriptor.
+
+    Raises:
+        OSError: If the file exists.
+    """
+    return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | flags, 0o600)
+
+
+class _Worker(object):
+
+    """A persistent process that runs one job at a time for job_runner."""
+
+    def __init__(self):
+        """Start the process, it waits for jobs on a pipe."""
+        self.conn, child = mp.Pipe()
+        # Python 2 doesn't support daemon, even though the docs say that it
+        # does. We use daemon mode so that workers are killed on exit.
+        daemon = {} if sys.version_info.major == 2 else {'daemon': True}
+        self.process = mp.Process(target=job_worker,
+                                  args=(child, self.conn),
+                                  name='Worker', **daemon)
+        self.process.start()
+        child.close()
+        self.job   = None
+        self.end   = None  # Estimated end time of the job
+        self.rss   = 0     # MB used by the job when last checked
+        self.count = 0
+
+    @property
+    def handles(self):
+        """The pipe and the process sentinel, to wait on."""
+        return [self.conn, getattr(self.process, 'sentinel', self.conn)]
+
+    def run(self, job):
+        """Send job to the worker."""
+        self.job = job
+        self.end = time() + job.time if job.time else None
+        self.rss = 0
+        self.conn.send((job.function, job.args or (), job.kwargs or {},
+                        job.cpus))
+
+    def collect(self):
+        """Return (exitcode, output) if the job is finished, else None."""
+        result = None
+        if self.conn.poll():
+            try:
+                result = self.conn.recv()
+            except (EOFError, OSError):
+                pass
+        if result is None:
+            if self.process.is_alive():
+                return None
+            # The job killed the worker
+            self.process.join()
+            result = (self.process.exitcode, None)
+        self.count += 1
+        self.job = None
+        return result
+
+    def stop(self):
+        """Ask the worker to exit."""
+        try:
+            self.conn.send(None)
+        except (EOFError, OSError):
+            pass
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+def job_worker(conn, parent=None):
+    """Run (function, args, kwargs, cpus) from conn until None is received.
+
+    The worker is pinned to cpus while it runs the job, if they are given.
+
+    Sends (exitcode, output) back for every job, the exitcode is 0 if the
+    function returned, 1 if it raised (or is a function job that raised), or
+    the code passed to sys.exit().
+
+    Args:
+        conn:   The worker end of the pipe.
+        parent: The runner end of the pipe, closed here so that we get an
+                EOF if the runner dies.
+    """
+    # Forked from the runner, but terminate() should just kill us
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if parent:
+        parent.close()
+    # Jobs without CPUs of their own may use any of ours
+    allowed = os.sched_getaffinity(0) \
+        if hasattr(os, 'sched_getaffinity') else None
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        function, args, kwargs, cpus = job
+        _set_affinity(cpus if cpus else allowed)
+        out = None
+        try:
+            out  = function(*args, **kwargs)
+            code = 1 if isinstance(out, Result) and out.failed else 0
+        except SystemExit as err:
+            code = err.code if isinstance(err.code, int) else 1
+        except Exception as err:
+            logme.log('Job {} failed with: {}: {}'.format(
+                getattr(function, '__name__', function),
+                type(err).__name__, err), 'error')
+            code = 1
+        try:
+            conn.send((code, out))
+        except Exception as err:
+            logme.log('Could not send output of {}: {}'.format(
+                getattr(function, '__name__', function), err), 'error')
+            conn.send((code, None))
+
+
+###############################################################################
+#                       Running Function Jobs Directly                        #
+###############################################################################
+
+
+class Result(object):
+
+    """The output of a function job, pickled by the worker for the trip back.
+
+    Buffers larger than `serialize.OOB_MIN_SIZE` are copied into one block of
+    shared memory, only the name of which passes through the runner. The block
+    is freed by `load()`.
+
+    Attributes:
+        failed (bool): The output is an exception raised by the function.
+    """
+
+    def __init__(self, obj):
+        """Pickle obj, moving large buffers to shared memory if possible."""
+        self.failed = isinstance(obj, Exception)
+        self.shared = None
+        self.layout = []
+        payload, buffers = serialize.dumps(obj, oob=_shared_memory is not None)
+        if buffers:
+            views = [buf.raw() for buf in buffers]
+            block = _shared_memory.SharedMemory(
+                create=True, size=sum(view.nbytes for view in views))
+            start = 0
+            for view in views:
+                block.buf[start:start+view.nbytes] = view
+                self.layout.append((start, view.nbytes))
+                start += view.nbytes
+                view.release()
+            # The parent process frees the block, not our resource tracker
+            _untrack(block)
+            self.shared = block.name
+            block.close()
+        self.payload = payload
+
+    def load(self):
+        """Return the output, freeing the shared memory."""
+        buffers = None
+        if self.shared:
+            block = _shared_memory.SharedMemory(name=self.shared)
+            try:
+                buffers = [bytearray(block.buf[start:start+length])
+                           for start, length in self.layout]
+            finally:
+                block.close()
+                block.unlink()
+        try:
+            return serialize.loads(self.payload, buffers)
+        except Exception as err:
+            logme.log('Could not load a local job output: {}'.format(err),
+                      'error')
+            return err
+
+
+def run_function(payload, outfile=None, errfile=None, runpath=None,
+                 name=None):
+    """Run a pickled (function, args, kwargs) in this process.
+
+    Does what the function runner script does for a local function job:
+    STDOUT and STDERR are redirected to outfile and errfile, with the same
+    time stamps the job scripts write, and an exception raised by the function
+    (or when unpickling it) is returned as the output, and the job exits with
+    code 1.
+
+    Args:
+        payload (bytes): The function call from `serialize.dumps_call()`.
+        outfile (str):   The file for STDOUT.
+        errfile (str):   The file for STDERR.
+        runpath (str):   The directory to run in.
+        name (str):      The job name, for the STDOUT header.
+
+    Returns:
+        Result: The output of the function.
+    """
+    cwd   = os.getcwd()
+    saved = _redirect(outfile, errfile)
+    try:
+        sys.stdout.write('{}\nRunning {}\n'.format(_timestamp(), name))
+        sys.stdout.flush()
+        try:
+            if runpath:
+                os.chdir(runpath)
+            function, args, kwargs = serialize.loads_call(payload)
+            out = function(*args, **kwargs)
+        except Exception as err:
+            out = err
+        sys.stdout.write('Done\n{}\n'.format(_timestamp()))
+    finally:
+        _restore(saved)
+        os.chdir(cwd)
+    return Result(out)
+
+
+def run_thread(function, args=None, kwargs=None, outfile=None,
+                 errfile=None, name=None):
+    """Run function on a JobQueue thread for a fyrd.Job.
+
+    STDOUT and STDERR belong to the whole process, so they are not redirected,
+    only the time stamps are written to outfile, and errfile is created empty.
+
+    Args:
+        function (callable): The function to run.
+        args (tuple):        Its arguments.
+        kwargs (dict):       Its keyword arguments.
+        outfile (str):       The file for the time stamps.
+        errfile (str):       The file for STDERR.
+        name (str):          The job name, for the header.
+
+    Returns:
+        The output of the function, exceptions are raised.
+    """
+    if errfile:
+        open(errfile, 'w').close()
+    if outfile:
+        with open(outfile, 'w') as fout:
+            fout.write('{}\nRunning {}\n'.format(_timestamp(), name))
+    try:
+        return function(*(args or ()), **(kwargs or {}))
+    finally:
+        if outfile:
+            with open(outfile, 'a') as fout:
+                fout.write('Done\n{}\n'.format(_timestamp()))
+
+
+def _timestamp():
+    """The time in the format of the job scripts."""
+    return _dt.now().strftime('%y-%m-%d-%H:%M:%S')
+
+
+def _redirect(outfile, errfile):
+    """Point file descriptors 1 and 2 at outfile and errfile.
+
+    Returns:
+        list: (fd, saved copy) to pass to `_restore()`.
+    """
+    saved = []
+    for fd, stream, path in [(1, sys.stdout, outfile),
+                             (2, sys.stderr, errfile)]:
+        if not path:
+            continue
+        stream.flush()
+        saved.append((fd, os.dup(fd)))
+        with open(path, 'w') as fout:
+            os.dup2(fout.fileno(), fd)
+    return saved
+
+
+def _restore(saved):
+    """Undo `_redirect()`."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    for fd, copy in saved:
+        os.dup2(copy, fd)
+        os.close(copy)
+
+
+def _untrack(block):
+    """Stop the resource tracker from freeing a shared memory block."""
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(block._name, 'shared_memory')
+    except (ImportError, AttributeError):
+        pass
+
+
+def _exit(*args):
+    """Exit normally on a signal, so cleanup runs."""
+    sys.exit(0)
+
 
-        # Clean out running jobs
-        if running:
-            for i in running:
-                j = i[0]
-                if not j.is_alive():
-                    jobs[int(j.name)].out = j.join()
-                    jobs[int(j.name)].state = 'done'
-                    jobs[int(j.name)].exitcode = j.exitcode
-                    done.append(int(j.name))
-                    running.pop(running.index(i))
-                    output(jobs)
-
-        # Wait for half a second before looping again
-        sleep(0.5)
+def _wait(objects, timeout=None):
+    """Block until one of the connections or process sentinels is ready."""
+    if _mp_wait:
+        return _mp_wait(objects, timeout)
+    # Python 2, no sentinels, so just check everything regularly
+    sleep(0.05)
+    return objects
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Store and look up the results of function jobs by their content.
+
+A function job submitted with ``memo=True`` is identified by a hash of the
+function's code and of its pickled arguments. When the job completes, its
+output pickle is copied into a `ResultStore` under that hash. Submitting an
+identical call later returns a completed Job straight from the store, without
+writing any scripts or touching the scheduler.
+
+The store is a directory (the memo_path config option) of pickles in the
+`serialize` format, pruned to memo_size MB by deleting the least recently used
+results first.
+
+Note that only the code of the function itself is hashed, not the functions
+it calls or the global variables it uses, so a change to those will not
+invalidate the stored result.
+"""
+import os      as _os
+import shutil  as _shutil
+import hashlib as _hashlib
+import inspect as _inspect
+import pickle  as _stdpickle
+from uuid import uuid4 as _uuid
+
+# Try to use dill, revert to pickle if not found
+try:
+    import dill as _pickle
+except ImportError:
+    try:
+        import cPickle as _pickle # For python2
+    except ImportError:
+        import pickle as _pickle
+
+from . import conf      as _conf
+from . import logme     as _logme
+from . import serialize as _serialize
+
+__all__ = ['ResultStore', 'get_store', 'job_key']
+
+# Holds the store created by get_store()
+STORE = None
+
+
+###############################################################################
+#                              The Result Store                               #
+###############################################################################
+
+
+class ResultStore(object):
+
+    """An on-disk store of function results with LRU eviction by size."""
+
+    def __init__(self, path=None, max_size=None):
+        """Set the store location and size.
+
+        Args:
+            path (str):     The directory to use, default from memo_path in
+                            the config.
+            max_size (int): Maximum size in MB, default from memo_size in the
+                            config.
+        """
+        if not path:
+            path = _conf.get_option('jobs', 'memo_path')
+        if not path:
+            path = _os.path.join(_conf.CONFIG_PATH, 'memo')
+        if max_size is None:
+            max_size = _conf.get_option('jobs', 'memo_size')
+        self.path     = _os.path.abspath(_os.path.expanduser(path))
+        self.max_size = int(max_size)*1024*1024
+
+    def lookup(self, key, mmap=False):
+        """Return the result stored for key.
+
+        Args:
+            key (str):   A hash from `job_key()`.
+            mmap (bool): Memory map large buffers, see `serialize.load()`.
+
+        Returns:
+            tuple: (found, result), found is False if there is no result.
+        """
+        pfile = self.path_for(key)
+        try:
+            result = _serialize.load(pfile, mmap=mmap)
+        except (IOError, OSError, EOFError):
+            return False, None
+        # Mark as recently used
+        for fl in [pfile, _serialize.buffer_file(pfile)]:
+            if _os.path.isfile(fl):
+                _os.utime(fl, None)
+        _logme.log('Found stored result for {}'.format(key), 'debug')
+        return True, result
+
+    def store(self, key, pickle_file):
+        """Copy an output pickle (and sidecar) into the store as key.
+
+        The pickle is copied last under a temporary name and then renamed, so
+        a partly copied result is never found by `lookup()`.
+        """
+        pfile = self.path_for(key)
+        pdir  = _os.path.dirname(pfile)
+        if not _os.path.isdir(pdir):
+            _os.makedirs(pdir)
+        files = [(_serialize.buffer_file(pickle_file),
+                  _serialize.buffer_file(pfile)),
+                 (pickle_file, pfile)]
+        for src, dest in files:
+            if not _os.path.isfile(src):
+                continue
+            tmp = '{}.{}.tmp'.format(dest, _uuid().hex)
+            _shutil.copyfile(src, tmp)
+            _os.rename(tmp, dest)
+        _logme.log('Stored result for {}'.format(key), 'debug')
+        self.evict()
+
+    def store_result(self, key, result):
+        """Pickle a result straight into the store as key.
+
+        For outputs that never had a pickle file, e.g. of local function jobs,
+        written under a temporary name and renamed just like `store()`.
+        """
+        pfile = self.path_for(key)
+        pdir  = _os.path.dirname(pfile)
+        if not _os.path.isdir(pdir):
+            _os.makedirs(pdir)
+        tmp = '{}.{}.tmp'.format(pfile, _uuid().hex)
+        _serialize.dump(result, tmp)
+        for src, dest in [(_serialize.buffer_file(tmp),
+                           _serialize.buffer_file(pfile)), (tmp, pfile)]:
+            if _os.path.isfile(src):
+                _os.rename(src, dest)
+        _logme.log('Stored result for {}'.format(key), 'debug')
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used results until below max_size."""
+        files = []
+        total = 0
+        for root, _, names in _os.walk(self.path):
+            for name in names:
+                fl = _os.path.join(root, name)
+                try:
+                    stat = _os.stat(fl)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, fl))
+                total += stat.st_size
+        if total <= self.max_size:
+            return
+        for _, size, fl in sorted(files):
+            if total <= self.max_size:
+                break
+            _logme.log('Evicting {} from result store'.format(fl), 'debug')
+            try:
+                _os.remove(fl)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Delete every stored result."""
+        if _os.path.isdir(self.path):
+            _shutil.rmtree(self.path)
+
+    def path_for(self, key):
+        """Return the pickle file name for key."""
+        return _os.path.join(self.path, key[:2], key + '.pickle')
+
+    def __contains__(self, key):
+        """True if a result is stored for key."""
+        return _os.path.isfile(self.path_for(key))
+
+    def __repr__(self):
+        """Location and size."""
+        return 'ResultStore<{}:max_size:{}MB>'.format(
+            self.path, self.max_size//1024//1024)
+
+
+###############################################################################
+#                                   Hashing                                   #
+###############################################################################
+
+
+def job_key(function, args=None, kwargs=None):
+    """Return a hash of function's code and its arguments.
+
+    The arguments are pickled as in `Function.write()`, large buffers (e.g.
+    numpy arrays) are hashed in place rather than copied into the pickle.
+
+    Returns:
+        str: A hex digest.
+    """
+    digest = _hashlib.sha256()
+    digest.update(_function_id(function))
+    payload = None
+    if _serialize.OOB_AVAILABLE:
+        def hash_buffer(buf):
+            """Hash the buffer directly, keep it out of the pickle."""
+            with buf.raw() as view:
+                digest.update(view)
+            return False
+        try:
+            payload = _stdpickle.dumps((args, kwargs),
+                                       protocol=_serialize.OOB_PROTOCOL,
+                                       buffer_callback=hash_buffer)
+        except Exception:
+            payload = None
+    if payload is None:
+        payload = _pickle.dumps((args, kwargs))
+    digest.update(payload)
+    return digest.hexdigest()
+
+
+def get_store():
+    """Return the ResultStore configured in the config file."""
+    global STORE
+    if STORE is None:
+        STORE = ResultStore()
+    return STORE
+
+
+def _function_id(function):
+    """Return bytes identifying function's name and code."""
+    name = '{}.{}'.format(
+        getattr(function, '__module__', ''),
+        getattr(function, '__qualname__', getattr(function, '__name__', ''))
+    )
+    try:
+        code = _inspect.getsource(function)
+    except (IOError, OSError, TypeError):
+        try:
+            code = _pickle.dumps(function.__code__)
+        except Exception:
+            code = repr(function)
+    if not isinstance(code, bytes):
+        code = code.encode('utf-8')
+    return name.encode('utf-8') + b'\0' + code
@@ -23,10 +23,10 @@ from textwrap import wrap as _wrap
 from itertools import groupby
 from collections import OrderedDict
 
-from tabulate import tabulate as _tabulate
 
 from . import run
 from . import logme
+from . import serialize
 from . import ClusterError
 
 __all__ = ['option_help']
@@ -62,6 +62,23 @@ COMMON  = OrderedDict([
     ('imports',
      {'help': 'Imports to be used in function calls (e.g. sys, os)',
       'default': None, 'type': list}),
+    ('compress',
+     {'help': 'Compress function pickles with gzip, bz2, lzma, zstd, or lz4',
+      'default': None, 'type': str}),
+    ('memo',
+     {'help': 'Reuse the stored result of an identical earlier function job',
+      'default': None, 'type': bool}),
+    ('retries',
+     {'help': 'Resubmit up to this many times on timeout, out of memory, ' +
+              'or node failure',
+      'default': 0, 'type': int}),
+    ('retry_scale',
+     {'help': 'Multiply time (on timeout) or mem (out of memory) by this ' +
+              'on each retry',
+      'default': 2.0, 'type': float}),
+    ('retry_backoff',
+     {'help': 'Seconds to wait before the first retry, doubles each retry',
+      'default': 30, 'type': int}),
     ('scriptpath',
      {'help': 'Folder to write cluster script files to, must be accessible ' +
               'to the compute nodes.',
@@ -92,6 +109,12 @@ NORMAL  = OrderedDict([
     ('threads',
      {'help': 'Number of threads to use on the local machine',
       'default': 4, 'type': int}),
+    ('priority',
+     {'help': 'Priority in the local queue, higher numbers run first',
+      'default': 0, 'type': int}),
+    ('executor',
+     {'help': "Run local jobs in a worker 'process' or a 'thread' here",
+      'default': 'process', 'type': str}),
 ])
 
 # Options used in both torque and slurm
@@ -322,6 +345,24 @@ def check_arguments(kwargs):
                                    'or a fragment of that (e.g. MM:SS) ' +
                                    'it is formatted as {}'.format(opt))
 
+        elif arg == 'compress':
+            opt = opt.lower() if opt else None
+            if opt in (None, '', 'none', 'false', '0'):
+                opt = None
+            elif opt == 'true':
+                opt = serialize.DEFAULT_CODEC
+            elif opt not in serialize.CODECS:
+                raise OptionsError('compress must be one of {}, is {}'
+                                   .format(', '.join(serialize.CODECS), opt))
+            new_kwds[arg] = opt
+
+        elif arg == 'executor':
+            opt = opt.lower() if opt else 'process'
+            if opt not in ('process', 'thread'):
+                raise OptionsError("executor must be 'process' or 'thread', "
+                                   'is {}'.format(opt))
+            new_kwds[arg] = opt
+
         # Force memory into an integer of megabytes
         elif arg == 'mem' and isinstance(opt, str):
             if opt.isdigit():
@@ -371,8 +412,8 @@ def option_to_string(option, value=None, qtype=None):
     """
     # Import a couple of queue functions here
     from . import queue
-    qtype = qtype if qtype else queue.MODE
     queue.check_queue(qtype)
+    qtype = qtype if qtype else queue.MODE
 
     if isinstance(option, dict):
         raise ValueError('Arguments to option_to_string cannot be '
@@ -447,10 +488,10 @@ def options_to_string(option_dict, qtype=None):
 
     option_dict = check_arguments(option_dict.copy())
 
-    qtype = qtype if qtype else queue.MODE
-
     queue.check_queue(qtype)
 
+    qtype = qtype if qtype else queue.MODE
+
     outlist = []
 
     # Handle cores separately
@@ -502,6 +543,8 @@ def option_help(mode='string', qtype=None, tablefmt='simple'):
     Returns:
         str: A formatted string
     """
+    # tabulate imports numpy if it can, so only load it here
+    from tabulate import tabulate as _tabulate
 
     hlp = OrderedDict()
 
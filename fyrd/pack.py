@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Pack many small function calls into a few cluster jobs.
+
+Submitting thousands of jobs that each run for a few seconds wastes most of
+the time in the scheduler and in starting python. `submit_packed()` instead
+groups the calls into tasks of a few `PackedJob` objects, each a single
+cluster job whose runner script calls the function once per task, in sequence
+or across the job's cores with multiprocessing.
+
+Each job appends the result of every task to a task file as soon as it
+finishes (see `serialize.read_tasks()`), so if a job is killed or some tasks
+raise, the results of all completed tasks are kept, and a resubmitted job
+(e.g. with ``retries=2``) only runs the tasks that are missing.
+
+`submit_packed()` returns one `Task` handle per call, in order::
+
+    tasks = fyrd.submit_packed(analyze, range(10000), tasks_per_job=500,
+                               cores=8)
+    results = [task.get() for task in tasks]
+"""
+import os as _os
+
+from . import logme     as _logme
+from . import serialize as _serialize
+from . import ClusterError as _ClusterError
+from .job import Job as _Job
+from .submission_scripts import Function as _Function
+
+__all__ = ['submit_packed', 'PackedJob', 'Task']
+
+# Used if neither tasks_per_job nor target_runtime are given
+TASKS_PER_JOB = 100
+
+
+###############################################################################
+#                              Packed Job Class                               #
+###############################################################################
+
+
+class PackedJob(_Job):
+
+    """A single cluster job that runs a function once for each of many tasks.
+
+    Attributes:
+        tasks (list):     (index, args, kwargs) for every task.
+        task_file (str):  The file the runner writes task results to.
+    """
+
+    _resubmitting = False
+
+    def __init__(self, function, tasks, name=None, **kwds):
+        """Create the job.
+
+        Args:
+            function (callable): The function to run.
+            tasks (list):        A list of (index, args, kwargs), index must be
+                                 a unique non-negative integer.
+            name (str):          Optional name of the job.
+
+            *All other keywords are passed to Job, cores sets the number of
+            tasks run at once.*
+        """
+        self.tasks    = list(tasks)
+        self._results = None
+        super(PackedJob, self).__init__(function, name=name, **kwds)
+        if self.memo:
+            _logme.log('memo is not supported for packed jobs, ignoring',
+                       'warn')
+            self.memo = False
+        self.task_file = self.function.task_file
+
+    def _make_function(self, script_file, function, args, kwargs,
+                       compress):
+        """Return a Function script that runs all tasks."""
+        return _Function(
+            file_name=script_file, function=function, tasks=self.tasks,
+            task_file=self.outfile + '.tasks', cores=self.cores,
+            outfile=self.poutfile, imports=self.imports, compress=compress,
+            suffix=self._suffix,
+            blob_dir=_os.path.join(self.scriptpath, _serialize.BLOB_DIR)
+        )
+
+    def _runs_in_process(self):
+        """Packed jobs always use the runner script, which runs the tasks."""
+        return False
+
+    def results(self):
+        """Wait for the job and return the results of all completed tasks.
+
+        Returns:
+            dict: {task index: result or Exception}, tasks that did not
+                  complete are missing.
+        """
+        if self._results is not None:
+            return self._results
+        self.wait()
+        results = _serialize.read_tasks(self.task_file)
+        if self.done:
+            self._results = results
+        return results
+
+    def resubmit(self):
+        """Resubmit, tasks already in the task file are not run again."""
+        self._results      = None
+        self._resubmitting = True
+        try:
+            return super(PackedJob, self).resubmit()
+        finally:
+            self._resubmitting = False
+
+    def clean(self, delete_outputs=None, get_outputs=True):
+        """Delete all scripts, and the task file if delete_outputs."""
+        super(PackedJob, self).clean(delete_outputs, get_outputs)
+        if delete_outputs is None:
+            delete_outputs = self.clean_outputs
+        if delete_outputs and not self._resubmitting \
+                and _os.path.isfile(self.task_file):
+            _logme.log('Deleting {}'.format(self.task_file), 'debug')
+            _os.remove(self.task_file)
+
+
+class Task(object):
+
+    """A handle on one function call in a PackedJob."""
+
+    def __init__(self, job, index):
+        """Store the job and the index of the task in it."""
+        self.job   = job
+        self.index = index
+
+    def wait(self):
+        """Block until the job running this task completes."""
+        return self.job.wait()
+
+    @property
+    def done(self):
+        """True if the job running this task has completed."""
+        return self.job.done
+
+    def get(self):
+        """Block until the task completes and return its result.
+
+        Raises:
+            ClusterError: If the job finished without running the task.
+            Exception:    Any exception raised by the task.
+        """
+        results = self.job.results()
+        if self.index not in results:
+            raise _ClusterError('Task {} did not complete in job {} ({})'
+                                .format(self.index, self.job.name,
+                                        self.job.id))
+        out = results[self.index]
+        if isinstance(out, Exception):
+            raise out
+        return out
+
+    def __repr__(self):
+        """Task and job."""
+        return 'Task<{}:job:{}>'.format(self.index, self.job.name)
+
+
+###############################################################################
+#                                 Submission                                  #
+###############################################################################
+
+
+def submit_packed(function, arg_iter, tasks_per_job=None, target_runtime=None,
+                  task_runtime=None, kwargs=None, name=None, **kwds):
+    """Submit one call of function per item of arg_iter, packed into jobs.
+
+    Args:
+        function (callable):  The function to run.
+        arg_iter (iterable):  Arguments for each call, a tuple is passed as
+                              the positional arguments, anything else as the
+                              only argument.
+        tasks_per_job (int):  Number of calls per job.
+        target_runtime (int): Instead of tasks_per_job, aim for jobs that run
+                              for this many seconds, requires task_runtime.
+        task_runtime (int):   Estimated seconds per call.
+        kwargs (dict):        Keyword arguments for every call.
+        name (str):           Base name for the jobs.
+
+        *All other keywords are passed to every PackedJob, cores sets the
+        number of calls run at once in each job.*
+
+    Returns:
+        list: A Task for every call, in the order of arg_iter.
+    """
+    tasks = []
+    for index, args in enumerate(arg_iter):
+        if not isinstance(args, tuple):
+            args = (args,)
+        tasks.append((index, args, kwargs))
+    if not tasks_per_job:
+        if target_runtime and task_runtime:
+            cores = int(kwds.get('cores', 1) or 1)
+            tasks_per_job = max(1, int(target_runtime*cores//task_runtime))
+        elif target_runtime:
+            raise _ClusterError('target_runtime requires task_runtime, the '
+                                'estimated runtime of one call')
+        else:
+            tasks_per_job = TASKS_PER_JOB
+    tasks_per_job = int(tasks_per_job)
+    name = name if name else getattr(function, '__name__', 'task')
+    _logme.log('Packing {} calls into jobs of {}'.format(
+        len(tasks), tasks_per_job), 'debug')
+    handles = []
+    for count, start in enumerate(range(0, len(tasks), tasks_per_job)):
+        chunk = tasks[start:start+tasks_per_job]
+        job = PackedJob(function, chunk, name='{}_pack{}'.format(name, count),
+                        **kwds)
+        job.submit()
+        handles += [Task(job, index) for index, _, _ in chunk]
+    return handles
@@ -26,6 +26,7 @@ The default cluster environment is also defined in this file as MODE, it can be
 set directly or with the get_cluster_environment() function definied here.
 """
 import re
+import os
 import sys
 import pwd      # Used to get usernames for queue
 import socket   # Used to get the hostname
@@ -59,14 +60,15 @@ from . import ALLOWED_MODES
 from . import local
 
 # Funtions to import if requested
-__all__ = ['Queue', 'wait', 'check_queue', 'get_cluster_environment']
-
-# We only need the queue defaults
-_defaults = conf.get_option('queue')
+__all__ = ['Queue', 'wait', 'check_queue', 'get_cluster_environment',
+           'get_queue']
 
 # This is set in the get_cluster_environment() function.
 MODE = ''
 
+# Queues shared by all jobs, see get_queue()
+_QUEUES = {}
+
 # Define torque-to-slurm mappings
 TORQUE_SLURM_STATES = {
     'C': 'completed',
@@ -83,8 +85,8 @@ TORQUE_SLURM_STATES = {
 GOOD_STATES      = ['complete', 'completed', 'special_exit']
 ACTIVE_STATES    = ['configuring', 'completing', 'pending',
                     'running']
-BAD_STATES       = ['boot_fail', 'cancelled', 'failed',
-                    'node_fail', 'timeout']
+BAD_STATES       = ['boot_fail', 'cancelled', 'failed', 'deadline',
+                    'node_fail', 'oom', 'out_of_memory', 'timeout']
 UNCERTAIN_STATES = ['hold', 'preempted', 'stopped',
                     'suspended']
 ALL_STATES = GOOD_STATES + ACTIVE_STATES + BAD_STATES + UNCERTAIN_STATES
@@ -205,8 +207,9 @@ class Queue(object):
                                    'is {}'.format(type(job)))
 
         # Wait for 0.1 second before checking, as jobs take a while to be
-        # queued sometimes
-        sleep(0.1)
+        # queued sometimes, the local queue acknowledges every submission
+        if self.qtype != 'local':
+            sleep(0.1)
         for job in jobs:
             logme.log('Checking {}'.format(job), 'debug')
             qtype = job.qtype if isinstance(job, self._Job) else self.qtype
@@ -218,11 +221,17 @@ class Queue(object):
                     job = int(job)
                 except TypeError:
                     raise TypeError('Job must be a Job object or job #.')
-                if not local.JQUEUE \
+                if local.JQUEUE is None \
                         or not local.JQUEUE.runner.is_alive():
                     raise ClusterError('Cannot wait on job ' + str(job) +
                                        'JobQueue does not exist')
                 local.JQUEUE.wait(job)
+                # The job is done, don't wait for the next scheduled update
+                self.update(max_age=0)
+                if self.jobs[job].state in BAD_STATES:
+                    logme.log('Job {} failed with state {}'
+                              .format(job, self.jobs[job].state), 'error')
+                    return False
             else:
                 logme.log('Job is in remote queue', 'debug')
                 if isinstance(job, self._Job):
@@ -333,9 +342,17 @@ class Queue(object):
             count -= 1
             sleep(self.sleep_len)
 
-    def update(self):
-        """Refresh the list of jobs from the server, limit queries."""
-        if int(time()) - self.last_update > self.queue_update_time:
+    def update(self, max_age=None):
+        """Refresh the list of jobs from the server, limit queries.
+
+        Args:
+            max_age (float): Only query the server if the current snapshot is
+                             older than this many seconds, defaults to the
+                             queue_update config option. 0 forces a query.
+        """
+        if max_age is None:
+            max_age = self.queue_update_time
+        if time() - self.last_update >= max_age:
             self._update()
         else:
             logme.log('Skipping update as last update too recent', 'debug')
@@ -420,16 +437,13 @@ class Queue(object):
         if self._updating:
             return
         logme.log('Queue updating', 'debug')
-        # Set the update time I don't care about microseconds
-        self.last_update = int(time())
+        self.last_update = time()
 
         jobs = []  # list of jobs created this session
 
         # Mode specific initialization
         if self.qtype == 'local':
-            if not local.JQUEUE or not local.JQUEUE.runner.is_alive():
-                local.JQUEUE = local.JobQueue(cores=local.THREADS)
-            for job_id, job_info in local.JQUEUE:
+            for job_id, job_info in local.get_queue(local.THREADS):
                 if job_id in self.jobs:
                     job = self.jobs[job_id]
                 else:
@@ -441,7 +455,8 @@ class Queue(object):
                 if job_info.state == 'Not Submitted':
                     job.state = 'pending'
                 elif job_info.state == 'waiting' \
-                        or job_info.state == 'submitted':
+                        or job_info.state == 'submitted' \
+                        or job_info.state == 'queued':
                     job.state = 'pending'
                 elif job_info.state == 'started' \
                         or job_info.state == 'running':
@@ -449,6 +464,9 @@ class Queue(object):
                 elif job_info.state == 'done':
                     job.state = 'completed'
                     job.exitcode = int(job_info.exitcode)
+                elif job_info.state == 'cancelled':
+                    # A dependency failed
+                    job.state = 'cancelled'
                 else:
                     raise Exception('Unrecognized state')
 
@@ -910,6 +928,32 @@ def check_queue(qtype=None):
                            'should be: local, torque, or slurm')
 
 
+###################
+#  Shared Queues  #
+###################
+
+
+def get_queue(qtype=None, user='self'):
+    """Return a Queue shared by all callers in this process.
+
+    All Job objects get their state from this queue, so however many jobs are
+    checked the server is only queried once every queue_update seconds.
+
+    Args:
+        qtype (str): 'torque', 'slurm', or 'local', defaults to MODE.
+        user (str):  The user to filter the queue with.
+
+    Returns:
+        Queue: The shared queue.
+    """
+    check_queue(qtype)
+    qtype = qtype if qtype else MODE
+    key = (qtype, user, os.getpid())
+    if key not in _QUEUES:
+        _QUEUES[key] = Queue(user=user, qtype=qtype)
+    return _QUEUES[key]
+
+
 ######################################################################
 #  Expose the Queue waiting method without requiring a Queue object  #
 ######################################################################
@@ -943,7 +987,7 @@ def wait(jobs):
                 job = int(job)
             except TypeError:
                 raise TypeError('Job must be a Job object or job #.')
-            if not local.JQUEUE or not local.JQUEUE.runner.is_alive():
+            if local.JQUEUE is None or not local.JQUEUE.runner.is_alive():
                 raise ClusterError('Cannot wait on job ' + str(job) +
                                    'JobQueue does not exist')
             local.JQUEUE.wait(job)
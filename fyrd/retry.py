@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Resubmit jobs that fail because of their resources.
+
+A job submitted with ``retries=N`` is resubmitted up to N times if it fails in
+a way that asking for more resources (or simply trying again) can fix:
+
+- timeout:       the walltime ran out, time is multiplied by retry_scale.
+- out_of_memory: the memory limit was hit, mem is multiplied by retry_scale.
+- limit:         a resource limit was hit but the queue doesn't say which,
+                 both are multiplied.
+- node_fail, boot_fail, preempted: the node failed, resubmitted unchanged.
+
+Any other failure (e.g. a non-zero exit code) is a bug in the job and is not
+retried. Before each resubmission the job sleeps for retry_backoff seconds,
+doubling with every attempt.
+
+The failure is classified from the final job state reported by the queue. In
+slurm that state is taken from sacct where possible, as jobs often leave
+squeue before their final state is seen. In torque it comes from the exit
+code, which is negative for jobs killed by the server.
+"""
+from . import run     as _run
+from . import logme   as _logme
+from . import options as _options
+
+__all__ = ['RetryPolicy', 'failure_reason']
+
+###############################################################################
+#                                  Constants                                  #
+###############################################################################
+
+SCALE = 2.0
+"""Default multiplier for time and mem."""
+
+BACKOFF = 30
+"""Default seconds to wait before the first resubmission."""
+
+ESCALATE = {
+    'timeout':       ('time',),
+    'out_of_memory': ('mem',),
+    'limit':         ('time', 'mem'),
+}
+"""Failures fixed with more resources: the options to scale."""
+
+TRANSIENT = ('node_fail', 'boot_fail', 'preempted')
+"""Failures of the cluster rather than the job, retried unchanged."""
+
+# slurm states (from squeue or sacct) that map to a different reason
+SLURM_STATES = {
+    'oom':      'out_of_memory',
+    'deadline': 'timeout',
+}
+
+# Torque exit codes from the server when it kills a job (JOB_EXEC_*)
+TORQUE_CODES = {
+    -10: 'out_of_memory',  # JOB_EXEC_OVERLIMIT_MEM
+    -11: 'timeout',        # JOB_EXEC_OVERLIMIT_WT
+    -12: 'limit',          # JOB_EXEC_OVERLIMIT_CPUT
+}
+
+
+###############################################################################
+#                              The Retry Policy                               #
+###############################################################################
+
+
+class RetryPolicy(object):
+
+    """How many times, and with how many more resources, to resubmit a job."""
+
+    def __init__(self, retries=0, scale=None, backoff=None):
+        """Set the policy.
+
+        Args:
+            retries (int):   Maximum number of resubmissions.
+            scale (float):   Multiply time and/or mem by this on each
+                             resource failure.
+            backoff (int):   Seconds to wait before the first resubmission,
+                             doubled for each later one.
+        """
+        self.retries = int(retries) if retries else 0
+        self.scale   = float(scale) if scale is not None else SCALE
+        self.backoff = float(backoff) if backoff is not None else BACKOFF
+        if self.scale < 1:
+            raise _options.OptionsError('retry_scale must be at least 1, '
+                                        'is {}'.format(self.scale))
+
+    def can_retry(self, reason, attempt):
+        """Return True if a job that failed with reason can be resubmitted.
+
+        Args:
+            reason (str):  From `failure_reason()`.
+            attempt (int): The number of resubmissions already made.
+        """
+        if attempt >= self.retries:
+            return False
+        return reason in ESCALATE or reason in TRANSIENT
+
+    def delay(self, attempt):
+        """Return seconds to wait before resubmission number attempt (1+)."""
+        return self.backoff * 2**(attempt-1)
+
+    def escalate(self, kwds, reason):
+        """Return a copy of the job keywords with more resources for reason.
+
+        Args:
+            kwds (dict):  Job keyword arguments, must already be parsed by
+                          `options.check_arguments()`.
+            reason (str): From `failure_reason()`.
+
+        Returns:
+            dict: New keyword arguments.
+        """
+        kwds = kwds.copy()
+        for opt in ESCALATE.get(reason, ()):
+            if opt not in kwds or not kwds[opt]:
+                continue
+            if opt == 'time':
+                kwds[opt] = scale_time(kwds[opt], self.scale)
+            else:
+                kwds[opt] = scale_mem(kwds[opt], self.scale)
+            _logme.log('Increasing {} to {}'.format(opt, kwds[opt]), 'info')
+        return kwds
+
+    def __repr__(self):
+        """Display the policy."""
+        return 'RetryPolicy<retries:{};scale:{};backoff:{}>'.format(
+            self.retries, self.scale, self.backoff)
+
+
+###############################################################################
+#                           Failure Classification                            #
+###############################################################################
+
+
+def failure_reason(job):
+    """Return why a finished job failed.
+
+    Args:
+        job (Job): A completed or failed job.
+
+    Returns:
+        str: A key of ESCALATE, one of TRANSIENT, another (lowercase) queue
+             state, or None if the job did not fail.
+    """
+    info  = job.queue_info
+    state = info.state if info and info.state else None
+    if job.qtype == 'slurm':
+        state = sacct_state(job.id) or state
+        if state:
+            state = SLURM_STATES.get(state, state)
+    elif job.qtype == 'torque':
+        code = getattr(info, 'exitcode', None)
+        if code in TORQUE_CODES:
+            return TORQUE_CODES[code]
+    if state in ('complete', 'completed'):
+        return None
+    return state
+
+
+def sacct_state(job_id):
+    """Return the final state of a slurm job from sacct, None if unknown."""
+    if not job_id:
+        return None
+    code, stdout, _ = _run.cmd(['sacct', '-j', str(job_id), '-X', '-n', '-P',
+                                '-o', 'State'])
+    if code != 0 or not stdout.strip():
+        return None
+    # States can have suffixes, e.g. 'CANCELLED by 1000'
+    return stdout.strip().split('\n')[0].split(' ')[0].lower()
+
+
+def scale_time(time, scale):
+    """Multiply a walltime string by scale, returns HH:MM:SS."""
+    time = _options.check_arguments({'time': time})['time']
+    hours, mins, secs = [int(i) for i in time.split(':')]
+    secs = int(((hours*60 + mins)*60 + secs)*scale)
+    return '{}:{}:{}'.format(str(secs//3600).rjust(2, '0'),
+                             str(secs//60 % 60).rjust(2, '0'),
+                             str(secs % 60).rjust(2, '0'))
+
+
+def scale_mem(mem, scale):
+    """Multiply memory (int MB or a string like 4GB) by scale, returns MB."""
+    mem = _options.check_arguments({'mem': mem})['mem']
+    return int(int(mem)*scale)
@@ -381,6 +381,14 @@ FUNC_RUNNER = r"""\
 '''
 Run a function remotely and pickle the result.
 
+Usage: <script> pickle_file out_file [--compress codec] [--tasks task_file
+[--cores n]] [--blobs blob_dir]
+
+The same script is used for every job running this function, only the pickle
+files given on the command line differ. The function and large arguments may
+be references to a blob store shared by many jobs, each blob is copied once to
+a private folder in node-local scratch ($TMPDIR) and loaded from there.
+
 To try and make this as resistent to failure as possible, we import everything
 we can, this sometimes results in duplicate imports and always results in
 unnecessary imports, but given the context we don't care, as we just want the
@@ -388,7 +396,13 @@ thing to run successfully on the first try, no matter what.
 '''
 import os
 import sys
+import mmap
 import socket
+import shutil
+import tempfile
+import struct
+import argparse
+import multiprocessing
 from subprocess import Popen, PIPE
 # Try to use dill, revert to pickle if not found
 try:
@@ -398,6 +412,23 @@ except ImportError:
         import cPickle as pickle # For python2
     except ImportError:
         import pickle
+import pickle as stdpickle
+
+# Must match fyrd.serialize
+OOB_MARK      = '{oob_mark}'
+OOB_MIN_SIZE  = {oob_min_size}
+BUFFER_SUFFIX = '{buffer_suffix}'
+ALIGN         = {align}
+CODECS        = {codecs}
+COMPRESS      = ''
+BLOB_MARK     = '{blob_mark}'
+BLOB_DIR      = ''
+
+# Packed tasks, must match fyrd.serialize
+TASK_FILE     = ''
+TASK_CORES    = 1
+TASK_HEADER   = struct.Struct('{task_header}')
+TASK_FUNCTION = None
 
 out = None
 try:
@@ -422,6 +453,137 @@ Then, submit a job to the compute nodes with this command::
 '''
 
 
+def open_codec(file_name, mode, codec):
+    '''Open a file with a compression codec, the fallback is gzip.'''
+    if not codec:
+        return open(file_name, mode)
+    try:
+        module = __import__(CODECS[codec][0], fromlist=['open'])
+    except ImportError:
+        module = __import__('gzip')
+    return getattr(module, 'open', getattr(module, 'BZ2File', None))(
+        file_name, mode
+    )
+
+
+def read_pickle(file_name, writable=False):
+    '''Load a pickle, memory mapping any out-of-band buffers.'''
+    with open(file_name, 'rb') as fin:
+        head = fin.read(8)
+    codec = None
+    for name, (_, magic) in CODECS.items():
+        if head.startswith(magic):
+            codec = name
+    with open_codec(file_name, 'rb', codec) as fin:
+        obj = pickle.load(fin)
+    if not (isinstance(obj, tuple) and len(obj) == 3 and obj[0] == OOB_MARK):
+        return obj
+    layout, payload = obj[1:]
+    with open(file_name + BUFFER_SUFFIX, 'rb') as fin:
+        access = mmap.ACCESS_COPY if writable else mmap.ACCESS_READ
+        data = memoryview(mmap.mmap(fin.fileno(), 0, access=access))
+    return pickle.loads(payload, buffers=[data[i:i+j] for i, j in layout])
+
+
+def write_pickle(obj, file_name):
+    '''Pickle obj, writing large buffers to a sidecar file.'''
+    if os.path.isfile(file_name + BUFFER_SUFFIX):
+        os.remove(file_name + BUFFER_SUFFIX)
+    if COMPRESS:
+        with open_codec(file_name, 'wb', COMPRESS) as fout:
+            pickle.dump(obj, fout)
+        return
+    buffers = []
+    def in_band(buf):
+        with buf.raw() as view:
+            if view.nbytes < OOB_MIN_SIZE:
+                return True
+        buffers.append(buf)
+        return False
+    payload = None
+    if stdpickle.HIGHEST_PROTOCOL >= 5:
+        try:
+            payload = stdpickle.dumps(obj, protocol=5, buffer_callback=in_band)
+        except Exception:
+            buffers = []
+            payload = None
+    if not buffers:
+        with open(file_name, 'wb') as fout:
+            if payload is not None:
+                fout.write(payload)
+            else:
+                pickle.dump(obj, fout)
+        return
+    layout = []
+    offset = 0
+    with open(file_name + BUFFER_SUFFIX, 'wb') as fout:
+        for buf in buffers:
+            with buf.raw() as view:
+                pad = -offset % ALIGN
+                fout.write(b'\0'*pad)
+                offset += pad
+                fout.write(view)
+                layout.append((offset, view.nbytes))
+                offset += view.nbytes
+    with open(file_name, 'wb') as fout:
+        stdpickle.dump((OOB_MARK, layout, payload), fout, protocol=2)
+
+
+def private_dir(directory):
+    '''Create directory if needed, return True if only this user can use it.'''
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError:
+        pass  # Already exists
+    try:
+        stat = os.lstat(directory)
+    except OSError:
+        return False
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0o077 \
+        and os.path.isdir(directory) and not os.path.islink(directory)
+
+
+def fetch_blob(key):
+    '''Copy a blob to node-local scratch if needed, return the local file.'''
+    source = os.path.join(BLOB_DIR, key[:2], key)
+    # Cached blobs are unpickled, so others must not be able to place them,
+    # this is the same directory as fyrd.local.user_dir()
+    user   = os.path.join(tempfile.gettempdir(),
+                          'fyrd-{{}}'.format(os.getuid()))
+    cache  = os.path.join(user, 'blobs')
+    local  = os.path.join(cache, key)
+    if not private_dir(user) or not private_dir(cache):
+        return source
+    if os.path.isfile(local):
+        return local
+    try:
+        # Sidecar first, the pickle only exists once the blob is complete
+        for suffix in [BUFFER_SUFFIX, '']:
+            if os.path.isfile(source + suffix):
+                tmp = '{{}}{{}}.{{}}.tmp'.format(local, suffix, os.getpid())
+                shutil.copyfile(source + suffix, tmp)
+                os.rename(tmp, local + suffix)
+    except (IOError, OSError):
+        # Scratch is full or not writable, read from the shared store
+        return source
+    return local
+
+
+def resolve_blobs(obj):
+    '''Load obj, or the items of a tuple, list or dict, from the blobs.'''
+    def load(item):
+        if isinstance(item, tuple) and len(item) == 2 \
+                and item[0] == BLOB_MARK:
+            return read_pickle(fetch_blob(item[1]), writable=True)
+        return item
+    if isinstance(obj, dict):
+        return dict((k, load(v)) for k, v in obj.items())
+    if isinstance(obj, (tuple, list)) and not (len(obj) == 2 and
+                                               obj[0] == BLOB_MARK):
+        return type(obj)(load(i) for i in obj)
+    return load(obj)
+
+
 def run_function(func_c, args=None, kwargs=None):
     '''Run a function with arglist and return output.'''
     if not hasattr(func_c, '__call__'):
@@ -444,26 +606,123 @@ def run_function(func_c, args=None, kwargs=None):
     return ot
 
 
+def read_task_indices(file_name):
+    '''Return the indices of tasks in the task file and its valid length.'''
+    indices = set()
+    end     = 0
+    if not os.path.isfile(file_name):
+        return indices, end
+    with open(file_name, 'rb') as fin:
+        while True:
+            head = fin.read(TASK_HEADER.size)
+            if len(head) < TASK_HEADER.size:
+                break
+            index, length = TASK_HEADER.unpack(head)
+            if len(fin.read(length)) < length:
+                break
+            indices.add(index)
+            end = fin.tell()
+    return indices, end
+
+
+def set_task_function(payload):
+    '''Load the function run by run_task in a pool worker.'''
+    global TASK_FUNCTION
+    TASK_FUNCTION = pickle.loads(payload)
+
+
+def run_task(task):
+    '''Run one packed task, return (index, output or exception).'''
+    index, args, kwargs = task
+    try:
+        return index, run_function(TASK_FUNCTION, args, kwargs)
+    except Exception as e:
+        return index, e
+
+
+def run_tasks(func_c, tasks):
+    '''Run packed tasks, appending each result to the task file.
+
+    Tasks already in the file (from an earlier attempt) are skipped, returns
+    the number of tasks that raised an exception.
+    '''
+    global TASK_FUNCTION
+    TASK_FUNCTION = func_c
+    done, end = read_task_indices(TASK_FILE)
+    tasks = [task for task in tasks if task[0] not in done]
+    pool  = None
+    if TASK_CORES > 1 and len(tasks) > 1:
+        # Workers do not inherit TASK_FUNCTION with the spawn or forkserver
+        # start methods, and may not be able to import it
+        pool    = multiprocessing.Pool(min(TASK_CORES, len(tasks)),
+                                       set_task_function,
+                                       (pickle.dumps(func_c),))
+        results = pool.imap_unordered(run_task, tasks)
+    else:
+        results = (run_task(task) for task in tasks)
+    failed = 0
+    with open(TASK_FILE, 'ab') as fout:
+        # Drop any partly written record left by a killed attempt
+        fout.truncate(end)
+        for index, result in results:
+            try:
+                payload = pickle.dumps(result)
+            except Exception as e:
+                payload = pickle.dumps(e)
+            if isinstance(result, Exception):
+                failed += 1
+            fout.write(TASK_HEADER.pack(index, len(payload)) + payload)
+            fout.flush()
+    if pool:
+        pool.close()
+        pool.join()
+    return failed
+
+
+def parse_args(argv=None):
+    '''Parse the pickle and task file arguments.'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pickle_file')
+    parser.add_argument('out_file')
+    parser.add_argument('--compress', default='')
+    parser.add_argument('--tasks', default='')
+    parser.add_argument('--cores', type=int, default=1)
+    parser.add_argument('--blobs', default='')
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
+    opts = parse_args()
+    COMPRESS   = opts.compress
+    TASK_FILE  = opts.tasks
+    TASK_CORES = opts.cores
+    BLOB_DIR   = opts.blobs
+
     # If an Exception was raised during import, skip this
     if not out:
-        with open('{pickle_file}', 'rb') as fin:
-            # Try to install packages first
-            try:
-                function_call, args, kwargs = pickle.load(fin)
-            except ImportError as e:
-                module = str(e).split(' ')[-1]
-                node   = socket.gethostname()
-                sys.stderr.write(ERR_MESSAGE.format(module))
-                out = ImportError(('Module {{}} is not installed on compute '
-                                   'node {{}}').format(module, node))
+        # Try to install packages first
+        try:
+            function_call, args, kwargs = read_pickle(opts.pickle_file,
+                                                      writable=True)
+            if BLOB_DIR:
+                function_call = resolve_blobs(function_call)
+                args, kwargs  = resolve_blobs(args), resolve_blobs(kwargs)
+            if isinstance(function_call, bytes):
+                function_call = pickle.loads(function_call)
+        except ImportError as e:
+            module = str(e).split(' ')[-1]
+            node   = socket.gethostname()
+            sys.stderr.write(ERR_MESSAGE.format(module))
+            out = ImportError(('Module {{}} is not installed on compute '
+                               'node {{}}').format(module, node))
 
     try:
-        if not out:
+        if not out and TASK_FILE:
+            out = run_tasks(function_call, args)
+        elif not out:
             out = run_function(function_call, args, kwargs)
     except Exception as e:
         out = e
 
-    with open('{out_file}', 'wb') as fout:
-        pickle.dump(out, fout)
+    write_pickle(out, opts.out_file)
 """
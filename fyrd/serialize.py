@@ -0,0 +1,612 @@
+# -*- coding: utf-8 -*-
+"""
+Read and write the pickle files used to pass functions and their results.
+
+Function jobs pass their input ``(function, args, kwargs)`` and their output
+through pickle files on the shared filesystem. To avoid copying large arrays
+several times, buffers larger than `OOB_MIN_SIZE` (e.g. the data of a numpy
+array or of the blocks of a pandas DataFrame) are written *out-of-band* with
+pickle protocol 5 into a raw sidecar file (the pickle file name plus
+`BUFFER_SUFFIX`). The pickle itself then only holds the object structure and
+the layout of the sidecar.
+
+When loading with ``mmap=True`` the sidecar is memory mapped read-only, so
+arrays are reconstructed with zero copies and pages are only read from disk
+when they are actually touched.
+
+Alternatively the pickles can be compressed with any codec in `CODECS`
+(``compress='gzip'`` etc.), which is worthwhile when the shared filesystem
+rather than the CPU is the bottleneck. Compressed pickles are a single stream
+with no sidecar, so they cannot be memory mapped. The codec is recognized from
+the magic bytes at the start of the file when loading, so a file can always
+be read whatever codec it was written with.
+
+Packed jobs (see `fyrd.pack`) write the results of many tasks to a single task
+file, a sequence of records each holding a `TASK_HEADER` (the task index and
+the payload length) followed by the pickled result. Records are appended and
+flushed as each task finishes, so a reader stops cleanly at a record cut short
+by a killed job and keeps every task before it.
+
+Arguments shared by many jobs (e.g. a large lookup table) and the function
+itself can be written once to a content-addressed `BlobStore`, a directory of
+pickles named by the sha256 of their contents. The job pickle then only holds
+a small reference (`BLOB_MARK`, key) in place of the object, and the runner
+copies each blob to node-local scratch once and loads it from there. Storing a
+blob again marks it as used, and `BlobStore.prune()` deletes the blobs that
+were not used for longest.
+
+The same logic is inlined in the function runner script (`run.FUNC_RUNNER`),
+as fyrd may not be installed on the compute nodes, so the two must be kept in
+sync.
+"""
+import os    as _os
+import mmap  as _mmap
+import hashlib as _hashlib
+import struct as _struct
+import pickle as _stdpickle
+from time import time as _time
+from importlib import import_module as _import_module
+from collections import OrderedDict as _OrderedDict
+
+# Try to use dill, revert to pickle if not found
+try:
+    import dill as _pickle
+except ImportError:
+    try:
+        import cPickle as _pickle # For python2
+    except ImportError:
+        import pickle as _pickle
+
+from . import logme as _logme
+
+__all__ = ['dump', 'load', 'remove', 'available_codecs', 'read_tasks',
+           'BlobStore']
+
+###############################################################################
+#                                  Constants                                  #
+###############################################################################
+
+OOB_PROTOCOL  = 5
+"""The pickle protocol that allows out-of-band buffers."""
+
+OOB_AVAILABLE = _stdpickle.HIGHEST_PROTOCOL >= OOB_PROTOCOL
+"""True if this python can write out-of-band buffers (python 3.8+)."""
+
+OOB_MIN_SIZE  = 1024*1024
+"""Buffers smaller than this many bytes are kept in the pickle itself."""
+
+OOB_MARK      = '__fyrd_oob__'
+"""Marks a pickle whose buffers are in a sidecar file."""
+
+BUFFER_SUFFIX = '.buf'
+"""Appended to the pickle file name to get the sidecar file name."""
+
+ALIGN         = 64
+"""Byte alignment of each buffer in the sidecar, keeps SIMD code happy."""
+
+# name: (module, magic bytes)
+CODECS = _OrderedDict([
+    ('gzip', ('gzip',      b'\x1f\x8b')),
+    ('bz2',  ('bz2',       b'BZh')),
+    ('lzma', ('lzma',      b'\xfd7zXZ\x00')),
+    ('zstd', ('zstandard', b'\x28\xb5\x2f\xfd')),
+    ('lz4',  ('lz4.frame', b'\x04\x22\x4d\x18')),
+])
+"""Compression codecs, the first three are in the standard library."""
+
+DEFAULT_CODEC = 'gzip'
+"""Used if the requested codec is not installed."""
+
+TASK_HEADER = _struct.Struct('<QQ')
+"""Header of each record in a task file: task index, payload length."""
+
+BLOB_DIR      = 'fyrd_blobs'
+"""Name of the blob store directory in the script path."""
+
+BLOB_MARK     = '__fyrd_blob__'
+"""Marks a reference to an object in a `BlobStore`."""
+
+BLOB_MIN_SIZE = 1024*1024
+"""Arguments that pickle to fewer bytes than this stay in the job pickle."""
+
+
+###############################################################################
+#                               Core Functions                                #
+###############################################################################
+
+
+def dump(obj, file_name, oob=True, compress=None):
+    """Pickle obj to file_name, writing large buffers out-of-band.
+
+    The standard pickle module is tried first, as dill pickles numpy arrays
+    in-band, dill is used if the standard pickle fails (e.g. for lambdas).
+
+    Args:
+        obj:            Any picklable object.
+        file_name:      The path to write to.
+        oob (bool):     Write large buffers to a sidecar file if possible.
+        compress (str): Compress the pickle with this codec from `CODECS`,
+                        no sidecar is written if set.
+
+    Returns:
+        list: The files written.
+    """
+    remove(file_name, pickle_file=False)
+    if compress:
+        with open_codec(file_name, 'wb', compress) as fout:
+            try:
+                _stdpickle.dump(obj, fout, protocol=_stdpickle.HIGHEST_PROTOCOL)
+                return [file_name]
+            except Exception as err:
+                _logme.log('Pickling failed with {}, falling back to dill'
+                           .format(err), 'debug')
+        with open_codec(file_name, 'wb', compress) as fout:
+            _pickle.dump(obj, fout)
+        return [file_name]
+    return write_payload(file_name, *dumps(obj, oob))
+
+
+def dumps(obj, oob=True):
+    """Pickle obj to bytes, keeping large buffers out-of-band.
+
+    Args:
+        obj:        Any picklable object.
+        oob (bool): Take large buffers out-of-band if possible.
+
+    Returns:
+        tuple: (payload, buffers), the pickle and a list of PickleBuffers
+               that are not in it, the list is empty if oob is False or
+               nothing was large enough.
+    """
+    buffers = []
+    if oob and OOB_AVAILABLE:
+        try:
+            payload = _stdpickle.dumps(
+                obj, protocol=OOB_PROTOCOL,
+                buffer_callback=lambda b: _in_band(b, buffers)
+            )
+            return payload, buffers
+        except Exception as err:
+            _logme.log('Out-of-band pickling failed with {}, falling back '
+                       'to dill'.format(err), 'debug')
+    return _pickle.dumps(obj), []
+
+
+def dumps_function(function, by_value=False):
+    """Pickle a function on its own.
+
+    By reference if possible, and with dill otherwise, only following the
+    globals the function actually uses.
+
+    Args:
+        function (callable): The function.
+        by_value (bool):     Always use dill for functions in __main__, for
+                             loading in another program.
+
+    Returns:
+        bytes: The pickle.
+    """
+    try:
+        if by_value and getattr(function, '__module__', None) == '__main__':
+            raise ValueError('__main__ is pickled by value')
+        return _stdpickle.dumps(function)
+    except Exception:
+        try:
+            return _pickle.dumps(function, recurse=True)
+        except TypeError:  # Not dill
+            return _pickle.dumps(function)
+
+
+def dumps_call(function, args=None, kwargs=None, by_value=False):
+    """Pickle a function call in one payload, see `loads_call()`.
+
+    The function is pickled with `dumps_function()`, so it can be loaded
+    whether or not it pickles by reference.
+
+    Returns:
+        bytes: The payload.
+    """
+    payload, _ = dumps((dumps_function(function, by_value), args, kwargs),
+                       oob=False)
+    return payload
+
+
+def loads_call(payload):
+    """Load a payload from `dumps_call()`.
+
+    Returns:
+        tuple: (function, args, kwargs), args and kwargs are never None.
+    """
+    function, args, kwargs = loads(payload)
+    return loads(function), args or (), kwargs or {}
+
+
+def loads(payload, buffers=None):
+    """Unpickle a payload from `dumps()`.
+
+    Args:
+        payload (bytes): The pickle.
+        buffers (list):  The out-of-band buffers, in order, if there were any.
+
+    Returns:
+        The unpickled object.
+    """
+    if buffers:
+        return _pickle.loads(payload, buffers=buffers)
+    return _pickle.loads(payload)
+
+
+def write_payload(file_name, payload, buffers=None):
+    """Write a payload and buffers from `dumps()` to file_name.
+
+    Returns:
+        list: The files written.
+    """
+    if not buffers:
+        with open(file_name, 'wb') as fout:
+            fout.write(payload)
+        return [file_name]
+    layout = write_buffers(buffers, buffer_file(file_name))
+    with open(file_name, 'wb') as fout:
+        _stdpickle.dump((OOB_MARK, layout, payload), fout, protocol=2)
+    return [file_name, buffer_file(file_name)]
+
+
+def load(file_name, mmap=False, writable=False):
+    """Load a pickle written by `dump()`, or any ordinary pickle.
+
+    Compressed pickles are detected automatically.
+
+    Args:
+        file_name (str): The pickle file to read.
+        mmap (bool):     Memory map any out-of-band buffers instead of reading
+                         them into memory. Arrays will be backed by the file
+                         with zero copies.
+        writable (bool): If mmap, map the sidecar copy-on-write instead of
+                         read-only, so the loaded arrays can be edited in
+                         memory without touching the file.
+
+    Returns:
+        The unpickled object.
+    """
+    with open_codec(file_name, 'rb', detect_codec(file_name)) as fin:
+        obj = _pickle.load(fin)
+    if not is_oob(obj):
+        return obj
+    _, layout, payload = obj
+    buffers = read_buffers(buffer_file(file_name), layout, mmap, writable)
+    return _pickle.loads(payload, buffers=buffers)
+
+
+def remove(file_name, pickle_file=True):
+    """Delete a pickle file and its sidecar if they exist.
+
+    Args:
+        file_name (str):    The pickle file.
+        pickle_file (bool): Delete the pickle itself also, if False only the
+                            sidecar is deleted.
+
+    Returns:
+        list: The deleted files.
+    """
+    deleted = []
+    files = [buffer_file(file_name)]
+    if pickle_file:
+        files.insert(0, file_name)
+    for fl in files:
+        if _os.path.isfile(fl):
+            _logme.log('Deleting {}'.format(fl), 'debug')
+            _os.remove(fl)
+            deleted.append(fl)
+    return deleted
+
+
+###############################################################################
+#                                 Compression                                 #
+###############################################################################
+
+
+def available_codecs():
+    """Return a list of the codecs in `CODECS` that can be imported."""
+    return [i for i in CODECS if _get_module(i)]
+
+
+def get_codec(codec):
+    """Return an installed codec name for codec.
+
+    Falls back to `DEFAULT_CODEC` with a warning if codec is not installed.
+
+    Raises:
+        ValueError: If codec is not in `CODECS`.
+    """
+    if codec not in CODECS:
+        raise ValueError('Unknown compression codec {}, must be one of {}'
+                         .format(codec, list(CODECS)))
+    if _get_module(codec):
+        return codec
+    _logme.log('{} is not installed, compressing with {} instead'
+               .format(CODECS[codec][0], DEFAULT_CODEC), 'warn')
+    return DEFAULT_CODEC
+
+
+def detect_codec(file_name):
+    """Return the codec file_name was compressed with, or None."""
+    with open(file_name, 'rb') as fin:
+        head = fin.read(8)
+    for codec, (_, magic) in CODECS.items():
+        if head.startswith(magic):
+            return codec
+    return None
+
+
+def open_codec(file_name, mode='rb', codec=None):
+    """Open file_name with codec, or as a plain file if codec is None."""
+    if not codec:
+        return open(file_name, mode)
+    module = _get_module(get_codec(codec))
+    if codec == 'gzip' and 'w' in mode:
+        # Level 9 is much slower for very little gain
+        return module.open(file_name, mode, compresslevel=6)
+    return getattr(module, 'open', getattr(module, 'BZ2File', None))(
+        file_name, mode
+    )
+
+
+def _get_module(codec):
+    """Import and return the module for codec, None if not installed."""
+    try:
+        return _import_module(CODECS[codec][0])
+    except ImportError:
+        return None
+
+
+###############################################################################
+#                                 Task Files                                  #
+###############################################################################
+
+
+def read_tasks(file_name):
+    """Read every complete record in a task file.
+
+    Returns:
+        dict: {task index: result}, empty if the file does not exist.
+    """
+    results = {}
+    if not _os.path.isfile(file_name):
+        return results
+    with open(file_name, 'rb') as fin:
+        while True:
+            head = fin.read(TASK_HEADER.size)
+            if len(head) < TASK_HEADER.size:
+                break
+            index, length = TASK_HEADER.unpack(head)
+            payload = fin.read(length)
+            if len(payload) < length:
+                _logme.log('Task file {} ends with a partial record'
+                           .format(file_name), 'warn')
+                break
+            results[index] = _pickle.loads(payload)
+    return results
+
+
+def write_task(fout, index, result):
+    """Append the record for one task to an open task file."""
+    try:
+        payload = _pickle.dumps(result)
+    except Exception as err:
+        payload = _pickle.dumps(err)
+    fout.write(TASK_HEADER.pack(index, len(payload)) + payload)
+    fout.flush()
+
+
+###############################################################################
+#                                 Blob Store                                  #
+###############################################################################
+
+
+class BlobStore(object):
+
+    """Pickles stored once each, named by the sha256 of their contents.
+
+    Blobs are written as ``<path>/<key[:2]>/<key>``, with an out-of-band
+    sidecar if they have large buffers, so they can be read with `load()`.
+    Writing a blob that already exists only costs the hash, and updates its
+    modification time, which is when it was last used.
+
+    Attributes:
+        added (int): Number of new blobs written by this object.
+    """
+
+    def __init__(self, path):
+        """Set the directory, it is created on the first write."""
+        self.path  = _os.path.abspath(path)
+        self.added = 0
+
+    def file_name(self, key):
+        """Return the pickle file for key."""
+        return _os.path.join(self.path, key[:2], key)
+
+    def put(self, obj, min_size=0):
+        """Store obj if it pickles to at least min_size bytes.
+
+        Returns:
+            tuple: A reference to the blob, see `is_blob()`, or None if obj
+                   is smaller than min_size.
+        """
+        payload, buffers = dumps(obj)
+        size = len(payload) + sum(_nbytes(i) for i in buffers)
+        if size < min_size:
+            return None
+        return self.put_payload(payload, buffers)
+
+    def put_payload(self, payload, buffers=None):
+        """Store a pickled payload and buffers from `dumps()`.
+
+        Returns:
+            tuple: A reference to the blob, see `is_blob()`.
+        """
+        buffers = buffers if buffers else []
+        digest = _hashlib.sha256(payload)
+        for buf in buffers:
+            with buf.raw() as view:
+                digest.update(view)
+        key = digest.hexdigest()
+        file_name = self.file_name(key)
+        try:
+            # Used again, so it is pruned last
+            _os.utime(file_name, None)
+        except OSError:
+            _logme.log('Writing blob {}'.format(key), 'debug')
+            try:
+                _os.makedirs(_os.path.dirname(file_name))
+            except OSError:
+                pass
+            # Write under a temporary name, the sidecar is moved first, so
+            # the pickle only exists once the blob is complete
+            tmp_file = '{}.{}.tmp'.format(file_name, _os.getpid())
+            written = write_payload(tmp_file, payload, buffers)
+            for tmp in reversed(written):
+                _os.rename(tmp, file_name + tmp[len(tmp_file):])
+            self.added += 1
+        return (BLOB_MARK, key)
+
+    def get(self, ref, mmap=False):
+        """Load the object for a reference from `put()`."""
+        return load(self.file_name(ref[1]), mmap=mmap)
+
+    def prune(self, max_size=None, max_age=None):
+        """Delete the least recently used blobs.
+
+        Blobs not used in max_age days are deleted, then the least recently
+        used until the store is below max_size MB. A job that has not run yet
+        fails if its blobs are deleted, so max_age should be longer than jobs
+        wait in the queue.
+
+        Args:
+            max_size (int):   Maximum size in MB, None for no limit.
+            max_age (float):  Maximum days since a blob was last used, None
+                              for no limit.
+
+        Returns:
+            list: The keys of the deleted blobs.
+        """
+        blobs = {}  # {key: [mtime, size, files]}
+        total = 0
+        for root, _, names in _os.walk(self.path):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue  # Being written
+                fl = _os.path.join(root, name)
+                try:
+                    stat = _os.stat(fl)
+                except OSError:
+                    continue
+                key  = name[:-len(BUFFER_SUFFIX)] \
+                    if name.endswith(BUFFER_SUFFIX) else name
+                blob = blobs.setdefault(key, [0, 0, []])
+                if key == name:
+                    blob[0] = stat.st_mtime
+                blob[1] += stat.st_size
+                blob[2].append(fl)
+                total += stat.st_size
+        oldest  = _time() - max_age*86400 if max_age is not None else None
+        limit   = max_size*1024*1024 if max_size is not None else None
+        deleted = []
+        for key, (mtime, size, files) in sorted(blobs.items(),
+                                                key=lambda i: i[1][0]):
+            if (oldest is None or mtime >= oldest) and \
+                    (limit is None or total <= limit):
+                break
+            _logme.log('Pruning blob {}'.format(key), 'debug')
+            # The pickle first, so a blob is never found without its sidecar
+            for fl in sorted(files, key=len):
+                try:
+                    _os.remove(fl)
+                except OSError:
+                    pass
+            total -= size
+            deleted.append(key)
+        return deleted
+
+    def __repr__(self):
+        """The path."""
+        return 'BlobStore<{}>'.format(self.path)
+
+
+def is_blob(obj):
+    """Return True if obj is a reference to a blob."""
+    return isinstance(obj, tuple) and len(obj) == 2 and obj[0] == BLOB_MARK
+
+
+###############################################################################
+#                              Helper Functions                               #
+###############################################################################
+
+
+def buffer_file(file_name):
+    """Return the sidecar file name for a pickle file."""
+    return file_name + BUFFER_SUFFIX
+
+
+def is_oob(obj):
+    """Return True if obj is the header of an out-of-band pickle."""
+    return isinstance(obj, tuple) and len(obj) == 3 and obj[0] == OOB_MARK
+
+
+def write_buffers(buffers, file_name):
+    """Write PickleBuffers to file_name, each aligned to ALIGN bytes.
+
+    Returns:
+        list: A list of (offset, length) tuples, one per buffer.
+    """
+    layout = []
+    offset = 0
+    with open(file_name, 'wb') as fout:
+        for buf in buffers:
+            with buf.raw() as view:
+                pad = -offset % ALIGN
+                if pad:
+                    fout.write(b'\0'*pad)
+                    offset += pad
+                fout.write(view)
+                layout.append((offset, view.nbytes))
+                offset += view.nbytes
+    return layout
+
+
+def read_buffers(file_name, layout, mmap=False, writable=False):
+    """Return a list of memoryviews from a sidecar file.
+
+    Args:
+        file_name (str): The sidecar file.
+        layout (list):   (offset, length) tuples from `write_buffers()`.
+        mmap (bool):     Map the file instead of reading it.
+        writable (bool): Map copy-on-write instead of read-only.
+
+    Returns:
+        list: memoryview objects, one per buffer.
+    """
+    if not _os.path.isfile(file_name):
+        raise IOError('Buffer file not found: {}'.format(file_name))
+    with open(file_name, 'rb') as fin:
+        if mmap and _os.path.getsize(file_name):
+            access = _mmap.ACCESS_COPY if writable else _mmap.ACCESS_READ
+            data = memoryview(_mmap.mmap(fin.fileno(), 0, access=access))
+        else:
+            data = memoryview(bytearray(fin.read()))
+    return [data[start:start+length] for start, length in layout]
+
+
+def _nbytes(buf):
+    """Return the size of a PickleBuffer."""
+    with buf.raw() as view:
+        return view.nbytes
+
+
+def _in_band(buf, buffers):
+    """Buffer callback for pickle, keep small buffers in-band."""
+    with buf.raw() as view:
+        if view.nbytes < OOB_MIN_SIZE:
+            return True
+    buffers.append(buf)
+    return False
@@ -5,7 +5,12 @@ Classes to build submission scripts.
 import os  as _os
 import sys as _sys
 import inspect as _inspect
+from hashlib import sha1 as _sha1
 from textwrap import dedent as _ddent
+try:
+    from shlex import quote as _quote
+except ImportError:
+    from pipes import quote as _quote  # For python2
 
 # Try to use dill, revert to pickle if not found
 try:
@@ -21,9 +26,16 @@ except ImportError:
 ###############################################################################
 
 from . import run as _run
+from . import conf as _conf
 from . import logme as _logme
+from . import serialize as _serialize
 from .run import indent as _ident
 
+# Runner scripts by (function, imports), see get_runner()
+RUNNERS = {}
+# Pickle files of the jobs of this process by runner file, see Function.clean()
+RUNNER_JOBS = {}
+
 
 class Script(object):
 
@@ -73,12 +85,20 @@ class Function(Script):
     """A special Script used to run a function."""
 
     def __init__(self, file_name, function, args=None, kwargs=None,
-                 imports=None, pickle_file=None, outfile=None):
+                 imports=None, pickle_file=None, outfile=None, compress=None,
+                 tasks=None, task_file=None, cores=1, suffix=None,
+                 blob_dir=None):
         """Create a function wrapper.
 
         NOTE: Function submission will fail if the parent file's code is not
         wrapped in an if __main__ wrapper.
 
+        The runner script itself is shared by all jobs running the same
+        function, it is written next to file_name as
+        <function>.<hash>_func.<suffix>.py and deleted by the `clean()` of
+        the last job of this process that uses it, only the pickle files are
+        per job.
+
         Args:
             file_name (str):     A root name to the outfiles
             function (callable): Function handle.
@@ -92,238 +112,395 @@ class Function(Script):
                                  ['from os import path', 'sys']
             pickle_file (str): The file to hold the function.
             outfile (str):     The file to hold the output.
+            compress (str):    Compress both pickle files with this codec,
+                               one of `serialize.CODECS`.
+            tasks (list):      Run function once per task instead, a list of
+                               (index, args, kwargs), see `fyrd.pack`.
+            task_file (str):   The file to write task results to.
+            cores (int):       Number of tasks to run at once.
+            suffix (str):      Suffix for the runner script name.
+            blob_dir (str):    Store the function and large arguments once in
+                               this `serialize.BlobStore`, shared by all
+                               jobs, instead of in the pickle file.
         """
         self.function = function
-        rootmod       = _inspect.getmodule(self.function)
-        self.parent   = rootmod.__name__
+        self.compress = _serialize.get_codec(compress) if compress else None
         self.args     = args
         self.kwargs   = kwargs
+        self.tasks    = tasks
+        self.cores    = int(cores)
+        self.blob_dir = _os.path.abspath(blob_dir) if blob_dir else None
 
-        # Get the module path
-        if hasattr(rootmod, '__file__'):
-            imppath, impt = _os.path.split(rootmod.__file__)
-            impt = _os.path.splitext(impt)[0]
+        # Set file names
+        self.pickle_file = pickle_file if pickle_file else file_name + '.pickle.in'
+        self.outfile     = outfile if outfile else file_name + '.pickle.out'
+        if tasks is not None:
+            self.task_file = task_file if task_file \
+                else file_name + '.tasks'
         else:
-            imppath = '.'
-            impt = None
-        imppath = _os.path.abspath(imppath)
-
-        # Clobber ourselves to prevent pickling errors
-        if impt and self.function.__module__ == '__main__':
-            self.function.__module__ = impt
-
-        # Import the submitted function
-        if impt:
-            imp1 = 'from {} import {}'.format(impt, self.function.__name__)
-            imp2 = 'from {} import *'.format(impt)
-            if impt != self.parent:
-                imppath2 = _os.path.abspath(_os.path.join(
-                    imppath,
-                    *['..' for i in range(self.parent.count('.'))]
-                ))
-                bimp1 = 'from {} import {}'.format(
-                    self.parent, self.function.__name__)
-                bimp2 = 'from {} import *'.format(self.parent)
-            else:
-                bimp1 = None
-        elif self.parent != self.function.__name__ and self.parent != '__main__':
-            imp1 = 'from {} import {}'.format(
-                self.parent, self.function.__name__)
-            imp2 = 'from {} import *'.format(self.parent)
-            bimp1 = None
+            self.task_file = None
+
+        # All jobs running this function share one runner script
+        script, digest = get_runner(function, imports)
+        runner = '{}.{}_func'.format(
+            getattr(function, '__name__', 'function'), digest[:12])
+        if suffix:
+            runner += '.' + suffix
+        runner = _os.path.join(_os.path.dirname(_os.path.abspath(file_name)),
+                               runner + '.py')
+
+        super(Function, self).__init__(runner, script)
+
+    @property
+    def arguments(self):
+        """The command line arguments of the runner for this job."""
+        args = [self.pickle_file, self.outfile]
+        if self.compress:
+            args += ['--compress', self.compress]
+        if self.task_file:
+            args += ['--tasks', self.task_file, '--cores', str(self.cores)]
+        if self.blob_dir:
+            args += ['--blobs', self.blob_dir]
+        return args
+
+    def command(self, executable=None):
+        """Return the shell command to run the function.
+
+        Args:
+            executable (str): The python to use, default sys.executable.
+        """
+        return ' '.join([executable if executable else _sys.executable,
+                         self.file_name] +
+                        [_quote(i) for i in self.arguments])
+
+    def write(self, overwrite=True):
+        """Write the pickle file, and the runner script if it is missing.
+
+        The function is pickled on its own, by reference if possible and with
+        dill otherwise (only following the globals the function actually
+        uses), the arguments are then pickled with any large buffers
+        (e.g. numpy arrays) written out-of-band to a sidecar file, which the
+        runner memory maps. If compress is set, the whole pickle is compressed
+        instead.
+
+        With a blob store, the function and every argument larger than
+        `serialize.BLOB_MIN_SIZE` are written to the store, unless already
+        there, and the pickle only holds references to them. If new blobs
+        were written, the store is pruned to the blob_size and blob_age
+        config options.
+        """
+        _logme.log('Writing pickle file {}'.format(self.pickle_file), 'debug')
+        function = _serialize.dumps_function(self.function)
+        args, kwargs = self.args, self.kwargs
+        if self.blob_dir:
+            store    = _serialize.BlobStore(self.blob_dir)
+            function = store.put_payload(function)
+            args     = _store_large(store, args)
+            kwargs   = _store_large(store, kwargs)
+            if store.added:
+                store.prune(_conf.get_option('jobs', 'blob_size'),
+                            _conf.get_option('jobs', 'blob_age'))
+        if self.tasks is not None:
+            payload = (function, self.tasks, None)
         else:
-            imp1 = 'import {}'.format(self.function.__name__)
-            imp2 = None
-            bimp1 = None
+            payload = (function, args, kwargs)
+        _serialize.dump(payload, self.pickle_file, compress=self.compress)
+        # The runner is named by its hash, an existing file is the same script
+        if not self.exists:
+            tmp_file = '{}.{}.tmp'.format(self.file_name, _os.getpid())
+            with open(tmp_file, 'w') as fout:
+                fout.write(self.script + '\n')
+            _os.rename(tmp_file, self.file_name)
+        RUNNER_JOBS.setdefault(self.file_name, set()).add(self.pickle_file)
+        self.written = True
+        return self.file_name
 
-        # Try to set a sane import string to make the function work
-        if bimp1:
-            modstr = _ddent("""\
-            sys.path.append('{imppath1}')
-            try:
-                try:
-                    {imp1}
-                except SystemError:
-                    sys.path.append('{imppath2}')
-                    try:
-                        {bimp1}
-                    except ImportError:
-                        pass
-            except ImportError:
-                pass
-            try:
-                try:
-                    {imp2}
-                except SystemError:
-                    try:
-                        {bimp2}
-                    except ImportError:
-                        pass
-            except ImportError:
-                pass
-            """).format(imppath1=imppath, imppath2=imppath2,
-                        imp1=imp1, imp2=imp2, bimp1=bimp1, bimp2=bimp2)
+    def clean(self, delete_output=False):
+        """Delete the input pickle file, and the runner if no longer used.
+
+        The shared runner script is only deleted if no other job of this
+        process has written a pickle file for it, runners of jobs of other
+        processes are left to `basic.clean_dir()`.
+
+        Args:
+            delete_output (bool): Delete the output pickle file too.
+        """
+        if self.written:
+            _logme.log('Function: Deleting {}'.format(self.pickle_file),
+                       'debug')
+            _serialize.remove(self.pickle_file)
+            users = RUNNER_JOBS.get(self.file_name, set())
+            users.discard(self.pickle_file)
+            if not users:
+                RUNNER_JOBS.pop(self.file_name, None)
+                if self.exists:
+                    _logme.log('Function: Deleting {}'.format(self.file_name),
+                               'debug')
+                    _os.remove(self.file_name)
+            if delete_output:
+                _logme.log('Function: Deleting {}'.format(self.outfile),
+                           'debug')
+                _serialize.remove(self.outfile)
+
+
+def _store_large(store, obj):
+    """Replace the large items of a tuple, list, or dict with blob refs."""
+    if isinstance(obj, dict):
+        refs = {}
+        for key, value in obj.items():
+            ref = store.put(value, _serialize.BLOB_MIN_SIZE)
+            refs[key] = value if ref is None else ref
+        return refs
+    if isinstance(obj, (tuple, list)):
+        refs = []
+        for value in obj:
+            ref = store.put(value, _serialize.BLOB_MIN_SIZE)
+            refs.append(value if ref is None else ref)
+        return type(obj)(refs)
+    return obj
+
+
+def get_runner(function, imports=None):
+    """Return the runner script for function and a hash of it.
+
+    The script does not depend on the job, so it is built only once per
+    function and set of imports, and all jobs share a single file.
+
+    Args:
+        function (callable): The function to run.
+        imports (list):      Extra imports, see `Function`.
+
+    Returns:
+        tuple: (script text, hex digest of the script)
+    """
+    try:
+        key = (function, tuple(imports) if isinstance(imports, (list, tuple))
+               else imports)
+        return RUNNERS[key]
+    except TypeError:
+        # Unhashable function or imports
+        key = None
+    except KeyError:
+        pass
+    script = _build_runner(function, imports)
+    digest = _sha1(script.encode('utf8')).hexdigest()
+    if key is not None:
+        RUNNERS[key] = (script, digest)
+    return script, digest
+
+
+def _build_runner(function, imports=None):
+    """Return the text of a FUNC_RUNNER script that runs function."""
+    rootmod = _inspect.getmodule(function)
+    if rootmod is None:
+        # __module__ was already changed from __main__ by an earlier job
+        rootmod = _sys.modules['__main__']
+    parent  = rootmod.__name__
+
+    # Get the module path
+    if hasattr(rootmod, '__file__'):
+        imppath, impt = _os.path.split(rootmod.__file__)
+        impt = _os.path.splitext(impt)[0]
+    else:
+        imppath = '.'
+        impt = None
+    imppath = _os.path.abspath(imppath)
+
+    # Clobber ourselves to prevent pickling errors
+    if impt and function.__module__ == '__main__':
+        function.__module__ = impt
+
+    # Import the submitted function
+    if impt:
+        imp1 = 'from {} import {}'.format(impt, function.__name__)
+        imp2 = 'from {} import *'.format(impt)
+        if impt != parent:
+            imppath2 = _os.path.abspath(_os.path.join(
+                imppath,
+                *['..' for i in range(parent.count('.'))]
+            ))
+            bimp1 = 'from {} import {}'.format(
+                parent, function.__name__)
+            bimp2 = 'from {} import *'.format(parent)
         else:
-            modstr = _ddent("""\
-            sys.path.append('{imppath1}')
+            bimp1 = None
+    elif parent != function.__name__ and parent != '__main__':
+        imp1 = 'from {} import {}'.format(
+            parent, function.__name__)
+        imp2 = 'from {} import *'.format(parent)
+        bimp1 = None
+    else:
+        imp1 = 'import {}'.format(function.__name__)
+        imp2 = None
+        bimp1 = None
+
+    # Try to set a sane import string to make the function work
+    if bimp1:
+        modstr = _ddent("""\
+        sys.path.append('{imppath1}')
+        try:
             try:
                 {imp1}
-            except ImportError:
-                pass
+            except SystemError:
+                sys.path.append('{imppath2}')
+                try:
+                    {bimp1}
+                except ImportError:
+                    pass
+        except ImportError:
+            pass
+        try:
             try:
                 {imp2}
-            except ImportError:
-                pass
-            """).format(imppath1=imppath, imp1=imp1, imp2=imp2)
-        modstr = _ident(modstr, '    ')
-
-        ##########################
-        #  Take care of imports  #
-        ##########################
-        if imports:
-            if not isinstance(imports, (list, tuple)):
-                imports = [imports]
-        else:
-            imports = []
-
-        func_imports = []
-
-        # Import everything in current and function globals
-        import_places = [
-            #  dict(globals().items()),
-            dict(_inspect.getmembers(function))['__globals__'],
-        ]
-        for place in import_places:
-            for name, item in place.items():
-                # Module
-                if _inspect.ismodule(item):
-                    if name != '__main__' or not name.startswith('__'):
-                        imports.append((name, item.__name__))
-                # Function
-                elif callable(item):
-                    try:
-                        func_imports.append((name, item.__name__,
-                                             item.__module__))
-                    except AttributeError:
-                        pass
-
-        # Import all modules in the root module
-        imports += [(k,v.__name__) for k,v in
-                    _inspect.getmembers(rootmod, _inspect.ismodule)
-                    if not k.startswith('__')]
-
-        imports = sorted(list(set(imports)), key=_sort_imports)
-        func_imports = sorted(list(set(func_imports)), key=_sort_imports)
-        _logme.log('Imports: {}'.format(imports), 'debug')
-
-        # Create a sane set of imports
-        ignore_list = ['os', 'sys', 'dill', 'pickle', '__main__']
-        filtered_imports = []
-        for imp in imports:
-            if imp in ignore_list:
+            except SystemError:
+                try:
+                    {bimp2}
+                except ImportError:
+                    pass
+        except ImportError:
+            pass
+        """).format(imppath1=imppath, imppath2=imppath2,
+                    imp1=imp1, imp2=imp2, bimp1=bimp1, bimp2=bimp2)
+    else:
+        modstr = _ddent("""\
+        sys.path.append('{imppath1}')
+        try:
+            {imp1}
+        except ImportError:
+            pass
+        try:
+            {imp2}
+        except ImportError:
+            pass
+        """).format(imppath1=imppath, imp1=imp1, imp2=imp2)
+    modstr = _ident(modstr, '    ')
+
+    ##########################
+    #  Take care of imports  #
+    ##########################
+    if imports:
+        if not isinstance(imports, (list, tuple)):
+            imports = [imports]
+        imports = list(imports)
+    else:
+        imports = []
+
+    func_imports = []
+
+    # Import everything in current and function globals
+    import_places = [
+        #  dict(globals().items()),
+        dict(_inspect.getmembers(function))['__globals__'],
+    ]
+    for place in import_places:
+        for name, item in place.items():
+            # Module
+            if _inspect.ismodule(item):
+                if name != '__main__' or not name.startswith('__'):
+                    imports.append((name, item.__name__))
+            # Function
+            elif callable(item):
+                try:
+                    func_imports.append((name, item.__name__,
+                                         item.__module__))
+                except AttributeError:
+                    pass
+
+    # Import all modules in the root module
+    imports += [(k,v.__name__) for k,v in
+                _inspect.getmembers(rootmod, _inspect.ismodule)
+                if not k.startswith('__')]
+
+    imports = sorted(list(set(imports)), key=_sort_imports)
+    func_imports = sorted(list(set(func_imports)), key=_sort_imports)
+    _logme.log('Imports: {}'.format(imports), 'debug')
+
+    # Create a sane set of imports
+    ignore_list = ['os', 'sys', 'dill', 'pickle', '__main__']
+    filtered_imports = []
+    for imp in imports:
+        if imp in ignore_list:
+            continue
+        if isinstance(imp, tuple):
+            iname, name = imp
+            names = name.split('.')
+            if iname in ignore_list:
                 continue
-            if isinstance(imp, tuple):
-                iname, name = imp
-                names = name.split('.')
-                if iname in ignore_list:
-                    continue
-                if name.startswith('@') or iname.startswith('@'):
-                    continue
-                if iname != name:
-                    if len(names) > 1:
-                        if '.'.join(names[1:]) != iname:
-                            filtered_imports.append(
-                                ('try:\n    from {} import {} as {}\n'
-                                 'except ImportError:\n    pass\n')
-                                .format('.'.join(names[:-1]), names[-1], iname)
-                            )
-                        else:
-                            filtered_imports.append(
-                                ('try:\n    from {} import {}\n'
-                                 'except ImportError:\n    pass\n')
-                                .format(names[0], '.'.join(names[1:]))
-                            )
+            if name.startswith('@') or iname.startswith('@'):
+                continue
+            if iname != name:
+                if len(names) > 1:
+                    if '.'.join(names[1:]) != iname:
+                        filtered_imports.append(
+                            ('try:\n    from {} import {} as {}\n'
+                             'except ImportError:\n    pass\n')
+                            .format('.'.join(names[:-1]), names[-1], iname)
+                        )
                     else:
                         filtered_imports.append(
-                            ('try:\n    import {} as {}\n'
+                            ('try:\n    from {} import {}\n'
                              'except ImportError:\n    pass\n')
-                            .format(name, iname)
+                            .format(names[0], '.'.join(names[1:]))
                         )
                 else:
-                    filtered_imports.append(('try:\n    import {}\n'
-                                             'except ImportError:\n    pass\n')
-                                            .format(name))
-
-            else:
-                if imp.startswith('import') or imp.startswith('from'):
-                    filtered_imports.append('try:\n    ' + imp.rstrip() +
-                                            '\nexcept ImportError:\n    pass')
-                else:
-                    if imp.startswith('@'):
-                        continue
-                    filtered_imports.append(('try:\n    import {}\n'
-                                             'except ImportError:\n    pass\n')
-                                            .format(imp))
-
-            # Function imports
-            for iname, name, mod in func_imports:
-                if iname in ignore_list:
-                    continue
-                if iname == name:
                     filtered_imports.append(
-                        ('try:\n    from {} import {}\n'
+                        ('try:\n    import {} as {}\n'
                          'except ImportError:\n    pass\n')
-                        .format(mod, name)
+                        .format(name, iname)
                     )
-                else:
-                    filtered_imports.append(
-                        ('try:\n    from {} import {} as {}\n'
-                         'except ImportError:\n    pass\n')
-                        .format(mod, name, iname)
-                    )
-
-
-        # Get rid of duplicates and sort imports
-        impts = _ident('\n'.join(set(filtered_imports)), '    ')
-
-        # Set file names
-        self.pickle_file = pickle_file if pickle_file else file_name + '.pickle.in'
-        self.outfile     = outfile if outfile else file_name + '.pickle.out'
-
-        # Create script text
-        script = '#!{}\n'.format(_sys.executable)
-        script += _run.FUNC_RUNNER.format(name=file_name,
-                                          path=imppath,
-                                          modimpstr=modstr,
-                                          imports=impts,
-                                          pickle_file=self.pickle_file,
-                                          out_file=self.outfile)
-
-        super(Function, self).__init__(file_name, script)
-
-    def write(self, overwrite=True):
-        """Write the pickle file and call the parent Script write function."""
-        _logme.log('Writing pickle file {}'.format(self.pickle_file), 'debug')
-        with open(self.pickle_file, 'wb') as fout:
-            _pickle.dump((self.function, self.args, self.kwargs), fout)
-        super(Function, self).write(overwrite)
+            else:
+                filtered_imports.append(('try:\n    import {}\n'
+                                         'except ImportError:\n    pass\n')
+                                        .format(name))
 
-    def clean(self, delete_output=False):
-        """Delete the input pickle file and any scripts.
+        else:
+            if imp.startswith('import') or imp.startswith('from'):
+                filtered_imports.append('try:\n    ' + imp.rstrip() +
+                                        '\nexcept ImportError:\n    pass')
+            else:
+                if imp.startswith('@'):
+                    continue
+                filtered_imports.append(('try:\n    import {}\n'
+                                         'except ImportError:\n    pass\n')
+                                        .format(imp))
 
-        Args:
-            delete_output (bool): Delete the output pickle file too.
-        """
-        if self.written:
-            if _os.path.isfile(self.pickle_file):
-                _logme.log('Function: Deleting {}'.format(self.pickle_file),
-                           'debug')
-                _os.remove(self.pickle_file)
-            if delete_output and _os.path.isfile(self.outfile):
-                _logme.log('Function: Deleting {}'.format(self.outfile),
-                           'debug')
-                _os.remove(self.outfile)
-        super(Function, self).clean(delete_output)
+        # Function imports
+        for iname, name, mod in func_imports:
+            if iname in ignore_list:
+                continue
+            if iname == name:
+                filtered_imports.append(
+                    ('try:\n    from {} import {}\n'
+                     'except ImportError:\n    pass\n')
+                    .format(mod, name)
+                )
+            else:
+                filtered_imports.append(
+                    ('try:\n    from {} import {} as {}\n'
+                     'except ImportError:\n    pass\n')
+                    .format(mod, name, iname)
+                )
+
+
+    # Get rid of duplicates and sort imports
+    impts = _ident('\n'.join(sorted(set(filtered_imports))), '    ')
+
+    # Create script text
+    task_header = _serialize.TASK_HEADER.format
+    if isinstance(task_header, bytes):
+        task_header = task_header.decode()
+    script = '#!{}\n'.format(_sys.executable)
+    script += _run.FUNC_RUNNER.format(path=imppath,
+                                      modimpstr=modstr,
+                                      imports=impts,
+                                      oob_mark=_serialize.OOB_MARK,
+                                      oob_min_size=_serialize.OOB_MIN_SIZE,
+                                      buffer_suffix=_serialize.BUFFER_SUFFIX,
+                                      align=_serialize.ALIGN,
+                                      codecs=repr(dict(_serialize.CODECS)),
+                                      task_header=task_header,
+                                      blob_mark=_serialize.BLOB_MARK)
+    return script
 
 
 def _sort_imports(x):
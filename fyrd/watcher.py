@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+Watch for the arrival of job output files.
+
+When the queue reports a job as complete its output files may still be in
+flight on a shared filesystem. Rather than have every waiting job stat each of
+its files in a loop, all waiting jobs subscribe to a single `FileWatcher`,
+which runs one background thread for the whole process.
+
+The thread groups the files by directory. Directories on local filesystems are
+watched with inotify (on linux), so arrivals are seen immediately and the
+directory is only read when something changes. All other directories (NFS,
+lustre, etc., where inotify does not see writes made by other machines) are
+read with a single `os.scandir` per directory per tick, however many jobs are
+waiting on them. Before each read the directory is opened and closed, which
+forces an NFS client to revalidate its cached attributes for the directory
+(close-to-open consistency), so new files are not hidden by a stale cache.
+"""
+import os     as _os
+import sys    as _sys
+import errno  as _errno
+import struct as _struct
+import fcntl  as _fcntl
+import select as _select
+import threading as _threading
+from time import time as _time
+
+try:
+    from os import scandir as _scandir
+except ImportError:  # python < 3.5
+    _scandir = None
+
+from . import logme as _logme
+
+__all__ = ['FileWatcher', 'wait_for_files']
+
+###############################################################################
+#                                  Constants                                  #
+###############################################################################
+
+INTERVAL = 0.1
+"""Seconds between reads of directories without inotify."""
+
+RESCAN = 5
+"""Seconds between safety reads of directories watched with inotify."""
+
+NETWORK_FS = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'lustre', 'gpfs',
+              'beegfs', 'ceph', 'glusterfs', 'afs', 'panfs', '9p', 'fuse')
+"""Filesystem types where inotify can't be trusted (matched by prefix)."""
+
+# From sys/inotify.h
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO    = 0x00000080
+_IN_CREATE      = 0x00000100
+_IN_NONBLOCK    = 0o4000
+_IN_CLOEXEC     = 0o2000000
+_IN_MASK        = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+_IN_EVENT       = _struct.Struct('iIII')
+
+# Holds the watcher for this process, see get_watcher()
+WATCHER = None
+
+
+###############################################################################
+#                                 The Watcher                                 #
+###############################################################################
+
+
+class FileWatcher(object):
+
+    """Wait for files to appear, shared between all waiting jobs.
+
+    Use `wait()` to block until a list of files exists, the watcher thread is
+    started on demand and exits when nothing is being waited on.
+    """
+
+    def __init__(self, interval=INTERVAL):
+        """Set up the wake-up pipe and inotify if available.
+
+        Args:
+            interval (float): Seconds between reads of unwatched directories.
+        """
+        self.interval = interval
+        self.pid      = _os.getpid()
+        self._lock    = _threading.Lock()
+        self._thread  = None
+        self._subs    = []
+        self._dirs    = {}     # dir: number of subscriptions using it
+        self._dirty   = set()  # dirs to read on the next tick
+        self._scanned = {}     # dir: time of last read
+        self._wds     = {}     # dir: inotify watch descriptor
+        self._wake_r, self._wake_w = _os.pipe()
+        _fcntl.fcntl(self._wake_w, _fcntl.F_SETFL, _os.O_NONBLOCK)
+        self._inotify = _Inotify.create()
+
+    def wait(self, files, timeout=None):
+        """Block until all files exist.
+
+        Args:
+            files (list):    Paths to wait for.
+            timeout (float): Give up after this many seconds.
+
+        Returns:
+            bool: True if all files exist, False if timeout reached.
+        """
+        sub = self.subscribe(files)
+        try:
+            return sub.wait(timeout)
+        finally:
+            self.unsubscribe(sub)
+
+    def subscribe(self, files):
+        """Start watching for files, returns a Subscription."""
+        sub = Subscription(files)
+        with self._lock:
+            self._subs.append(sub)
+            for dirname in sub.pending:
+                if dirname not in self._dirs:
+                    self._dirs[dirname] = 0
+                    self._add_watch(dirname)
+                self._dirs[dirname] += 1
+                self._dirty.add(dirname)
+            if self._thread is None:
+                self._thread = _threading.Thread(target=self._run,
+                                                 name='fyrd-file-watcher')
+                self._thread.daemon = True
+                self._thread.start()
+        self._wake()
+        return sub
+
+    def unsubscribe(self, sub):
+        """Stop watching for the files in a Subscription."""
+        with self._lock:
+            if sub not in self._subs:
+                return
+            self._subs.remove(sub)
+            for dirname in sub.dirs:
+                self._dirs[dirname] -= 1
+                if not self._dirs[dirname]:
+                    self._drop_dir(dirname)
+        self._wake()
+
+    ###############
+    #  Internals  #
+    ###############
+
+    def _run(self):
+        """Thread loop, exits when there are no subscriptions."""
+        fds = [self._wake_r]
+        if self._inotify:
+            fds.append(self._inotify.fd)
+        while True:
+            with self._lock:
+                if not self._subs:
+                    self._thread = None
+                    return
+            try:
+                ready = _select.select(fds, [], [], self.interval)[0]
+            except (OSError, _select.error) as err:
+                if err.args[0] != _errno.EINTR:
+                    raise
+                ready = []
+            if self._wake_r in ready:
+                _os.read(self._wake_r, 4096)
+            if self._inotify and self._inotify.fd in ready:
+                changed = self._inotify.read()
+            else:
+                changed = set()
+            now = _time()
+            with self._lock:
+                changed.update(self._dirty)
+                self._dirty.clear()
+                dirs = [
+                    d for d in self._dirs if d in changed
+                    or d not in self._wds
+                    or now - self._scanned.get(d, 0) > RESCAN
+                ]
+            for dirname in dirs:
+                names = _list_dir(dirname)
+                with self._lock:
+                    self._scanned[dirname] = now
+                    for sub in self._subs:
+                        sub.update(dirname, names)
+
+    def _wake(self):
+        """Interrupt the select in the thread."""
+        try:
+            _os.write(self._wake_w, b'x')
+        except OSError:
+            pass
+
+    def _add_watch(self, dirname):
+        """Add an inotify watch if dirname is on a local filesystem."""
+        if not self._inotify or is_network_fs(dirname):
+            return
+        wd = self._inotify.add(dirname)
+        if wd is not None:
+            self._wds[dirname] = wd
+
+    def _drop_dir(self, dirname):
+        """Forget about dirname."""
+        self._dirs.pop(dirname)
+        self._scanned.pop(dirname, None)
+        self._dirty.discard(dirname)
+        if dirname in self._wds:
+            self._inotify.remove(self._wds.pop(dirname))
+
+
+class Subscription(object):
+
+    """A set of files to wait for, grouped by directory."""
+
+    def __init__(self, files):
+        """Group files by directory."""
+        self.pending = {}
+        for fl in files:
+            dirname, name = _os.path.split(_os.path.abspath(fl))
+            self.pending.setdefault(dirname, set()).add(name)
+        self.dirs  = list(self.pending)
+        self.event = _threading.Event()
+        if not self.pending:
+            self.event.set()
+
+    def update(self, dirname, names):
+        """Mark names in dirname as arrived."""
+        if dirname not in self.pending:
+            return
+        self.pending[dirname].difference_update(names)
+        if not self.pending[dirname]:
+            self.pending.pop(dirname)
+        if not self.pending:
+            self.event.set()
+
+    def wait(self, timeout=None):
+        """Block until all files have arrived, True if they did."""
+        self.event.wait(timeout)
+        return self.event.is_set()
+
+
+###############################################################################
+#                                   inotify                                   #
+###############################################################################
+
+
+class _Inotify(object):
+
+    """Minimal ctypes wrapper of the linux inotify API."""
+
+    def __init__(self, libc, fd):
+        """Use create() instead."""
+        self.libc = libc
+        self.fd   = fd
+        self.wds  = {}  # wd: dir
+
+    @classmethod
+    def create(cls):
+        """Return an _Inotify instance, or None if not available."""
+        if not _sys.platform.startswith('linux'):
+            return None
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                               use_errno=True)
+            fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        except (ImportError, OSError, AttributeError) as err:
+            _logme.log('inotify not available: {}'.format(err), 'debug')
+            return None
+        if fd < 0:
+            return None
+        return cls(libc, fd)
+
+    def fileno(self):
+        """Allow use in select."""
+        return self.fd
+
+    def add(self, dirname):
+        """Watch dirname for new files, return the watch descriptor."""
+        path = dirname.encode(_sys.getfilesystemencoding()) \
+            if not isinstance(dirname, bytes) else dirname
+        wd = self.libc.inotify_add_watch(self.fd, path, _IN_MASK)
+        if wd < 0:
+            return None
+        self.wds[wd] = dirname
+        return wd
+
+    def remove(self, wd):
+        """Stop watching a directory."""
+        self.wds.pop(wd, None)
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """Return the set of directories with new files."""
+        changed = set()
+        while True:
+            try:
+                data = _os.read(self.fd, 65536)
+            except OSError as err:
+                if err.errno in (_errno.EAGAIN, _errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                break
+            pos = 0
+            while pos < len(data):
+                wd, _, _, length = _IN_EVENT.unpack_from(data, pos)
+                pos += _IN_EVENT.size + length
+                if wd in self.wds:
+                    changed.add(self.wds[wd])
+        return changed
+
+
+###############################################################################
+#                              Helper Functions                               #
+###############################################################################
+
+
+def get_watcher():
+    """Return the FileWatcher for this process, creating it if needed."""
+    global WATCHER
+    if WATCHER is None or WATCHER.pid != _os.getpid():
+        WATCHER = FileWatcher()
+    return WATCHER
+
+
+def wait_for_files(files, timeout=None):
+    """Block until all files exist, using the shared FileWatcher.
+
+    Args:
+        files (list):    Paths to wait for.
+        timeout (float): Give up after this many seconds.
+
+    Returns:
+        bool: True if all files exist, False if timeout reached.
+    """
+    return get_watcher().wait(files, timeout)
+
+
+def is_network_fs(path):
+    """Return True if path is on a network filesystem (or unknown)."""
+    fstype = _fs_type(path)
+    return fstype is None or fstype.startswith(NETWORK_FS)
+
+
+def _fs_type(path):
+    """Return the filesystem type of path from /proc/self/mounts or None."""
+    try:
+        with open('/proc/self/mounts') as fin:
+            mounts = [i.split()[1:3] for i in fin if len(i.split()) > 2]
+    except (IOError, OSError):
+        return None
+    path = _os.path.realpath(path)
+    best = (None, None)
+    for mount, fstype in mounts:
+        # Spaces etc. are octal escaped
+        mount = mount.replace('\\040', ' ').replace('\\011', '\t')
+        if path == mount or path.startswith(mount.rstrip('/') + '/'):
+            if best[0] is None or len(mount) > len(best[0]):
+                best = (mount, fstype)
+    return best[1]
+
+
+def _list_dir(dirname):
+    """Return the set of names in dirname, bypassing the NFS attribute cache.
+
+    Opening the directory makes an NFS client revalidate it with the server,
+    which would otherwise serve a cached listing for up to `acdirmax` seconds.
+    """
+    try:
+        _os.close(_os.open(dirname, _os.O_RDONLY))
+        if _scandir:
+            return set(i.name for i in _scandir(dirname))
+        return set(_os.listdir(dirname))
+    except OSError:
+        # Directory does not exist yet
+        return set()
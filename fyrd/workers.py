@@ -0,0 +1,538 @@
+# -*- coding: utf-8 -*-
+"""
+Run many short tasks on a pool of long-lived worker jobs.
+
+A `WorkerPool` submits a few ordinary (pilot) jobs through the queue, each of
+which runs `run_worker()`. The workers pull tasks from a directory on the
+shared filesystem and run them until they are told to stop or have been idle
+for too long, so each task only costs a few file operations instead of a
+trip through the scheduler.
+
+Every step is an atomic rename within the pool directory, so workers need no
+locks and no network services::
+
+    tasks/NAME            waiting to run, written to tmp/ then renamed in
+    claimed/WORKER/NAME   claimed by a worker, up to prefetch at once
+    running/WORKER/NAME   being run
+    results/NAME          the result, written to tmp/ then renamed in
+    functions/HASH        each function is pickled once, tasks refer to it
+    stop/WORKER, stop/ALL ask one or all workers to exit
+
+Only one rename of a file can succeed, so a task is never run twice. A worker
+with nothing to do steals a task from the claimed directory of another worker.
+If the job of a worker ends while it still has tasks (e.g. it hit its
+walltime), those tasks are returned to tasks/ by the pool.
+
+With ``max_workers`` (or ``min_workers``) set, `WorkerPool.autoscale()` adds
+workers while tasks are waiting and no worker job is still pending in the
+queue, and stops workers once all tasks are done. It is called whenever a
+result is waited on.
+
+fyrd must be installed on the compute nodes to use a WorkerPool::
+
+    pool  = fyrd.WorkerPool(4, profile='short', max_workers=20)
+    tasks = [pool.submit(analyze, i) for i in range(10000)]
+    results = [task.get() for task in tasks]
+    pool.shutdown()
+"""
+import os      as _os
+import errno   as _errno
+import shutil  as _shutil
+import hashlib as _hashlib
+import pickle  as _stdpickle
+from time import time  as _time
+from time import sleep as _sleep
+from uuid import uuid4 as _uuid
+
+# Try to use dill, revert to pickle if not found
+try:
+    import dill as _pickle
+except ImportError:
+    try:
+        import cPickle as _pickle # For python2
+    except ImportError:
+        import pickle as _pickle
+
+from . import conf    as _conf
+from . import logme   as _logme
+from . import queue   as _queue
+from . import serialize as _serialize
+from . import watcher as _watcher
+from . import ClusterError as _ClusterError
+from .job import Job as _Job
+
+__all__ = ['WorkerPool', 'run_worker']
+
+###############################################################################
+#                                  Constants                                  #
+###############################################################################
+
+IDLE_TIMEOUT = 300
+"""Seconds a worker waits for a task before exiting."""
+
+POLL_MIN = 0.05
+"""Seconds between checks for tasks by a busy worker."""
+
+POLL_MAX = 1.0
+"""Maximum seconds between checks for tasks by an idle worker."""
+
+CHECK_INTERVAL = 5
+"""Seconds between autoscale checks while waiting for a result."""
+
+_DIRS = ['tasks', 'claimed', 'running', 'results', 'functions', 'stop', 'tmp']
+
+
+###############################################################################
+#                             The Task Directory                              #
+###############################################################################
+
+
+class TaskDir(object):
+
+    """The directory queue shared by the pool and its workers."""
+
+    def __init__(self, path):
+        """Create the directories if needed."""
+        self.path = _os.path.abspath(path)
+        for dirname in _DIRS:
+            _makedirs(self.dir(dirname))
+
+    def dir(self, *parts):
+        """Return a path in the pool directory."""
+        return _os.path.join(self.path, *parts)
+
+    def write(self, dest, data):
+        """Write bytes to dest atomically, via tmp/."""
+        tmp = self.dir('tmp', _uuid().hex)
+        with open(tmp, 'wb') as fout:
+            fout.write(data)
+        _os.rename(tmp, dest)
+
+    def list(self, *parts):
+        """Return the sorted names in a directory, [] if missing."""
+        try:
+            return sorted(_os.listdir(self.dir(*parts)))
+        except OSError:
+            return []
+
+    def move(self, src, dest):
+        """Rename src to dest, False if someone else got there first."""
+        try:
+            _os.rename(src, dest)
+        except OSError as err:
+            if err.errno == _errno.ENOENT:
+                return False
+            raise
+        return True
+
+    ###########
+    #  Tasks  #
+    ###########
+
+    def add_function(self, function):
+        """Store function once, return its key."""
+        data = _serialize.dumps_function(function, by_value=True)
+        key  = _hashlib.sha256(data).hexdigest()
+        dest = self.dir('functions', key)
+        if not _os.path.isfile(dest):
+            self.write(dest, data)
+        return key
+
+    def add_task(self, name, key, args, kwargs):
+        """Add a task to the queue."""
+        self.write(self.dir('tasks', name), _dumps((key, args, kwargs)))
+
+    def claim(self, worker, count=1):
+        """Move up to count waiting tasks into the claimed dir of worker.
+
+        If there are none, steals one task claimed by another worker.
+
+        Returns:
+            int: Number of tasks claimed.
+        """
+        mine = self.dir('claimed', worker)
+        got  = 0
+        for name in self.list('tasks'):
+            if got >= count:
+                break
+            if self.move(self.dir('tasks', name), _os.path.join(mine, name)):
+                got += 1
+        if got:
+            return got
+        for other in self.list('claimed'):
+            if other == worker:
+                continue
+            for name in self.list('claimed', other):
+                if self.move(self.dir('claimed', other, name),
+                             _os.path.join(mine, name)):
+                    _logme.log('{} stole {} from {}'.format(
+                        worker, name, other), 'debug')
+                    return 1
+        return 0
+
+    def start(self, worker):
+        """Move the next claimed task of worker to running.
+
+        Returns:
+            str: The task name, None if worker has no claimed tasks left.
+        """
+        for name in self.list('claimed', worker):
+            if self.move(self.dir('claimed', worker, name),
+                         self.dir('running', worker, name)):
+                return name
+        return None
+
+    def finish(self, worker, name, result):
+        """Write the result of a task and remove the task."""
+        self.write(self.dir('results', name), result)
+        _os.remove(self.dir('running', worker, name))
+
+    def requeue(self, worker):
+        """Return all claimed and running tasks of worker to the queue.
+
+        Returns:
+            int: Number of tasks requeued.
+        """
+        count = 0
+        for state in ['running', 'claimed']:
+            for name in self.list(state, worker):
+                if self.move(self.dir(state, worker, name),
+                             self.dir('tasks', name)):
+                    count += 1
+        return count
+
+    def stopped(self, worker):
+        """True if worker, or all workers, should exit."""
+        return _os.path.isfile(self.dir('stop', 'ALL')) or \
+            _os.path.isfile(self.dir('stop', worker))
+
+    def stop(self, worker='ALL'):
+        """Ask worker (default all workers) to exit."""
+        with open(self.dir('stop', worker), 'w'):
+            pass
+
+
+###############################################################################
+#                                 The Worker                                  #
+###############################################################################
+
+
+def run_worker(path, worker, prefetch=1, idle_timeout=IDLE_TIMEOUT):
+    """Run tasks from the pool directory until stopped or idle.
+
+    This is the function run by each worker job.
+
+    Args:
+        path (str):           The pool directory.
+        worker (str):         The name of this worker.
+        prefetch (int):       Number of tasks to claim at once.
+        idle_timeout (float): Exit after this many seconds without a task.
+
+    Returns:
+        int: Number of tasks run.
+    """
+    queue = TaskDir(path)
+    for state in ['claimed', 'running']:
+        _makedirs(queue.dir(state, worker))
+    functions = {}
+    count = 0
+    last  = _time()
+    poll  = POLL_MIN
+    while not queue.stopped(worker):
+        name = queue.start(worker)
+        if name is None and queue.claim(worker, prefetch):
+            name = queue.start(worker)
+        if name is None:
+            if _time() - last > idle_timeout:
+                break
+            _sleep(poll)
+            poll = min(poll*2, POLL_MAX)
+            continue
+        # A bad task must fail, not kill every worker that runs it
+        try:
+            with open(queue.dir('running', worker, name), 'rb') as fin:
+                key, args, kwargs = _pickle.load(fin)
+            if key not in functions:
+                with open(queue.dir('functions', key), 'rb') as fin:
+                    functions[key] = _pickle.load(fin)
+            result = (True, functions[key](*args, **kwargs))
+        except Exception as err:
+            result = (False, err)
+        queue.finish(worker, name, _dump_result(result))
+        count += 1
+        last = _time()
+        poll = POLL_MIN
+    # Anything still claimed goes back for the other workers
+    queue.requeue(worker)
+    return count
+
+
+###############################################################################
+#                                  The Pool                                   #
+###############################################################################
+
+
+class WorkerPool(object):
+
+    """A pool of worker jobs that run tasks from a shared directory.
+
+    Attributes:
+        workers (dict): {worker name: Job} for every worker submitted.
+        path (str):     The pool directory.
+    """
+
+    def __init__(self, n_workers, min_workers=None, max_workers=None,
+                 prefetch=1, idle_timeout=IDLE_TIMEOUT, path=None, **kwds):
+        """Create the pool directory and submit the workers.
+
+        Args:
+            n_workers (int):      Number of workers to start with.
+            min_workers (int):    Fewest workers to keep while idle, default
+                                  n_workers.
+            max_workers (int):    Most workers to add while tasks are waiting,
+                                  default n_workers.
+            prefetch (int):       Number of tasks a worker claims at once.
+            idle_timeout (float): Workers exit after this many seconds
+                                  without a task.
+            path (str):           The pool directory, must be on a shared
+                                  filesystem, default is a new directory in
+                                  the outpath (or the current directory).
+
+            *All other keywords (e.g. profile) are passed to every worker
+            Job.*
+        """
+        self.min_workers  = n_workers if min_workers is None else min_workers
+        self.max_workers  = n_workers if max_workers is None else max_workers
+        self.prefetch     = int(prefetch)
+        self.idle_timeout = idle_timeout
+        self.kwds         = kwds
+        if not path:
+            outpath = kwds.get('outpath', _conf.get_option('jobs', 'outpath'))
+            path = _os.path.join(outpath if outpath else '.',
+                                 '.fyrd_pool_{}'.format(_uuid().hex[:8]))
+        self.queue     = TaskDir(path)
+        self.path      = self.queue.path
+        self.workers   = {}
+        self.stopped   = set()
+        self.functions = {}
+        self.pending   = set()
+        self._count    = 0
+        self._last     = 0
+        self.scale(n_workers)
+
+    ###########
+    #  Tasks  #
+    ###########
+
+    def submit(self, function, *args, **kwargs):
+        """Queue function(*args, **kwargs) to run on a worker.
+
+        Returns:
+            PoolTask: A handle to get the result with.
+        """
+        if function not in self.functions:
+            self.functions[function] = self.queue.add_function(function)
+        name = '{:012d}'.format(self._count)
+        self._count += 1
+        self.queue.add_task(name, self.functions[function], args, kwargs)
+        self.pending.add(name)
+        return PoolTask(self, name)
+
+    def map(self, function, iterable):
+        """Run function on every item of iterable and return the results."""
+        tasks = [self.submit(function, i) for i in iterable]
+        return [task.get() for task in tasks]
+
+    def waiting(self):
+        """Return the number of tasks not yet claimed by a worker."""
+        return len(self.queue.list('tasks'))
+
+    #############
+    #  Scaling  #
+    #############
+
+    def active(self):
+        """Return the names of workers whose jobs have not finished."""
+        active = []
+        for worker, job in self.workers.items():
+            if worker in self.stopped:
+                continue
+            if job.done or job.state in _queue.BAD_STATES:
+                self.stopped.add(worker)
+                count = self.queue.requeue(worker)
+                if count:
+                    _logme.log('Worker {} ended, requeued {} tasks'
+                               .format(worker, count), 'warn')
+                continue
+            active.append(worker)
+        return active
+
+    def scale(self, n_workers):
+        """Submit or stop workers until n_workers are active."""
+        active = self.active()
+        for _ in range(n_workers - len(active)):
+            worker = 'worker{:04d}'.format(len(self.workers))
+            job = _Job(run_worker,
+                       args=(self.path, worker, self.prefetch,
+                             self.idle_timeout),
+                       name='fyrd_{}'.format(worker), **self.kwds)
+            job.submit(wait_on_max_queue=False)
+            self.workers[worker] = job
+            _logme.log('Started {} as job {}'.format(worker, job.id), 'debug')
+        # Stop the newest first, they are the most likely to still be queued
+        for worker in sorted(active, reverse=True)[:len(active) - n_workers]:
+            self.queue.stop(worker)
+            self.stopped.add(worker)
+            _logme.log('Stopping {}'.format(worker), 'debug')
+
+    def autoscale(self):
+        """Add or stop workers to match the number of waiting tasks.
+
+        Workers are added (up to max_workers) while tasks are waiting and all
+        workers jobs are already running, and stopped (down to min_workers)
+        once no results are outstanding. Also requeues the tasks of workers
+        whose jobs have ended.
+        """
+        active  = self.active()
+        waiting = self.waiting()
+        if waiting and not active:
+            self.scale(max(1, self.min_workers))
+        elif waiting > len(active) and len(active) < self.max_workers:
+            queued = [w for w in active
+                      if self.workers[w].state in ('pending', 'queued')]
+            if not queued:
+                self.scale(min(self.max_workers, waiting))
+        elif not self.pending and len(active) > self.min_workers:
+            self.scale(self.min_workers)
+
+    def shutdown(self, wait=True, clean=True):
+        """Stop all workers.
+
+        Args:
+            wait (bool):  Block until the worker jobs exit.
+            clean (bool): Delete the pool directory and worker job files.
+        """
+        self.queue.stop()
+        for worker, job in self.workers.items():
+            if wait:
+                job.wait()
+            if clean:
+                job.clean(delete_outputs=True, get_outputs=False)
+        self.stopped.update(self.workers)
+        if clean:
+            _shutil.rmtree(self.path, ignore_errors=True)
+
+    def _check(self):
+        """Autoscale, but at most once every CHECK_INTERVAL seconds."""
+        if _time() - self._last > CHECK_INTERVAL:
+            self._last = _time()
+            self.autoscale()
+
+    def __enter__(self):
+        """Use as a context manager, shuts down on exit."""
+        return self
+
+    def __exit__(self, *args):
+        """Shut down the pool."""
+        self.shutdown()
+
+    def __len__(self):
+        """Number of active workers."""
+        return len(self.active())
+
+    def __repr__(self):
+        """Pool directory and workers."""
+        return 'WorkerPool<{}:workers:{};pending:{}>'.format(
+            self.path, len(self.workers) - len(self.stopped),
+            len(self.pending))
+
+
+class PoolTask(object):
+
+    """A handle on a task submitted to a WorkerPool."""
+
+    def __init__(self, pool, name):
+        """Store the pool and task name."""
+        self.pool    = pool
+        self.name    = name
+        self.file    = pool.queue.dir('results', name)
+        self._got    = False
+        self._result = None
+
+    @property
+    def done(self):
+        """True if the result is available."""
+        return self._got or _os.path.isfile(self.file)
+
+    def get(self, timeout=None):
+        """Block until the task has run and return its result.
+
+        Args:
+            timeout (float): Give up after this many seconds.
+
+        Raises:
+            ClusterError: If timeout is reached, or the task raised an
+                          exception that could not be pickled.
+            Exception:    Any exception raised by the task.
+        """
+        if not self._got:
+            start = _time()
+            while not _watcher.wait_for_files([self.file],
+                                              timeout=CHECK_INTERVAL):
+                if timeout and _time() - start > timeout:
+                    raise _ClusterError('Timed out waiting for task {}'
+                                        .format(self.name))
+                self.pool._check()
+            with open(self.file, 'rb') as fin:
+                self._result = _pickle.load(fin)
+            _os.remove(self.file)
+            self._got = True
+            self.pool.pending.discard(self.name)
+        success, out = self._result
+        if not success:
+            if isinstance(out, BaseException):
+                raise out
+            raise _ClusterError(out)
+        return out
+
+    def __repr__(self):
+        """Task name and state."""
+        return 'PoolTask<{}:done:{}>'.format(self.name, self.done)
+
+
+###############################################################################
+#                              Helper Functions                               #
+###############################################################################
+
+
+def _dumps(obj):
+    """Pickle obj with the standard pickle, or dill if that fails."""
+    try:
+        return _stdpickle.dumps(obj, protocol=2)
+    except Exception:
+        return _pickle.dumps(obj)
+
+
+def _dump_result(result):
+    """Pickle a (success, output) task result.
+
+    If the output cannot be pickled, the result is (False, the pickling
+    error), and if an error cannot be pickled, (False, its message).
+    """
+    try:
+        return _dumps(result)
+    except Exception as err:
+        error = result[1] if not result[0] else err
+    try:
+        return _dumps((False, error))
+    except Exception:
+        return _dumps((False, '{}: {}'.format(type(error).__name__, error)))
+
+
+def _makedirs(path):
+    """Make path and its parents, ignoring if it exists."""
+    try:
+        _os.makedirs(path)
+    except OSError as err:
+        if err.errno != _errno.EEXIST:
+            raise
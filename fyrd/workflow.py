@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+Build and submit pipelines of dependent jobs as a single graph.
+
+A Workflow holds a directed acyclic graph of Job objects, the edges are the
+dependencies between them. On submission the graph is validated, ordered
+topologically, and submitted one level at a time: every job in a level only
+depends on jobs in earlier levels, so all of its submissions can run at once.
+Edges become native afterok dependencies in torque and slurm, and dependencies
+in the local queue, where the whole graph is added in a single call.
+
+For example::
+
+    flow  = Workflow(profile='small')
+    fetch = flow.add(download, ('file1',))
+    runs  = [flow.add(analyze, (i,), depends=fetch) for i in range(10)]
+    flow.add(merge, depends=runs)
+    flow.submit()
+    flow.wait()
+    print(flow.report())
+"""
+from datetime import timedelta as _td
+from multiprocessing.pool import ThreadPool as _ThreadPool
+
+from . import local as _local
+from . import logme as _logme
+from . import queue as _queue
+from . import ClusterError as _ClusterError
+from .job import Job as _Job
+from .job import JobTemplate as _JobTemplate
+
+__all__ = ['Workflow']
+
+# Number of concurrent sbatch/qsub calls within a level
+SUBMIT_THREADS = 8
+
+
+###############################################################################
+#                             The Workflow Class                              #
+###############################################################################
+
+
+class Workflow(object):
+
+    """A graph of jobs with dependencies, submitted together.
+
+    Attributes:
+        jobs (list):    All Job objects in the order they were added.
+        parents (dict): {Job: [Job, ...]} the dependencies inside the graph.
+        external (dict): {Job: [int/Job, ...]} dependencies on jobs that are
+                         not in this workflow (e.g. already submitted).
+    """
+
+    def __init__(self, name=None, **kwds):
+        """Create an empty workflow.
+
+        Args:
+            name (str): A name for the workflow, used in logging only.
+
+            *All other keywords are passed to every Job created with `add()`,
+            they can be overridden per job.*
+        """
+        self.name     = name if name else 'workflow'
+        self.kwds     = kwds
+        self.template = None
+        self.jobs     = []
+        self.parents  = {}
+        self.external = {}
+        self.submitted = False
+
+    def add(self, command, args=None, kwargs=None, depends=None, **kwds):
+        """Create a Job and add it to the workflow.
+
+        Args:
+            command (function/str): The command or function to execute.
+            args (tuple/dict):      Optional arguments to add to command.
+            kwargs (dict):          Optional keyword arguments for functions.
+            depends (list):         Jobs (or job ids) this job depends on.
+
+            *All other keywords are passed to Job.*
+
+        Returns:
+            Job: The new job, use it in depends of later jobs.
+        """
+        name = kwds.pop('name', None)
+        if kwds:
+            options = self.kwds.copy()
+            options.update(kwds)
+            job = _Job(command, args=args, kwargs=kwargs, name=name,
+                       **options)
+        else:
+            # Resolve the shared options only once for the whole graph
+            if self.template is None:
+                self.template = _JobTemplate(**self.kwds)
+            job = self.template.make(command, args=args, kwargs=kwargs,
+                                     name=name)
+        return self.add_job(job, depends)
+
+    def add_job(self, job, depends=None):
+        """Add an existing, unsubmitted Job to the workflow.
+
+        Args:
+            job (Job):      The job to add.
+            depends (list): Jobs (or job ids) this job depends on, these are
+                            added to any dependencies the job already has.
+
+        Returns:
+            Job: The job.
+        """
+        if job.submitted:
+            raise _ClusterError('Cannot add a submitted job to a workflow')
+        if job in self.parents:
+            raise _ClusterError('{} is already in the workflow'.format(job))
+        self.jobs.append(job)
+        self.parents[job]  = []
+        self.external[job] = []
+        deps = list(job.dependencies) if job.dependencies else []
+        if depends is not None:
+            deps += depends if isinstance(depends, (list, tuple)) \
+                else [depends]
+        for dep in deps:
+            self.add_dependency(job, dep)
+        return job
+
+    def add_dependency(self, job, depends_on):
+        """Make job depend on depends_on.
+
+        Args:
+            job (Job):        A job in this workflow.
+            depends_on (Job): A job in this workflow, or any other Job or job
+                              id, which must then already be submitted when
+                              this workflow is.
+        """
+        if job not in self.parents:
+            raise _ClusterError('{} is not in the workflow'.format(job))
+        if depends_on in self.parents:
+            if depends_on not in self.parents[job]:
+                self.parents[job].append(depends_on)
+        elif isinstance(depends_on, (_Job, int, str)):
+            self.external[job].append(depends_on)
+        else:
+            raise _ClusterError('Dependencies must be Jobs or job ids')
+
+    ################
+    #  Validation  #
+    ################
+
+    def levels(self):
+        """Validate the graph and return the jobs grouped by level.
+
+        Level 0 has no dependencies inside the workflow, each later level only
+        depends on earlier ones, so concatenating the levels gives a
+        topological order.
+
+        Raises:
+            ClusterError: If the graph has a cycle.
+
+        Returns:
+            list: A list of lists of jobs.
+        """
+        children = {job: [] for job in self.jobs}
+        indegree = {}
+        for job in self.jobs:
+            indegree[job] = len(self.parents[job])
+            for parent in self.parents[job]:
+                children[parent].append(job)
+        level  = [job for job in self.jobs if not indegree[job]]
+        levels = []
+        count  = 0
+        while level:
+            levels.append(level)
+            count += len(level)
+            next_level = []
+            for job in level:
+                for child in children[job]:
+                    indegree[child] -= 1
+                    if not indegree[child]:
+                        next_level.append(child)
+            level = next_level
+        if count != len(self.jobs):
+            cycle = [job.name for job in self.jobs if indegree[job]]
+            raise _ClusterError('Workflow {} has a dependency cycle involving '
+                                '{}'.format(self.name, ', '.join(cycle)))
+        return levels
+
+    def order(self):
+        """Return all jobs in topological order."""
+        return [job for level in self.levels() for job in level]
+
+    ################
+    #  Submission  #
+    ################
+
+    def submit(self, wait_on_max_queue=True):
+        """Submit every job, parents always before children.
+
+        Args:
+            wait_on_max_queue (bool): Block before each level until the queue
+                                      has room for more jobs.
+
+        Returns:
+            self
+        """
+        if self.submitted:
+            _logme.log('Not submitting, already submitted.', 'warn')
+            return self
+        levels = self.levels()
+        qtypes = set(job.qtype for job in self.jobs)
+        if len(qtypes) > 1:
+            raise _ClusterError('All jobs in a workflow must use the same '
+                                'queue, not {}'.format(qtypes))
+        for job in self.jobs:
+            job.dependencies = self.parents[job] + self.external[job]
+        _logme.log('Submitting {} jobs in {} levels for {}'.format(
+            len(self.jobs), len(levels), self.name), 'debug')
+        if qtypes == set(['local']):
+            self._submit_local(levels)
+        elif qtypes:
+            self._submit_cluster(levels, wait_on_max_queue)
+        self.submitted = True
+        return self
+
+    def _submit_local(self, levels):
+        """Add all jobs to the local queue in one go."""
+        _local.get_queue(_local.THREADS)
+        # Jobs with a stored result are complete already
+        order = [job for level in levels for job in level
+                 if not (job.memo and job.kind == 'function'
+                         and job._load_memo())]
+        if not order:
+            return
+        for job in order:
+            if not job.written:
+                job.write()
+        ids = _local.JQUEUE.reserve(len(order))
+        for job, job_id in zip(order, ids):
+            job.id = job_id
+        local_jobs = []
+        for job in order:
+            local_job = job.local_job(job._dependency_ids())
+            local_job.id = job.id
+            local_jobs.append(local_job)
+        _local.JQUEUE.add_many(local_jobs)
+        for job in order:
+            job.submitted = True
+            job.state     = 'submitted'
+
+    def _submit_cluster(self, levels, wait_on_max_queue):
+        """Submit each level with several submissions running at once."""
+        queue = _queue.get_queue(qtype=self.jobs[0].qtype)
+        pool  = _ThreadPool(SUBMIT_THREADS)
+        try:
+            for level in levels:
+                if wait_on_max_queue:
+                    queue.wait_to_submit()
+                pool.map(lambda job: job.submit(wait_on_max_queue=False),
+                         level)
+        finally:
+            pool.close()
+            pool.join()
+
+    #############
+    #  Results  #
+    #############
+
+    def wait(self):
+        """Block until all jobs are complete.
+
+        Returns:
+            bool: True if every job completed successfully.
+        """
+        if not self.submitted:
+            self.submit()
+        return all([job.wait() for job in self.order()])
+
+    def get(self):
+        """Wait for all jobs and return their outputs.
+
+        Returns:
+            list: The output of every job, in the order they were added.
+        """
+        self.wait()
+        return [job.get() for job in self.jobs]
+
+    def critical_path(self):
+        """Return the longest chain of dependent jobs by runtime.
+
+        Only meaningful once all jobs are complete, jobs without runtime
+        information count as zero.
+
+        Returns:
+            tuple: (list of jobs on the path, total runtime as a timedelta)
+        """
+        best = {}
+        for job in self.order():
+            runtime = self._runtime(job)
+            if self.parents[job]:
+                prev = max([best[p] for p in self.parents[job]],
+                           key=_path_key)
+                best[job] = (prev[0] + runtime, prev[1] + [job])
+            else:
+                best[job] = (runtime, [job])
+        if not best:
+            return [], _td()
+        total, path = max(best.values(), key=_path_key)
+        return path, total
+
+    def report(self):
+        """Return a string summarizing runtimes and the critical path."""
+        path, total = self.critical_path()
+        starts = [job.start for job in self.jobs if job.start]
+        ends   = [job.end for job in self.jobs if job.end]
+        outstr = 'Workflow {}: {} jobs in {} levels\n'.format(
+            self.name, len(self.jobs), len(self.levels()))
+        if starts and ends:
+            outstr += 'Wall time: {}\n'.format(max(ends) - min(starts))
+        outstr += 'Total job time: {}\n'.format(
+            sum([self._runtime(j) for j in self.jobs], _td()))
+        outstr += 'Critical path ({}):\n'.format(total)
+        for job in path:
+            outstr += '    {}: {}\n'.format(job.name, self._runtime(job))
+        return outstr
+
+    @staticmethod
+    def _runtime(job):
+        """Return the runtime of job as a timedelta, zero if unknown."""
+        if job.start and job.end:
+            return job.end - job.start
+        return _td()
+
+    def __len__(self):
+        """Number of jobs."""
+        return len(self.jobs)
+
+    def __iter__(self):
+        """Iterate through jobs in topological order."""
+        for job in self.order():
+            yield job
+
+    def __repr__(self):
+        """Summary of the workflow."""
+        return 'Workflow<{}:jobs:{};submitted:{}>'.format(
+            self.name, len(self.jobs), self.submitted)
+
+
+def _path_key(path):
+    """Sort (runtime, jobs) tuples by runtime then length, for ties."""
+    return path[0], len(path[1])
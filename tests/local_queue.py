@@ -47,6 +47,8 @@ def test_job_execution():
     job = fyrd.Job('echo hi', profile='default', clean_files=True,
                    clean_outputs=True).submit()
     job.wait()
+    assert job.refresh().poll()
+    assert job.queue is fyrd.queue.get_queue('local')
     assert os.path.isfile(job.outfile)
     assert os.path.isfile(job.errfile)
     assert os.path.isfile(job.submission.file_name)
@@ -107,14 +109,315 @@ def test_function_submission():
 def test_function_keywords():
     """Submit a simple function with keyword arguments."""
     job = fyrd.Job(raise_me, (10,), kwargs={'power': 10}).submit()
-    assert job.get() == 10**10
+    assert job.in_process
+    assert job.get(cleanup=False) == 10**10
+    # Run in a local worker, without any script or pickle file
+    assert not os.path.isfile(job.submission.file_name)
+    assert not os.path.isfile(job.function.pickle_file)
+    assert job.poutfile is None
+    assert job.start <= job.end
+    job.clean(delete_outputs=True)
+    return 0
+
+
+def test_resubmit():
+    """Run a function job a second time with resubmit."""
+    job = fyrd.Job(raise_me, (5,), retries=1).submit()
+    assert job.get(cleanup=False) == 25
+    first = job.id
+    job.resubmit()
+    assert job.id != first
+    assert job.get() == 25
     job.clean(delete_outputs=True)
     return 0
 
 
+def test_packed():
+    """Run several function calls per job."""
+    tasks = fyrd.submit_packed(raise_me, range(5), tasks_per_job=2)
+    assert len(set(task.job for task in tasks)) == 3
+    assert [task.get() for task in tasks] == [0, 1, 4, 9, 16]
+    for job in set(task.job for task in tasks):
+        job.clean(delete_outputs=True)
+        assert not os.path.isfile(job.task_file)
+    return 0
+
+
+def test_worker_pool():
+    """Run tasks on a pool of two workers."""
+    pool  = fyrd.WorkerPool(2, idle_timeout=30)
+    tasks = [pool.submit(raise_me, i) for i in range(10)]
+    assert [task.get(timeout=60) for task in tasks] == \
+        [i**2 for i in range(10)]
+    assert pool.map(raise_me, [2, 3]) == [4, 9]
+    pool.shutdown()
+    assert not os.path.isdir(pool.path)
+    return 0
+
+
+def test_memo():
+    """Get a second identical function job from the result store."""
+    store = fyrd.memo.get_store()
+    store.path = os.path.abspath('memotest')
+    job = fyrd.Job(raise_me, (7,), memo=True).submit()
+    assert job.get() == 49
+    assert job.memo_key in store
+    job2 = fyrd.Job(raise_me, (7,), memo=True).submit()
+    assert job2.memoized
+    assert job2.id is None
+    assert job2.get() == 49
+    # A memoized dependency is complete already
+    job3 = fyrd.Job(raise_me, (2,), depends=[job2]).submit()
+    assert job3.get() == 4
+    # Workflows look up stored results too
+    for _ in range(2):
+        flow   = fyrd.Workflow(memo=True)
+        first  = flow.add(raise_me, (7,))
+        second = flow.add(raise_me, (3,), depends=[first])
+        assert flow.get() == [49, 9]
+    assert first.memoized and second.memoized
+    for each in [job, job2, job3, first, second]:
+        each.clean(delete_outputs=True)
+    store.clear()
+    return 0
+
+
+def test_workflow():
+    """Submit a diamond shaped workflow."""
+    flow  = fyrd.Workflow('diamond')
+    first = flow.add(raise_me, (2,))
+    mids  = [flow.add(raise_me, (i,), depends=first) for i in range(3)]
+    last  = flow.add('echo done', depends=mids)
+    assert len(flow.levels()) == 3
+    flow.submit()
+    assert flow.wait()
+    assert flow.get() == [4, 0, 1, 4, 'done\n']
+    path, _ = flow.critical_path()
+    assert path[0] is first and path[-1] is last
+    for job in flow.jobs:
+        job.clean(delete_outputs=True)
+    return 0
+
+
+def test_bulk_submission():
+    """Submit many trivial jobs straight to the local queue."""
+    if not fyrd.local.JQUEUE:
+        fyrd.local.JQUEUE = fyrd.local.JobQueue()
+    queue = fyrd.local.JQUEUE
+    start = dt.now()
+    jobs  = [queue.add(abs, (i,)) for i in range(200)]
+    assert dt.now() - start < td(seconds=10)
+    assert jobs == sorted(set(jobs))
+    queue.wait(jobs)
+    assert all(queue[i].state == 'done' for i in jobs)
+    assert all(queue[i].exitcode == 0 for i in jobs)
+    assert queue.get(jobs[-1]) == 199
+    # Changes are applied to the submitted Job objects
+    job    = fyrd.local.Job(abs, (-3,))
+    job.id = queue.reserve(1)[0]
+    queue.add_many([job])
+    queue.wait(job.id)
+    assert job.state == 'done'
+    assert job.out == 3
+    assert queue[job.id] is job
+    return 0
+
+
+def test_worker_recycling():
+    """Local workers are reused, and replaced after max_tasks jobs."""
+    queue = fyrd.local.JobQueue(cores=1, max_tasks=2)
+    pids  = [queue.get(queue.add(os.getpid)) for _ in range(4)]
+    assert pids[0] == pids[1] != pids[2] == pids[3]
+    job = queue.add(os._exit, (3,))
+    queue.wait(job)
+    assert queue[job].exitcode == 3
+    assert queue.get(queue.add(abs, (-2,))) == 2
+    return 0
+
+
+def test_failed_dependency():
+    """Jobs that depend on a failed job are cancelled."""
+    queue = fyrd.local.JobQueue(cores=2)
+    first = queue.add(os._exit, (2,))
+    child = queue.add(abs, (1,), dependencies=[first])
+    grand = queue.add(abs, (1,), dependencies=[child, first])
+    other = queue.add(abs, (1,))
+    queue.wait([first, child, grand, other])
+    assert queue[first].exitcode == 2
+    assert queue[child].state == queue[grand].state == 'cancelled'
+    assert queue[other].out == 1
+    late = queue.add(abs, (1,), dependencies=[grand])
+    queue.wait(late)
+    assert queue[late].state == 'cancelled'
+    return 0
+
+
+def test_memory_admission():
+    """Jobs only run together while their memory fits."""
+    from time import sleep, time
+    queue = fyrd.local.JobQueue(cores=2, mem=1000, mem_sample=0.1)
+    start = time()
+    jobs  = [queue.add(sleep, (0.5,), mem=800) for _ in range(2)]
+    queue.wait(jobs)
+    assert time() - start > 0.9
+    start = time()
+    jobs  = [queue.add(sleep, (0.5,), mem=400) for _ in range(2)]
+    queue.wait(jobs)
+    assert time() - start < 0.9
+    return 0
+
+
+def test_thread_executor():
+    """Thread jobs run here, sharing memory, with the same dependencies."""
+    from time import sleep
+    shared = []
+    queue  = fyrd.local.JobQueue(cores=2)
+    first  = queue.add(shared.append, (1,), executor='thread')
+    second = queue.add(abs, (-2,), dependencies=[first])
+    third  = queue.add(lambda: len(shared), dependencies=[second],
+                       executor='thread')
+    queue.wait([first, second, third])
+    assert shared == [1]
+    assert queue[third].out == 1
+    assert queue[third].pid == os.getpid() != queue[second].pid
+    failed = queue.add(int, ('a',), executor='thread')
+    child  = queue.add(abs, (1,), dependencies=[failed])
+    queue.wait([failed, child])
+    assert queue[failed].exitcode == 1
+    assert isinstance(queue[failed].out, ValueError)
+    assert queue[child].state == 'cancelled'
+    # A job without a number is numbered after every job, not the last thread
+    # job that ended
+    queue._send(fyrd.local.Job(abs, (-5,)))
+    sleep(0.5)
+    queue.update()
+    assert queue[child].state == 'cancelled'
+    job = fyrd.Job(raise_me, (3,), qtype='local', executor='thread')
+    assert job.submit().get() == 9
+    return 0
+
+
+def test_affinity():
+    """Jobs run on the CPUs they were given."""
+    if not hasattr(os, 'sched_getaffinity'):
+        return 0
+    queue = fyrd.local.JobQueue(cores=1, affinity=True)
+    job   = queue.add(os.sched_getaffinity, (0,))
+    queue.wait(job)
+    assert queue[job].cpus and queue[job].out == set(queue[job].cpus)
+    job   = queue.add(os.sched_getaffinity, (0,), executor='thread')
+    queue.wait(job)
+    assert queue[job].out == set(queue[job].cpus)
+    return 0
+
+
+def test_journal_restart():
+    """A killed runner is restarted and resumes its jobs."""
+    import signal
+    from time import sleep
+    queue = fyrd.local.JobQueue(cores=1, journal=True)
+    first = queue.add(os.getpid)
+    queue.wait(first)
+    pid   = queue[first].out
+    slow  = queue.add(sleep, (1,))
+    child = queue.add(abs, (-3,), dependencies=[slow])
+    sleep(0.3)
+    queue.update()
+    assert queue[slow].state == 'running'
+    orphan = queue[slow].pid
+    os.kill(queue.runner.pid, signal.SIGKILL)
+    sleep(0.1)
+    late = queue.add(abs, (-4,))
+    queue.wait([slow, child, late])
+    assert queue[first].out == pid
+    assert queue[slow].exitcode == 0 and queue[slow].pid != orphan
+    # The orphan is killed, but reaped by init
+    for _ in range(20):
+        if not fyrd.run.check_pid(orphan):
+            break
+        sleep(0.1)
+    assert not fyrd.run.check_pid(orphan)
+    assert queue[child].out == 3
+    assert queue[late].out == 4 and late > child
+    # Jobs that ended are compacted out of the journal
+    big = [queue.add(len, (bytes(100000),)) for _ in range(40)]
+    queue.wait(big)
+    assert queue[big[-1]].out == 100000
+    assert os.path.getsize(queue.journal) < 2*fyrd.local.JOURNAL_COMPACT
+    return 0
+
+
+def test_daemon():
+    """Two queues share the cores of one daemon, and each other's jobs."""
+    import tempfile
+    from time import sleep, time
+    path = os.path.join(tempfile.mkdtemp(), 'jobqueue.sock')
+    assert fyrd.daemon.start(cores=2, path=path)
+    try:
+        assert fyrd.daemon.running(path)
+        first  = fyrd.daemon.DaemonQueue(path)
+        second = fyrd.daemon.DaemonQueue(path)
+        assert first.cores == 2
+        start = time()
+        # raise_me is in __main__ here, so it is sent by value
+        slow  = [queue.add(sleep, (0.5,)) for queue in (first, second)]
+        power = second.add(raise_me, (3,), dependencies=[slow[0]])
+        first.wait()
+        second.wait()
+        assert second[power].out == 9
+        assert time() - start < 1.5
+        # Both sleeps ran at once, on the two cores
+        both = [queue.add(sleep, (0.5,), cores=2)
+                for queue in (first, second)]
+        first.wait()
+        second.wait()
+        assert time() - start >= 1.5
+        assert slow[0] not in second.jobs and both[0] not in second.jobs
+    finally:
+        stopped = fyrd.daemon.stop(path)
+    assert stopped
+    assert not fyrd.daemon.running(path)
+    try:
+        first.update()
+    except fyrd.ClusterError:
+        pass
+    else:
+        raise AssertionError('The stopped daemon was not noticed')
+    return 0
+
+
+def test_journal_replay():
+    """A replayed job that ended sends its output before it is done."""
+    import tempfile
+    path    = os.path.join(tempfile.mkdtemp(), 'journal')
+    job     = fyrd.local.Job(abs, (-5,))
+    job.id  = 7
+    fyrd.local.Journal(path).append(
+        [job, (1, 7, 'state', 'running'), (2, 7, 'out', 5),
+         (3, 7, 'exitcode', 0), (4, 7, 'state', 'done')]
+    )
+    jobqueue, outputs = fyrd.local.mp.Queue(), fyrd.local.mp.Queue()
+    runner = fyrd.local.mp.Process(
+        target=fyrd.local.job_runner,
+        args=(jobqueue, outputs, 1, None, 0, 0, 0, False, path)
+    )
+    runner.start()
+    try:
+        changes = outputs.get(timeout=10)
+    finally:
+        runner.terminate()
+        runner.join()
+    assert [(i[2], i[3]) for i in changes if i[1] == 7] == \
+        [('out', 5), ('exitcode', 0), ('state', 'done')]
+    return 0
+
+
 def test_dir_clean():
     """Clean all job files in this dir."""
+    tasks = fyrd.submit_packed(raise_me, range(2), tasks_per_job=2)
+    assert [task.get() for task in tasks] == [0, 1]
     fyrd.basic.clean_dir(delete_outputs=True)
+    assert not os.path.isfile(tasks[0].job.task_file)
     return 0
 
 
@@ -141,6 +444,20 @@ def main(argv=None):
     count += test_job_cleaning()
     count += test_function_submission()
     count += test_function_keywords()
+    count += test_resubmit()
+    count += test_packed()
+    count += test_worker_pool()
+    count += test_memo()
+    count += test_workflow()
+    count += test_bulk_submission()
+    count += test_worker_recycling()
+    count += test_failed_dependency()
+    count += test_memory_admission()
+    count += test_thread_executor()
+    count += test_affinity()
+    count += test_journal_restart()
+    count += test_journal_replay()
+    count += test_daemon()
     count += test_dir_clean()
     if count > 0:
         sys.stderr.write('Some tests failed')
@@ -0,0 +1,50 @@
+"""Test that importing fyrd is fast and has no side effects."""
+import os
+import sys
+import json
+import subprocess
+sys.path.append(os.path.abspath('.'))
+
+# Seconds, the best of three imports must be faster than this
+IMPORT_BUDGET = 1.0
+
+CHILD = """\
+import sys, json, time, subprocess
+calls = []
+class Popen(subprocess.Popen):
+    def __init__(self, *args, **kwargs):
+        calls.append(str(args[0]))
+        super(Popen, self).__init__(*args, **kwargs)
+subprocess.Popen = Popen
+start = time.time()
+import fyrd
+took = time.time() - start
+print(json.dumps({
+    'time': took, 'calls': calls, 'mode': fyrd.queue.MODE,
+    'modules': [i for i in ['numpy', 'pandas', 'readline', 'tabulate',
+                            'fyrd.helpers', 'fyrd.workers']
+                if i in sys.modules],
+}))
+"""
+
+
+def run_import(home):
+    """Import fyrd in a fresh python with HOME set to home."""
+    env = os.environ.copy()
+    env['HOME'] = home
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))
+    out = subprocess.check_output([sys.executable, '-c', CHILD], env=env)
+    return json.loads(out.decode().strip().split('\n')[-1])
+
+
+def test_import(tmpdir):
+    """No subprocesses, config files, or heavy imports, within budget."""
+    home = str(tmpdir)
+    results = [run_import(home) for _ in range(3)]
+    result = results[0]
+    assert result['calls'] == []
+    assert result['mode'] == ''
+    assert result['modules'] == []
+    assert not os.path.exists(os.path.join(home, '.fyrd'))
+    assert min(i['time'] for i in results) < IMPORT_BUDGET
@@ -1,6 +1,7 @@
 """Test remote queues, we can't test local queues in py.test."""
 import os
 import sys
+import pickle
 import pytest
 sys.path.append(os.path.abspath('.'))
 import fyrd
@@ -18,3 +19,196 @@ def test_job_creation():
     assert job.qtype == 'local'
     env = fyrd.get_cluster_environment()
     fyrd.queue.MODE = env
+
+
+def shout(word, times=1):
+    """Print and return word in upper case."""
+    sys.stdout.write('shouting\n')
+    return word.upper()*times
+
+
+def test_run_function(tmpdir, capsys):
+    """Function jobs run in a worker with outputs in files and a Result."""
+    outfile = str(tmpdir.join('job.out'))
+    errfile = str(tmpdir.join('job.err'))
+    payload = fyrd.serialize.dumps(
+        (fyrd.serialize.dumps_function(shout), ('hi',), {'times': 2}),
+        oob=False)[0]
+    with capsys.disabled():
+        result = fyrd.local.run_function(payload, outfile, errfile,
+                                         str(tmpdir), 'shout')
+    assert result.load() == 'HIHI'
+    with open(outfile) as fin:
+        lines = fin.read().split('\n')
+    assert lines[1:4] == ['Running shout', 'shouting', 'Done']
+    assert os.path.isfile(errfile)
+    payload = fyrd.serialize.dumps((b'not a function', None, None),
+                                   oob=False)[0]
+    assert isinstance(fyrd.local.run_function(payload).load(), Exception)
+
+
+@pytest.mark.skipif(fyrd.local._shared_memory is None,
+                    reason="No shared memory")
+def test_shared_result():
+    """Large buffers are passed in shared memory."""
+    data   = bytearray(b'x'*(fyrd.serialize.OOB_MIN_SIZE + 10))
+    result = fyrd.local.Result({'data': pickle.PickleBuffer(data),
+                                'small': 1})
+    assert result.shared
+    out = result.load()
+    assert out['data'] == data
+    assert out['small'] == 1
+    assert fyrd.local.Result(1).shared is None
+
+
+def test_schedule():
+    """Jobs start by priority, small jobs are backfilled around large ones."""
+    def queue(*jobs):
+        heap = []
+        for i, (cores, priority, time) in enumerate(jobs):
+            job = fyrd.local.Job(abs, (i,), cores=cores, priority=priority,
+                                 time=time)
+            job.id = i + 1
+            heap.append((-job.priority, job.id, job))
+        fyrd.local.heapify(heap)
+        return heap
+
+    ids = lambda jobs: [i.id for i in jobs]
+    # Higher priority first
+    ready = queue((1, 0, None), (1, 5, None), (1, 0, None))
+    assert ids(fyrd.local.schedule(ready, [], 2, now=0)) == [2, 1]
+    assert len(ready) == 1
+    # The 4 core job waits for the running job to end at 100, only the job
+    # that finishes before then may run on the free cores
+    ready = queue((4, 0, 100), (2, 0, '00:03:00'), (2, 0, 50))
+    assert ids(fyrd.local.schedule(ready, [(2, 100, 0)], 4, now=0)) == [3]
+    assert [i[1] for i in ready] == [1, 2]
+    # Cores the large job won't need can always be backfilled
+    ready = queue((3, 0, None), (1, 0, None), (2, 0, None))
+    assert ids(fyrd.local.schedule(ready, [(4, 10, 0)], 6, now=0)) == [2]
+    ready = queue((3, 0, None), (1, 0, None), (1, 0, None))
+    assert ids(fyrd.local.schedule(ready, [(4, 10, 0)], 6, now=0)) == [2, 3]
+    assert fyrd.local.Job(abs, time='1-01:00:10').time == 90010
+
+
+def test_schedule_memory():
+    """Jobs only start while their memory fits."""
+    def queue(*jobs):
+        heap = []
+        for i, (mem, time) in enumerate(jobs):
+            job = fyrd.local.Job(abs, (i,), mem=mem, time=time)
+            job.id = i + 1
+            heap.append((0, job.id, job))
+        return heap
+
+    ids = lambda jobs: [i.id for i in jobs]
+    ready = queue((3000, None), (3000, None), (1000, None))
+    assert ids(fyrd.local.schedule(ready, [], 8, mem=4000)) == [1, 3]
+    assert ids(fyrd.local.schedule(ready, [(1, None, 3000)], 8,
+                                   mem=4000)) == []
+    # The 3000 MB job waits for the running one to end at 100, the small one
+    # can only use memory the blocked job will need if it ends before then
+    running = [(1, 100, 2000)]
+    ready = queue((3000, None), (1000, None))
+    assert ids(fyrd.local.schedule(ready, running, 8, now=0,
+                                   mem=3500)) == []
+    ready = queue((3000, None), (1000, 50))
+    assert ids(fyrd.local.schedule(ready, running, 8, now=0,
+                                   mem=3500)) == [2]
+    # With nothing running, the head job always starts
+    assert ids(fyrd.local.schedule(queue((9000, None)), [], 8, mem=4000)) == [1]
+    assert ids(fyrd.local.schedule(queue((9000, None)), [], 8)) == [1]
+    # RSS is read from /proc for a process and its children
+    if os.path.isdir('/proc'):
+        assert fyrd.local._rss([os.getpid()])[os.getpid()] > 0
+        assert fyrd.local._mem_available() > 0
+
+
+def test_job_numbers(tmpdir):
+    """Job numbers are claimed in blocks and never handed out twice."""
+    path  = str(tmpdir.join('state'))
+    one   = fyrd.local.JobNumbers(path, block=10)
+    two   = fyrd.local.JobNumbers(path, block=10)
+    first = one.allocate(3)
+    assert len(first) == 3 and first == list(range(first[0], first[0] + 3))
+    start = first[0] - 1
+    assert two.allocate(1) == [start + 11]
+    assert one.allocate(7) == list(range(start + 4, start + 11))
+    assert one.allocate(12) == list(range(start + 21, start + 33))
+    assert one.allocate(1) == [start + 33]
+    with open(path) as fin:
+        assert int(fin.read()) == start + 42
+    # Only the last block to be claimed can be given back
+    two.close()
+    one.close()
+    assert fyrd.local.JobNumbers(path).allocate(1) == [start + 34]
+    assert not [i for i in os.listdir(str(tmpdir)) if i.endswith('.tmp')]
+
+
+def test_cpu_allocator():
+    """CPUs are handed out from one NUMA node where possible."""
+    assert fyrd.local._parse_cpus('0-3,8,10-11\n') == {0, 1, 2, 3, 8, 10, 11}
+    cpus = fyrd.local.CPUAllocator({0: {0, 1, 2, 3}, 1: {4, 5, 6, 7}})
+    first = cpus.allocate(2)
+    assert first in ([0, 1], [4, 5])
+    # The next small job goes on the same, fuller, node
+    second = cpus.allocate(1)
+    assert cpus.node[second[0]] == cpus.node[first[0]]
+    assert len(cpus.allocate(4)) == 4
+    assert cpus.allocate(2) is None
+    cpus.release(first)
+    assert cpus.allocate(2) == first
+    # Jobs bigger than a node are spread over several
+    cpus = fyrd.local.CPUAllocator({0: {0, 1}, 1: {2, 3}})
+    assert cpus.allocate(3) in ([0, 1, 2], [0, 2, 3])
+    assert cpus.allocate(0) is None
+    if hasattr(os, 'sched_getaffinity'):
+        nodes = fyrd.local._numa_nodes()
+        assert set().union(*nodes.values()) == os.sched_getaffinity(0)
+
+
+def test_journal(tmpdir):
+    """The journal is replayed up to the last complete record."""
+    path    = str(tmpdir.join('journal'))
+    journal = fyrd.local.Journal(path)
+    job     = fyrd.local.Job(abs, (-1,))
+    job.id  = 4
+    journal.append([job, (1, 4, 'state', 'submitted')])
+    journal.append([(2, 4, 'state', 'running'), (3, 4, 'pid', 10),
+                    (4, 5, 'state', 'running')])
+    journal.append([(5, 4, 'out', lambda: 1), (6, 4, 'exitcode', 0)])
+    with open(path, 'ab') as fout:
+        fout.write(pickle.dumps([(7, 4, 'state', 'done')])[:-3])
+    jobs = fyrd.local.Journal(path).replay()
+    assert list(jobs) == [4]
+    assert (jobs[4].state, jobs[4].pid, jobs[4].exitcode) == \
+        ('running', 10, 0)
+    journal.rewrite(list(jobs.values()))
+    assert fyrd.local.Journal(path).replay()[4].pid == 10
+    assert fyrd.local.Journal(str(tmpdir.join('none'))).replay() == {}
+
+
+def test_journal_compact(tmpdir, monkeypatch):
+    """Journals are private, and compacted once they outgrow their jobs."""
+    monkeypatch.setattr(fyrd.local, 'JOURNAL_COMPACT', 1000)
+    path    = str(tmpdir.join('journal'))
+    journal = fyrd.local.Journal(path)
+    jobs    = {}
+    for i in range(1, 4):
+        job    = fyrd.local.Job(len, ('x'*500,))
+        job.id = i
+        jobs[i] = job
+        journal.append([job, (i, i, 'state', 'submitted')])
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert journal.full()
+    jobs[1].state, jobs[1].out = 'done', 500
+    journal.compact(jobs)
+    assert not journal.full()
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    replayed = fyrd.local.Journal(path).replay()
+    assert (replayed[1].state, replayed[1].args, replayed[1].out) == \
+        ('done', None, None)
+    assert replayed[2].args == ('x'*500,)
+    # A journal is never created over an existing file
+    with pytest.raises(OSError):
+        fyrd.local._create_private(path)
@@ -0,0 +1,68 @@
+"""Test the result store used for memoization."""
+import os
+import sys
+import time
+sys.path.append(os.path.abspath('.'))
+import fyrd
+
+
+def double(x):
+    """Double x."""
+    return x*2
+
+
+def triple(x):
+    """Triple x."""
+    return x*3
+
+
+def test_job_key():
+    """Keys change with the function or the arguments."""
+    key = fyrd.memo.job_key(double, (2,))
+    assert key == fyrd.memo.job_key(double, (2,))
+    assert key != fyrd.memo.job_key(double, (3,))
+    assert key != fyrd.memo.job_key(triple, (2,))
+    assert key != fyrd.memo.job_key(double, (2,), {'a': 1})
+
+
+def test_store_and_evict(tmpdir):
+    """Results are stored, found, and evicted oldest first."""
+    store = fyrd.memo.ResultStore(str(tmpdir.join('memo')), max_size=1)
+    found, _ = store.lookup('abc')
+    assert not found
+    pfile = str(tmpdir.join('out.pickle'))
+    for key in ['aaa', 'bbb']:
+        fyrd.serialize.dump(os.urandom(600*1024), pfile)
+        store.store(key, pfile)
+        time.sleep(0.01)
+    assert 'aaa' not in store
+    assert 'bbb' in store
+    fyrd.serialize.dump(None, pfile)
+    store.store('none', pfile)
+    assert store.lookup('none') == (True, None)
+    store.clear()
+    assert 'bbb' not in store
+
+
+def test_memoized_dependency(tmpdir, monkeypatch):
+    """Dependencies completed from the store are not passed to the queue."""
+    calls = []
+
+    def cmd(args, tries=1):
+        """Record the submission."""
+        calls.append(args)
+        if args[0] == 'sbatch':
+            return 0, 'Submitted batch job 7', ''
+        return 0, '7.server', ''
+
+    monkeypatch.setattr(fyrd.queue, 'queue_parser', lambda *args: [])
+    monkeypatch.setattr(fyrd.run, 'cmd', cmd)
+    monkeypatch.chdir(str(tmpdir))
+    depend = fyrd.Job(double, (2,), qtype='local')
+    depend.memoized = True
+    for qtype in ['slurm', 'torque']:
+        job = fyrd.Job(double, (3,), qtype=qtype, depends=depend)
+        job.submit(wait_on_max_queue=False)
+        assert job.id == 7
+        assert calls.pop() == [{'slurm': 'sbatch', 'torque': 'qsub'}[qtype],
+                               job.submission.file_name]
@@ -79,6 +79,13 @@ def test_sane_keywords():
     # Check time
     j = fyrd.options.check_arguments({'time': '01-00:00:00'})
     assert j == {'time': '24:00:00'}
+    # Check compression
+    assert fyrd.options.check_arguments({'compress': 'GZIP'}) == {
+        'compress': 'gzip'}
+    assert fyrd.options.check_arguments({'compress': False}) == {
+        'compress': None}
+    with pytest.raises(fyrd.options.OptionsError):
+        fyrd.options.check_arguments({'compress': 'rar'})
 
 
 def test_split():
@@ -0,0 +1,60 @@
+"""Test packing many function calls into one job."""
+import os
+import sys
+import subprocess
+sys.path.append(os.path.abspath('.'))
+import pytest
+import fyrd
+
+
+def square(x):
+    """Square x, fail on 3."""
+    if x == 3:
+        raise ValueError('three')
+    return x*x
+
+
+def test_task_file(tmpdir):
+    """Complete records are read, a partial last record is ignored."""
+    tfile = str(tmpdir.join('job.tasks'))
+    with open(tfile, 'wb') as fout:
+        fyrd.serialize.write_task(fout, 0, 'zero')
+        fyrd.serialize.write_task(fout, 5, ValueError('five'))
+        fout.write(fyrd.serialize.TASK_HEADER.pack(6, 100) + b'cut')
+    results = fyrd.serialize.read_tasks(tfile)
+    assert sorted(results) == [0, 5]
+    assert results[0] == 'zero'
+    assert isinstance(results[5], ValueError)
+    assert fyrd.serialize.read_tasks(str(tmpdir.join('none'))) == {}
+
+
+@pytest.mark.parametrize('cores,method', [(1, None), (2, None),
+                                          (2, 'spawn')])
+def test_runner(tmpdir, monkeypatch, cores, method):
+    """The runner runs each task once, skipping those already done."""
+    if method:
+        # Set the start method of the runner, as on macOS
+        tmpdir.join('sitecustomize.py').write(
+            'import multiprocessing\n'
+            'multiprocessing.set_start_method({!r})\n'.format(method)
+        )
+        monkeypatch.setenv('PYTHONPATH', os.pathsep.join(
+            [str(tmpdir)] + sys.path))
+    tasks  = [(i, (i,), None) for i in range(6)]
+    script = fyrd.submission_scripts.Function(
+        str(tmpdir.join('square')), square, tasks=tasks, cores=cores
+    )
+    # A previous attempt finished task 0 and was killed while writing 1
+    with open(script.task_file, 'wb') as fout:
+        fyrd.serialize.write_task(fout, 0, 'done before')
+        fout.write(fyrd.serialize.TASK_HEADER.pack(1, 100))
+    script.write()
+    subprocess.check_call([sys.executable, script.file_name] +
+                          script.arguments)
+    results = fyrd.serialize.read_tasks(script.task_file)
+    assert sorted(results) == list(range(6))
+    assert results[0] == 'done before'
+    assert results[5] == 25
+    assert isinstance(results[3], ValueError)
+    assert fyrd.serialize.load(script.outfile) == 1
+    script.clean(delete_output=True)
@@ -38,6 +38,17 @@ def test_queue_creation():
     len(queue)
 
 
+def test_shared_queue():
+    """The shared queue is only updated when stale."""
+    queue = fyrd.queue.get_queue()
+    assert queue is fyrd.queue.get_queue(env)
+    last = queue.last_update
+    queue.update(max_age=60)
+    assert queue.last_update == last
+    queue.update(max_age=0)
+    assert queue.last_update > last
+
+
 def test_queue_parsers():
     """Test the queue parsers."""
     with pytest.raises(fyrd.ClusterError):
@@ -0,0 +1,72 @@
+"""Test resubmission of jobs that ran out of resources."""
+import os
+import sys
+sys.path.append(os.path.abspath('.'))
+import pytest
+import fyrd
+
+
+class FakeJob(object):
+
+    """Just enough of a Job for failure_reason."""
+
+    def __init__(self, qtype, state=None, exitcode=None):
+        self.id         = 10
+        self.qtype      = qtype
+        self.queue_info = fyrd.queue.Queue.QueueJob()
+        self.queue_info.state    = state
+        self.queue_info.exitcode = exitcode
+
+
+def test_scale():
+    """Time and memory are multiplied and normalized."""
+    assert fyrd.retry.scale_time('01:30:00', 2) == '03:00:00'
+    assert fyrd.retry.scale_time('1-00:00:00', 1.5) == '36:00:00'
+    assert fyrd.retry.scale_time('10:00', 3) == '00:30:00'
+    assert fyrd.retry.scale_mem(4000, 2) == 8000
+    assert fyrd.retry.scale_mem('4GB', 1.5) == 6144
+
+
+def test_policy():
+    """Only resource and node failures are retried, up to retries times."""
+    policy = fyrd.retry.RetryPolicy(retries=2, scale=2, backoff=10)
+    assert policy.can_retry('timeout', 0)
+    assert policy.can_retry('node_fail', 1)
+    assert not policy.can_retry('timeout', 2)
+    assert not policy.can_retry('failed', 0)
+    assert not policy.can_retry(None, 0)
+    assert [policy.delay(i) for i in [1, 2, 3]] == [10, 20, 40]
+    kwds = {'time': '01:00:00', 'mem': 1000, 'cores': 2}
+    assert policy.escalate(kwds, 'timeout') == {
+        'time': '02:00:00', 'mem': 1000, 'cores': 2}
+    assert policy.escalate(kwds, 'out_of_memory') == {
+        'time': '01:00:00', 'mem': 2000, 'cores': 2}
+    assert policy.escalate(kwds, 'node_fail') == kwds
+    assert kwds['time'] == '01:00:00'
+    with pytest.raises(fyrd.options.OptionsError):
+        fyrd.retry.RetryPolicy(retries=1, scale=0.5)
+
+
+def test_failure_reason(monkeypatch):
+    """Failures are classified from sacct, the queue state, or exit codes."""
+    monkeypatch.setattr(fyrd.retry, 'sacct_state', lambda x: None)
+    assert fyrd.retry.failure_reason(FakeJob('slurm', 'timeout')) == 'timeout'
+    assert fyrd.retry.failure_reason(FakeJob('slurm', 'completed')) is None
+    monkeypatch.setattr(fyrd.retry, 'sacct_state', lambda x: 'oom')
+    assert fyrd.retry.failure_reason(FakeJob('slurm', 'completed')) \
+        == 'out_of_memory'
+    assert fyrd.retry.failure_reason(FakeJob('torque', 'completed', -11)) \
+        == 'timeout'
+    assert fyrd.retry.failure_reason(FakeJob('torque', 'completed', 1)) \
+        is None
+
+
+def test_job_options():
+    """Retry options are taken out of the job keywords."""
+    job = fyrd.Job('echo hi', qtype='local', retries=3, retry_scale=1.5,
+                   retry_backoff=5)
+    assert job.retry.retries == 3
+    assert job.retry.scale == 1.5
+    assert job.retry.backoff == 5
+    assert 'retries' not in job.kwargs
+    assert job.failures == []
@@ -0,0 +1,75 @@
+"""Test the function runner script shared between jobs."""
+import os
+import sys
+import subprocess
+sys.path.append(os.path.abspath('.'))
+import fyrd
+
+
+def triple(x):
+    """Return 3x."""
+    return x*3
+
+
+def test_shared_runner(tmpdir):
+    """Jobs of the same function use one script with their own pickles."""
+    scripts = []
+    for i in range(3):
+        script = fyrd.submission_scripts.Function(
+            str(tmpdir.join('job{}_func.cluster.py'.format(i))), triple,
+            args=(i,), compress='gzip' if i == 2 else None, suffix='cluster'
+        )
+        script.write()
+        scripts.append(script)
+    runner = scripts[0].file_name
+    assert all(i.file_name == runner for i in scripts)
+    assert os.path.basename(runner).startswith('triple.')
+    assert runner.endswith('_func.cluster.py')
+    assert scripts[0].pickle_file != scripts[1].pickle_file
+    for i, script in enumerate(scripts):
+        subprocess.check_call([sys.executable, runner] + script.arguments)
+        assert fyrd.serialize.load(script.outfile) == i*3
+        script.clean(delete_output=True)
+        assert not os.path.exists(script.pickle_file)
+        # Deleted with the last job using it
+        assert os.path.isfile(runner) == (i < 2)
+    assert '--compress' in scripts[2].command()
+    # Other imports give a different script
+    other = fyrd.submission_scripts.Function(
+        str(tmpdir.join('job3')), triple, imports=['import json']
+    )
+    assert other.file_name != runner
+
+
+def total(values, offset=0):
+    """Sum values plus offset."""
+    return sum(values) + offset
+
+
+def test_blob_arguments(tmpdir, monkeypatch):
+    """Large arguments are stored once and fetched to scratch by the runner."""
+    blob_dir = str(tmpdir.join('blobs'))
+    scratch  = tmpdir.mkdir('scratch')
+    monkeypatch.setenv('TMPDIR', str(scratch))
+    table = list(range(300000))
+    for i in range(2):
+        script = fyrd.submission_scripts.Function(
+            str(tmpdir.join('job{}'.format(i))), total, args=(table,),
+            kwargs={'offset': i}, blob_dir=blob_dir
+        )
+        script.write()
+        assert os.path.getsize(script.pickle_file) < 1024
+        subprocess.check_call([sys.executable, script.file_name] +
+                              script.arguments)
+        assert fyrd.serialize.load(script.outfile) == sum(table) + i
+    # One blob for the function, one for the table
+    blobs = [f for _, _, files in os.walk(blob_dir) for f in files]
+    assert len(blobs) == 2
+    cache = scratch.join('fyrd-{}'.format(os.getuid()), 'blobs')
+    assert sorted(os.listdir(str(cache))) == sorted(blobs)
+    # A cache other users can write to is not used
+    os.chmod(str(cache), 0o777)
+    cache.join(blobs[0]).write('not a pickle')
+    subprocess.check_call([sys.executable, script.file_name] +
+                          script.arguments)
+    assert fyrd.serialize.load(script.outfile) == sum(table) + 1
@@ -0,0 +1,116 @@
+"""Test writing and reading function pickles."""
+import os
+import sys
+import time
+import pickle
+import pytest
+sys.path.append(os.path.abspath('.'))
+import fyrd
+
+oob = pytest.mark.skipif(not fyrd.serialize.OOB_AVAILABLE,
+                         reason="Requires pickle protocol 5")
+
+
+def test_plain_round_trip(tmpdir):
+    """Small objects are written as a single ordinary pickle."""
+    pfile = str(tmpdir.join('small.pickle'))
+    files = fyrd.serialize.dump({'a': [1, 2, 3]}, pfile)
+    assert files == [pfile]
+    assert not os.path.isfile(fyrd.serialize.buffer_file(pfile))
+    assert fyrd.serialize.load(pfile) == {'a': [1, 2, 3]}
+
+
+def test_dill_fallback(tmpdir):
+    """Objects the standard pickle can't handle still work."""
+    pfile = str(tmpdir.join('lambda.pickle'))
+    fyrd.serialize.dump(lambda x: x*2, pfile)
+    assert fyrd.serialize.load(pfile)(4) == 8
+
+
+@oob
+def test_out_of_band(tmpdir):
+    """Large buffers go to the sidecar and can be memory mapped."""
+    pfile = str(tmpdir.join('big.pickle'))
+    data  = bytearray(os.urandom(fyrd.serialize.OOB_MIN_SIZE + 10))
+    small = pickle.PickleBuffer(bytearray(b'small'))
+    files = fyrd.serialize.dump(
+        ('x', pickle.PickleBuffer(data), small), pfile
+    )
+    assert files == [pfile, fyrd.serialize.buffer_file(pfile)]
+    assert os.path.getsize(pfile) < 1024
+    name, big, little = fyrd.serialize.load(pfile)
+    assert name == 'x'
+    assert bytes(big) == bytes(data)
+    assert bytes(little) == b'small'
+    _, mapped, _ = fyrd.serialize.load(pfile, mmap=True)
+    assert mapped.readonly
+    assert bytes(mapped) == bytes(data)
+    _, mapped, _ = fyrd.serialize.load(pfile, mmap=True, writable=True)
+    mapped[0] = 0
+    assert fyrd.serialize.load(pfile)[1][:1] == data[:1]
+    fyrd.serialize.remove(pfile)
+    assert not os.path.exists(pfile)
+    assert not os.path.exists(fyrd.serialize.buffer_file(pfile))
+
+
+@pytest.mark.parametrize('codec', fyrd.serialize.available_codecs())
+def test_compression(tmpdir, codec):
+    """Compressed pickles are detected and loaded."""
+    pfile = str(tmpdir.join('comp.pickle'))
+    data  = ['hi'] * 10000
+    files = fyrd.serialize.dump(data, pfile, compress=codec)
+    assert files == [pfile]
+    assert fyrd.serialize.detect_codec(pfile) == codec
+    assert os.path.getsize(pfile) < 1024
+    assert fyrd.serialize.load(pfile) == data
+
+
+def test_blob_store(tmpdir):
+    """Blobs are stored once by content, small objects are not stored."""
+    store = fyrd.serialize.BlobStore(str(tmpdir.join('blobs')))
+    table = list(range(300000))
+    ref   = store.put(table, fyrd.serialize.BLOB_MIN_SIZE)
+    assert fyrd.serialize.is_blob(ref)
+    assert store.put(list(table)) == ref
+    assert store.get(ref) == table
+    assert store.put('small', fyrd.serialize.BLOB_MIN_SIZE) is None
+    assert len(os.listdir(store.path)) == 1
+    assert not [i for i in os.listdir(os.path.dirname(store.file_name(ref[1])))
+                if i.endswith('.tmp')]
+
+
+@oob
+def test_blob_out_of_band(tmpdir):
+    """Blobs with large buffers keep them in a sidecar."""
+    store = fyrd.serialize.BlobStore(str(tmpdir.join('blobs')))
+    data  = bytearray(os.urandom(fyrd.serialize.OOB_MIN_SIZE + 10))
+    ref   = store.put(pickle.PickleBuffer(data))
+    pfile = store.file_name(ref[1])
+    assert os.path.isfile(fyrd.serialize.buffer_file(pfile))
+    assert bytes(store.get(ref, mmap=True)) == bytes(data)
+
+
+def test_blob_prune(tmpdir):
+    """Old blobs go first, storing a blob again marks it as used."""
+    store = fyrd.serialize.BlobStore(str(tmpdir.join('blobs')))
+    refs  = [store.put(os.urandom(400*1024)) for _ in range(3)]
+    assert store.added == 3
+    for days, ref in zip([40, 20, 10], refs):
+        then = time.time() - days*86400
+        os.utime(store.file_name(ref[1]), (then, then))
+    assert store.prune(max_age=30) == [refs[0][1]]
+    # Used again, so the oldest is now the last one
+    assert store.put(store.get(refs[1])) == refs[1]
+    assert store.added == 3
+    assert store.prune(max_size=0.5) == [refs[2][1]]
+    assert store.get(refs[1])
+    assert store.prune() == []
+
+
+def test_call_payload():
+    """Function calls are loaded with default args and kwargs."""
+    payload = fyrd.serialize.dumps_call(divmod, (7, 2))
+    function, args, kwargs = fyrd.serialize.loads_call(payload)
+    assert function(*args, **kwargs) == (3, 1)
+    assert fyrd.serialize.loads_call(
+        fyrd.serialize.dumps_call(dict, by_value=True))[1:] == ((), {})
@@ -0,0 +1,47 @@
+"""Test creating many jobs from one JobTemplate."""
+import os
+import sys
+sys.path.append(os.path.abspath('.'))
+import pytest
+import fyrd
+
+
+def double(x):
+    """Return 2x."""
+    return x*2
+
+
+def test_make():
+    """Jobs from a template match jobs made directly."""
+    template = fyrd.JobTemplate(qtype='local', cores=2, mem='2GB',
+                                imports=['import os'])
+    job = template.make(double, (3,), name='double')
+    ref = fyrd.Job(double, (3,), name='double', qtype='local', cores=2,
+                   mem='2GB', imports=['import os'])
+    assert job.template is template
+    assert job.cores == ref.cores == 2
+    assert job.imports == ref.imports
+    assert sorted(job.kwargs) == sorted(ref.kwargs)
+    assert job.kwargs['mem'] == ref.kwargs['mem']
+    assert job.name != template.make(double, (4,), name='double').name
+    assert job.outfile.endswith('.out')
+    assert job.function.args == (3,)
+    with pytest.raises(fyrd.options.OptionsError):
+        fyrd.Job(double, template=template, cores=4)
+
+
+@pytest.mark.parametrize('qtype', ['slurm', 'torque'])
+def test_header(qtype, monkeypatch):
+    """The cached header gives the same script as building it fresh."""
+    # No scheduler here, only the scripts are built
+    monkeypatch.setattr(fyrd.queue, 'get_queue', lambda qtype=None: [])
+    template = fyrd.JobTemplate(qtype=qtype, cores=4, time='01:00:00')
+    assert template.header
+    assert 'outfile' not in template.header
+    job = template.make('echo hi', depends=[12])
+    assert job.dependencies == [12]
+    assert template.dependencies is None
+    full = fyrd.options.options_to_string(job.kwargs, qtype)
+    assert sorted(job._options_string().split('\n')) \
+        == sorted(full.split('\n'))
+    assert job.outfile in job.submission.script
@@ -0,0 +1,39 @@
+"""Test the output file watcher."""
+import os
+import sys
+import threading
+sys.path.append(os.path.abspath('.'))
+import fyrd
+
+
+def _write_later(files, delay=0.3):
+    """Create files in a thread after delay seconds."""
+    def write():
+        for fl in files:
+            with open(fl, 'w') as fout:
+                fout.write('hi\n')
+    timer = threading.Timer(delay, write)
+    timer.start()
+    return timer
+
+
+def test_wait_for_files(tmpdir):
+    """Files in two directories arrive after the wait starts."""
+    files = [str(tmpdir.join('a.out')), str(tmpdir.mkdir('sub').join('b.out'))]
+    timer = _write_later(files)
+    assert fyrd.watcher.wait_for_files(files, timeout=10)
+    timer.join()
+    # Files that already exist return immediately
+    assert fyrd.watcher.wait_for_files(files, timeout=0.5)
+
+
+def test_polling_and_timeout(tmpdir):
+    """Work without inotify, and time out on missing files."""
+    watcher = fyrd.watcher.FileWatcher()
+    watcher._inotify = None
+    files = [str(tmpdir.join('c.out')), str(tmpdir.join('d.out'))]
+    timer = _write_later(files[:1])
+    assert not watcher.wait(files, timeout=1)
+    timer.join()
+    assert watcher.wait(files[:1], timeout=1)
+    assert not watcher._subs
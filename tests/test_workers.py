@@ -0,0 +1,93 @@
+"""Test the directory task queue used by worker pools."""
+import os
+import sys
+import pickle
+sys.path.append(os.path.abspath('.'))
+import fyrd
+
+
+def add(x, y=0):
+    """Add x and y, fail on negative x."""
+    if x < 0:
+        raise ValueError('negative')
+    return x + y
+
+
+def numbers(x):
+    """Return a generator, which cannot be pickled."""
+    return (i for i in range(x))
+
+
+def raise_numbers(x):
+    """Raise an exception that cannot be pickled."""
+    raise ValueError(numbers(x))
+
+
+def test_claim_and_steal(tmpdir):
+    """Tasks are claimed by one worker only, idle workers steal."""
+    queue = fyrd.workers.TaskDir(str(tmpdir.join('pool')))
+    key = queue.add_function(add)
+    assert key == queue.add_function(add)
+    for i in range(3):
+        queue.add_task('{:012d}'.format(i), key, (i,), {})
+    for worker in ['a', 'b']:
+        os.makedirs(queue.dir('claimed', worker))
+        os.makedirs(queue.dir('running', worker))
+    assert queue.claim('a', 3) == 3
+    assert queue.list('tasks') == []
+    assert queue.claim('b') == 1
+    assert len(queue.list('claimed', 'a')) == 2
+    assert queue.start('b') == queue.list('running', 'b')[0]
+    assert queue.requeue('b') == 1
+    assert len(queue.list('tasks')) == 1
+
+
+def test_run_worker(tmpdir):
+    """A worker runs every task and exits when idle."""
+    queue = fyrd.workers.TaskDir(str(tmpdir.join('pool')))
+    key = queue.add_function(add)
+    queue.add_task('000', key, (1,), {'y': 2})
+    queue.add_task('001', key, (-1,), {})
+    queue.add_task('002', key, (5,), {})
+    queue.stop('other')
+    assert fyrd.workers.run_worker(queue.path, 'w', prefetch=2,
+                                   idle_timeout=0.2) == 3
+    results = {}
+    for name in queue.list('results'):
+        with open(queue.dir('results', name), 'rb') as fin:
+            results[name] = pickle.load(fin)
+    assert results['000'] == (True, 3)
+    assert results['001'][0] is False
+    assert isinstance(results['001'][1], ValueError)
+    assert results['002'] == (True, 5)
+    assert queue.list('running', 'w') == []
+    # Stopped workers exit without running anything
+    queue.add_task('003', key, (1,), {})
+    queue.stop()
+    assert fyrd.workers.run_worker(queue.path, 'w') == 0
+    assert queue.list('tasks') == ['003']
+
+
+def test_bad_tasks(tmpdir):
+    """Tasks that cannot be loaded or whose results cannot be pickled fail."""
+    queue = fyrd.workers.TaskDir(str(tmpdir.join('pool')))
+    for i, function in enumerate([numbers, raise_numbers]):
+        queue.add_task('{:03d}'.format(i), queue.add_function(function),
+                       (2,), {})
+    with open(queue.dir('tasks', '002'), 'wb') as fout:
+        fout.write(b'not a pickle')
+    queue.add_task('003', queue.add_function(add), (1,), {})
+    queue.stop('other')
+    assert fyrd.workers.run_worker(queue.path, 'w', idle_timeout=0.2) == 4
+    results = {}
+    for name in queue.list('results'):
+        with open(queue.dir('results', name), 'rb') as fin:
+            results[name] = pickle.load(fin)
+    assert results['000'][0] is False
+    assert isinstance(results['000'][1], TypeError)
+    assert results['001'][0] is False
+    assert results['001'][1].startswith('ValueError: ')
+    assert results['002'][0] is False
+    assert isinstance(results['002'][1], Exception)
+    assert results['003'] == (True, 1)
+    assert queue.list('running', 'w') == []
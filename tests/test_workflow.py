@@ -0,0 +1,29 @@
+"""Test building workflows, submission is tested in local_queue.py."""
+import os
+import sys
+import pytest
+sys.path.append(os.path.abspath('.'))
+import fyrd
+
+
+def test_levels():
+    """Jobs are grouped into topologically ordered levels."""
+    flow = fyrd.Workflow('test', qtype='local')
+    a = flow.add('echo a')
+    b = flow.add('echo b', depends=a)
+    c = flow.add('echo c', depends=a)
+    d = flow.add('echo d', depends=[b, c, 12])
+    assert flow.levels() == [[a], [b, c], [d]]
+    assert flow.external[d] == [12]
+    assert list(flow) == [a, b, c, d]
+
+
+def test_cycle():
+    """Cycles are refused."""
+    flow = fyrd.Workflow('cycle', qtype='local')
+    a = flow.add('echo a')
+    b = flow.add('echo b', depends=a)
+    flow.add_dependency(a, b)
+    with pytest.raises(fyrd.ClusterError):
+        flow.submit()
+    assert not a.submitted